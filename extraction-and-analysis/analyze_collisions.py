@@ -2,9 +2,13 @@
 # Phase: Analysis
 # Author: Luis Palazón Simón
 
+import argparse
 import pandas as pd
 import matplotlib.pyplot as plt
-from cmp_pages import mainRetDesc
+from comparison_cache import CACHE_FILE
+from cmp_pages import COMPARISON_COLUMNS, STATUS_ERROR, STATUS_MISSING, compare_pairs, format_desc
+from collisions_log import COLLISIONS_FILE, CHECKPOINT_FILE, load_collisions, ingest_collisions
+from dataset_store import save_dataset
 
 plt.rcParams.update({
     "text.usetex": True,
@@ -20,57 +24,48 @@ plt.rcParams.update({
     "figure.figsize": (24, 12)
 })
 
-file_path = './output_collisions_raw_dataset_filtered_2.out'
-# line format of the file:
-# CRITICAL:datalayer.database.page: [-] TLSH COLLISION [#pages 228438:228442]
+parser = argparse.ArgumentParser(description='Analiza las causas de las colisiones')
+parser.add_argument('-inc', '--incremental', action='store_true', help='Lee sólo las líneas añadidas al fichero de colisiones desde la última ejecución')
+parser.add_argument('-cp', '--checkpoint', default=CHECKPOINT_FILE, help='Fichero de checkpoint de la lectura incremental')
+parser.add_argument('-excel', '--excel', action='store_true', help='Exporta también los datasets a Excel')
+parser.add_argument('-nocache', '--nocache', action='store_true', help='Compara todas las parejas sin usar la caché de comparaciones ({})'.format(CACHE_FILE))
+args = parser.parse_args()
 
-df = pd.DataFrame(columns=['hash_function', 'page1', 'page2'])
+# Read the collisions of the APOTHEOSIS output file grouped by page1 and page2
+# (the values of hash_function are concatenated with the delimiter "+")
+if args.incremental:
+    df, new = ingest_collisions(COLLISIONS_FILE, args.checkpoint)
+    print('Nuevas colisiones leídas: {}'.format(new))
+else:
+    df = load_collisions(COLLISIONS_FILE)
 
-with open(file_path, 'r') as file:
-    for line in file:
-        if "COLLISION" in line:
-            # select the part of the line after '[-] '
-            l = line.split('[-] ')[1]
-            hash_function = l.split()[0]
-            # select the part of the line after '#pages '
-            l2 = l.split('#pages ')[1]
-            l2 = l2[:-2] # remove ']'
-            page1 = l2.split(':')[0]
-            page2 = l2.split(':')[1]
-            # print(hash_function, page1, page2)
-            df = df._append({'hash_function': hash_function, 'page1': page1, 'page2': page2}, ignore_index=True)
-
-    file.close()
-
-# Group by page1 and page2 and concatenate the values of hash_function with the delimiter "+"
-df = df.groupby(['page1', 'page2']).agg({'hash_function': '+'.join}).reset_index()
-
-# Save the dataframe to an excel file
-df.to_excel('coll_dataset.xlsx', index=False)
+# Save the dataframe (and optionally an excel report)
+save_dataset(df, 'coll_dataset.parquet', excel=args.excel)
 
 ## PAGE ANALYSIS ##
-# Add a new column to the dataframe with the description of the collision
-df['desc'] = ''
-# Recorrer las filas del dataframe
-for index, row in df.iterrows():
-    # Obtener los números de página
-    page1 = row['page1']
-    page2 = row['page2']
-    df.at[index, 'desc'] = mainRetDesc(page1, page2)
+# Add new columns to the dataframe with the result of the comparison of the
+# pages (status, shift, direction, diff_bytes, equal_ratio and warning) and
+# the description of the collision (the pairs of pages with the same contents
+# are compared only once, in parallel, and the pairs compared in previous runs
+# are taken from the comparison cache)
+table = compare_pairs(zip(df['page1'], df['page2']), cache=None if args.nocache else CACHE_FILE)
+for col in COMPARISON_COLUMNS:
+    df[col] = table[col].values
+df['desc'] = [format_desc(row) for row in table.to_dict('records')]
 
 ## COLLISION FILTERING ##
-# Remove the rows that have the field 'desc' a text that contains 'Error'
+# Remove the rows whose pages couldn't be compared
 # There are errors for 4 collisions of empty pages, so we remove them
-df = df[~df['desc'].str.contains('Error')]
-# Remove the rows that have the field 'desc' a text that contains '\Delta = 0'
+df = df[~df['status'].isin([STATUS_ERROR, STATUS_MISSING])]
+# Remove the rows with a displacement of 0 bytes
 # The entries are equal so it does not make sense to analyze the collision
-df = df[~df['desc'].str.contains('\Delta = 0')]
+df = df[~(df['shift'] == 0).fillna(False)]
 
 # Let only the first row of a same page1
 df = df.drop_duplicates(subset='page1', keep='first')
 
-# Save the dataframe to an excel file
-df.to_excel('coll_analisis_filter.xlsx', index=False)
+# Save the dataframe (and optionally an excel report)
+save_dataset(df, 'coll_analisis_filter.parquet', excel=args.excel)
 
 ## HISTOGRAMAS DE LAS CAUSAS DE COLISIÓN ##
 # Remove the text between parentheses in the field 'desc'
@@ -6,6 +6,7 @@
 import pandas as pd
 import os
 import matplotlib.pyplot as plt
+from dataset_store import save_dataset
 
 # Set Matplotlib to use LaTeX
 plt.rcParams.update({
@@ -62,8 +63,8 @@ for subdir in os.listdir(DIR):
                 df = df._append({'page1': page1, 'page2': page2, 'hash_function': hash_function, 'desc': desc, 'new_hash_function': new_hash_function}, ignore_index=True)
             f.close()
 
-# Save the dataframe to an Excel file
-df.to_excel('analysis_results.xlsx', index=False)
+# Save the dataframe and the final Excel report
+save_dataset(df, 'analysis_results.parquet', excel=True)
 
 # Show the frequency of the values of the new_hash_function column
 print(df['new_hash_function'].value_counts())
@@ -4,12 +4,32 @@
 # Author: Luis Palazón Simón
 
 import argparse
-import subprocess
-import tempfile
-import os
+import multiprocessing
+import numpy as np
+import pandas as pd
+from page_index import open_index
+from displacement import as_array, findAnchoredDisplacement, MismatchProfile
+from hexdiff import write_hexdiff
+from comparison_cache import CACHE_FILE, ComparisonCache
 
 PAGE_SIZE = 4096
 THRESHOLD = 2
+# Version of the comparison logic of compare_contents, it must be increased when
+# the logic changes so the results in the comparison cache are recalculated
+# (2: smaller exact displacements without anchors are found)
+COMPARISON_VERSION = 2
+# Result of the comparison of a pair of pages (see compare_contents)
+STATUS_SHIFT = 'shift'
+STATUS_BYTES = 'bytes'
+STATUS_THRESHOLD = 'shift_threshold'
+STATUS_UNDEFINED = 'undefined'
+STATUS_ERROR = 'error'
+STATUS_MISSING = 'missing'
+STATUSES = [STATUS_SHIFT, STATUS_BYTES, STATUS_THRESHOLD, STATUS_UNDEFINED, STATUS_ERROR, STATUS_MISSING]
+COMPARISON_COLUMNS = ['status', 'shift', 'direction', 'diff_bytes', 'equal_ratio', 'warning']
+# Spans of different bytes and bytes of each span printed in the summary
+SUMMARY_SPANS = 10
+SUMMARY_BYTES = 16
 
 
 def searchDisplacement(content1, content2, displacement, over1):
@@ -79,10 +99,7 @@ def cmpBytes(content1, content2):
     return:
         bool, true if the contents are equal byte by byte in more than 90%
     '''
-    eq = 0
-    for i in range(PAGE_SIZE):
-        if content1[i] == content2[i]:
-            eq += 1
+    eq = np.count_nonzero(as_array(content1)[:PAGE_SIZE] == as_array(content2)[:PAGE_SIZE])
     return eq > PAGE_SIZE*0.9
 
 def obtainDifferentBytes(content1, content2):
@@ -93,139 +110,275 @@ def obtainDifferentBytes(content1, content2):
     return:
         list of tuples, [(pos, byte1, byte2), ...]
     '''
-    diff = []
-    for i in range(PAGE_SIZE):
-        if content1[i] != content2[i]:
-            diff.append((i, content1[i], content2[i]))
-    return diff
+    a, b = as_array(content1)[:PAGE_SIZE], as_array(content2)[:PAGE_SIZE]
+    pos = np.flatnonzero(a != b)
+    return list(zip(pos.tolist(), a[pos].tolist(), b[pos].tolist()))
 
+def obtainDifferentSpans(content1, content2):
+    '''
+    Run-length encoding of the different bytes: consecutive different bytes
+    are grouped in a single span.
+    parameters:
+        content1: bytes
+        content2: bytes
+    return:
+        list of tuples, [(offset, length, bytes1, bytes2), ...]
+    '''
+    a, b = as_array(content1)[:PAGE_SIZE], as_array(content2)[:PAGE_SIZE]
+    # Edges of the runs of different bytes (+1 where a run starts, -1 where it ends)
+    edges = np.diff(np.concatenate(([0], (a != b).view(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1).tolist()
+    ends = np.flatnonzero(edges == -1).tolist()
+    return [(s, e - s, a[s:e].tobytes(), b[s:e].tobytes()) for s, e in zip(starts, ends)]
 
-def colordiff_files(file1, file2):
-    try:
-        # Generate hex dump of the two files using xxd
-        hex_dump1 = subprocess.run(['xxd', file1], capture_output=True, check=True).stdout
-        hex_dump2 = subprocess.run(['xxd', file2], capture_output=True, check=True).stdout
-        
-        # Create temporary files to store the hex dumps
-        with tempfile.NamedTemporaryFile(delete=False) as temp1, tempfile.NamedTemporaryFile(delete=False) as temp2:
-            temp1.write(hex_dump1)
-            temp2.write(hex_dump2)
-            temp1_path = temp1.name
-            temp2_path = temp2.name
-        
-        # Use colordiff to colorize the diff output of the two hex dump files
-        colordiff_output = subprocess.run(['colordiff', '-y', temp1_path, temp2_path], capture_output=True, text=True, check=True).stdout
-        
-        # Print the final colorized diff output
-        print(colordiff_output)
-    
-    except subprocess.CalledProcessError as e:
-        # print(f"An error occurred: {e}")
-        # print("Output:")
-        print(e.output)
+def printDifferentBytes(content1, content2, detail=False):
+    '''
+    Prints the different bytes of two contents: a summary of the spans of
+    different bytes (the first SUMMARY_SPANS) or, with detail, every byte.
+    parameters:
+        content1: bytes
+        content2: bytes
+        detail: bool, true to print every different byte
+    return:
+        int, number of different bytes
+    '''
+    spans = obtainDifferentSpans(content1, content2)
+    ndiff = sum(length for _, length, _, _ in spans)
+    print('> Bytes diferentes ({}) en {} regiones:'.format(ndiff, len(spans)))
+    if detail:
+        for offset, length, bytes1, bytes2 in spans:
+            for i in range(length):
+                print('  - Posición: {}, Byte en el primer archivo: {}, Byte en el segundo archivo: {}'.format(offset + i, hex(bytes1[i]), hex(bytes2[i])))
+        return ndiff
+    for offset, length, bytes1, bytes2 in spans[:SUMMARY_SPANS]:
+        more = '...' if length > SUMMARY_BYTES else ''
+        print('  - Posición: {}, longitud: {}B, primer archivo: {}{}, segundo archivo: {}{}'.format(offset, length, bytes1[:SUMMARY_BYTES].hex(), more, bytes2[:SUMMARY_BYTES].hex(), more))
+    if len(spans) > SUMMARY_SPANS:
+        print('  ... {} regiones más (usar --detail para verlas byte a byte)'.format(len(spans) - SUMMARY_SPANS))
+    return ndiff
 
-    finally:
-        # Cleanup temporary files
-        try:
-            os.remove(temp1_path)
-            os.remove(temp2_path)
-        except NameError:
-            pass
 
-def mainRetDesc(numPage1, numPage2):
-    found = False
-    warning = False
-    desc = "undefined"
-    # Obtain the names of the files (search in the current directory the file that starts with numPage1_ and numPage2_ using the find command)
-    res = subprocess.run(['find', '.', '-maxdepth', '1', '-type', 'f', '-name', '{}_*'.format(numPage1)], stdout=subprocess.PIPE)
-    if res.returncode != 0:
+def compare_contents(content1, content2, threshold=THRESHOLD):
+    '''
+    Compares two pages as mainRetDesc, without printing anything: searches the
+    smallest exact displacement and, if it isn't found or it's unreliable
+    (greater than 50% of the page), compares byte by byte or searches a
+    displacement with a threshold of different bytes.
+    parameters:
+        content1: bytes, memoryview or numpy.ndarray
+        content2: bytes, memoryview or numpy.ndarray
+        threshold: int, maximum different bytes of the displacement with a threshold
+    return:
+        dict with the fields of COMPARISON_COLUMNS:
+            status: str, one of STATUSES
+            shift: int, displacement in bytes (None if there isn't any)
+            direction: int, 1 if the displacement is over the first page, 2 if
+                       it's over the second one (None if there isn't any)
+            diff_bytes: int, different bytes (of the displacement or byte by byte)
+            equal_ratio: float, fraction of equal bytes byte by byte
+            warning: bool, true if an unreliable displacement has been found
+        and, for mainRetDesc, the exact displacement found (found_shift,
+        found_direction) and the anchor coverage of its overlap (coverage)
+    '''
+    result = dict(status=STATUS_ERROR, shift=None, direction=None, diff_bytes=None, equal_ratio=None, warning=False,
+                  found_shift=None, found_direction=None, coverage=None)
+    a, b = as_array(content1), as_array(content2)
+    if not ( len(a) == PAGE_SIZE and len(b) == PAGE_SIZE ):
+        return result
+    equal = int(np.count_nonzero(a == b))
+    result['equal_ratio'] = float(equal) / PAGE_SIZE
+    # - Search for displacement
+    displacement = findAnchoredDisplacement(a, b)
+    if displacement is not None:
+        i, over1, coverage = displacement
+        result.update(status=STATUS_SHIFT, shift=i, direction=1 if over1 else 2, diff_bytes=0,
+                      found_shift=i, found_direction=1 if over1 else 2, coverage=coverage)
+        result['warning'] = i > PAGE_SIZE*0.5
+        if not result['warning']:
+            return result
+    # - Byte to byte comparison
+    if equal > PAGE_SIZE*0.9:
+        if equal < PAGE_SIZE:
+            result.update(status=STATUS_BYTES, shift=None, direction=None, diff_bytes=PAGE_SIZE - equal)
+        return result
+    # - Displacement with a threshold of different bytes
+    shift = MismatchProfile(a, b).firstShift(threshold)
+    if shift is not None:
+        i, over1, diffbytes = shift
+        result.update(status=STATUS_THRESHOLD, shift=i, direction=1 if over1 else 2, diff_bytes=diffbytes)
+    else:
+        result.update(status=STATUS_UNDEFINED, shift=None, direction=None, diff_bytes=None)
+    return result
+
+
+def format_desc(result, latex=True):
+    '''
+    parameters:
+        result: dict or row with the fields of COMPARISON_COLUMNS (see compare_contents)
+        latex: bool, true to format the displacement as in the histograms
+               ($\\Delta = d$), false as in the output of the script
+               (desplazamiento de dB)
+    return:
+        str, description of the collision
+    '''
+    status = result['status']
+    if status == STATUS_ERROR:
+        return 'Error: los ficheros no tienen el tamaño de página esperado'
+    if status == STATUS_MISSING:
+        return 'Error: no se ha encontrado el fichero de la página'
+    if status == STATUS_BYTES:
+        return '{}B diferentes'.format(int(result['diff_bytes']))
+    if status in (STATUS_SHIFT, STATUS_THRESHOLD):
+        if latex:
+            desc = r'$\Delta = {}$ ({})'.format(int(result['shift']), int(result['direction']))
+        else:
+            desc = 'desplazamiento de {}B ({})'.format(int(result['shift']), int(result['direction']))
+        if status == STATUS_THRESHOLD:
+            desc += ' + {}B diferentes'.format(int(result['diff_bytes']))
+        return desc
+    return 'undefined'
+
+
+def mainRetDesc(numPage1, numPage2, detail=False):
+    # Obtain the names of the files from the index of the pages of the current directory
+    index = open_index('.')
+    if numPage1 not in index:
         print('No se ha encontrado el fichero del primer número de página')
         exit(1)
-    file1 = res.stdout.decode().split('\n')[0]
-    res = subprocess.run(['find', '.', '-maxdepth', '1', '-type', 'f', '-name', '{}_*'.format(numPage2)], stdout=subprocess.PIPE)
-    if res.returncode != 0:
+    if numPage2 not in index:
         print('No se ha encontrado el fichero del segundo número de página')
         exit(1)
-    file2 = res.stdout.decode().split('\n')[0]
+    file1 = index.name(numPage1)
+    file2 = index.name(numPage2)
     print('Ficheros a comparar:')
     print(' - {}'.format(file1))
     print(' - {}'.format(file2))
-    # Read files
-    with open(file1, 'rb') as f:
-        content1 = f.read()
-    f.close()
-    with open(file2, 'rb') as f:
-        content2 = f.read()
-    f.close()
-    if not ( len(content1) == PAGE_SIZE and len(content2) == PAGE_SIZE ):
+    # Read the pages (without copying them if they are in the page pack)
+    content1 = index.view(numPage1)
+    content2 = index.view(numPage2)
+    result = compare_contents(content1, content2)
+    status = result['status']
+    if status == STATUS_ERROR:
         print('Error: los ficheros no tienen el tamaño de página esperado')
         print('longitud de content1: {}'.format(len(content1)))
         print('longitud de content2: {}'.format(len(content2)))
-        return 'Error: los ficheros no tienen el tamaño de página esperado'
-    # Search for displacement or make the byte to byte comparison:
-    # - Search for displacement
-    for i in range(PAGE_SIZE):
-        if searchDisplacement(content1, content2, i, True):
-            print('Necesario desplazamiento de {}B sobre el primer archivo'.format(i))
-            found = True
-            desc = r'$\Delta = {}$ (1)'.format(i)
-            if i > PAGE_SIZE*0.5:
-                warning = True
-                print('\033[93mWarning: el desplazamiento es muy grande (mayor al 50% del tamaño de página) por lo que puede no ser correcto.\033[0m')
-            break
-        elif searchDisplacement(content1, content2, i, False):
-            print('Necesario desplazamiento de {}B sobre el segundo archivo'.format(i))
-            found = True
-            desc = r'$\Delta = {}$ (2)'.format(i)
-            if i > PAGE_SIZE*0.5:
-                warning = True
-                print('\033[93mWarning: el desplazamiento es muy grande (mayor al 50% del tamaño de página) por lo que puede no ser correcto.\033[0m')
-            break
-    # - Byte to byte comparison
-    if not found or warning:
-        if not found:
-            print('No se ha encontrado desplazamiento, comparando byte a byte...')
-        else:
-            print('Se ha encontrado un desplazamiento poco fiable, se recomienda comparar byte a byte...')
-        if cmpBytes(content1, content2):
-            print('> Los contenidos son iguales byte a byte en más de un 90%')
-            res = obtainDifferentBytes(content1, content2)
-            print('> Bytes diferentes ({}):'.format(len(res)))
-            for i in res:
-                print('  - Posición: {}, Byte en el primer archivo: {}, Byte en el segundo archivo: {}'.format(i[0], hex(i[1]), hex(i[2])))
-            if len(res) == 0:
-                print('> No hay diferencias')
-                print('> ¿Quiere ver la comparativa global? [y/n]')
-                if input() == 'y':
-                    print('> Comparando ficheros...')
-                    colordiff_files(file1, file2)
-            else:
-                desc = '{}B diferentes'.format(len(res))
+        return format_desc(result)
+    if result['warning'] or status == STATUS_SHIFT:
+        print('Necesario desplazamiento de {}B sobre el {} archivo'.format(result['found_shift'], 'primer' if result['found_direction'] == 1 else 'segundo'))
+    if result['warning']:
+        print('\033[93mWarning: el desplazamiento es muy grande (mayor al 50% del tamaño de página) por lo que puede no ser correcto.\033[0m')
+        if result['coverage'] is not None:
+            print('   Cobertura de anclas del solapamiento: {:.0%}'.format(result['coverage']))
+        print('Se ha encontrado un desplazamiento poco fiable, se recomienda comparar byte a byte...')
+    elif status != STATUS_SHIFT:
+        print('No se ha encontrado desplazamiento, comparando byte a byte...')
+    if status == STATUS_BYTES or (result['warning'] and status == STATUS_SHIFT):
+        print('> Los contenidos son iguales byte a byte en más de un 90%')
+        if printDifferentBytes(content1, content2, detail) == 0:
+            print('> No hay diferencias')
+    elif status in (STATUS_THRESHOLD, STATUS_UNDEFINED):
+        print('> Los contenidos tampoco son iguales byte a byte en más de un 90%')
+        print('> Probando el buscador de desplazamientos con un umbral de {} bytes...'.format(THRESHOLD))
+        if status == STATUS_THRESHOLD:
+            print('   Necesario desplazamiento de {}B sobre el {} archivo ({} bytes diferentes)'.format(result['shift'], 'primer' if result['direction'] == 1 else 'segundo', result['diff_bytes']))
         else:
-            print('> Los contenidos tampoco son iguales byte a byte en más de un 90%')
-            print('> Probando el buscador de desplazamientos con un umbral de {} bytes...'.format(THRESHOLD))
-            foundThreshold = False
-            for i in range(PAGE_SIZE):
-                res, diffbytes = searchDisplacementThreshold(content1, content2, i, True, THRESHOLD)
-                if res:
-                    print('   Necesario desplazamiento de {}B sobre el primer archivo ({} bytes diferentes)'.format(i, diffbytes))
-                    foundThreshold = True
-                    desc = r'$\Delta = {}$ (1) + {}B diferentes'.format(i, diffbytes)
-                    break
-                res, diffbytes = searchDisplacementThreshold(content1, content2, i, False, THRESHOLD)
-                if res:
-                    print('   Necesario desplazamiento de {}B sobre el segundo archivo ({} bytes diferentes)'.format(i, diffbytes))
-                    desc = r'$\Delta = {}$ (2) + {}B diferentes'.format(i, diffbytes)
-                    foundThreshold = True
-                    break
-            if not foundThreshold:
-                desc = 'undefined'
-                # print('> ¿Quiere ver la comparativa global? [y/n]')
-                # if input() == 'y':
-                #     print('> Comparando ficheros...')
-                #     colordiff_files(file1, file2)
-                print('> No se ha encontrado desplazamiento ni coincidencia byte a byte')
-    return desc
+            print('> No se ha encontrado desplazamiento ni coincidencia byte a byte')
+    return format_desc(result)
+
+
+# Index of the pages of the processes of the pool
+_pool_index = None
+
+
+def _init_compare(directory):
+    global _pool_index
+    _pool_index = open_index(directory)
+
+
+def _compare_task(task):
+    numPage1, numPage2, threshold = task
+    return compare_contents(_pool_index.view(numPage1), _pool_index.view(numPage2), threshold)
+
+
+def compare_pairs(pairs, workers=None, directory='.', cache=CACHE_FILE, threshold=THRESHOLD):
+    '''
+    Compares pairs of pages in a pool of processes, without printing anything.
+    Each pair of contents is compared only once: the pairs of pages with the
+    same contents (same digests) reuse the result, and the results of previous
+    runs are taken from the comparison cache.
+    parameters:
+        pairs: iterable of tuples (page1, page2), page numbers
+        workers: int, number of processes (the number of CPUs by default, 1
+                 to compare in this process)
+        directory: str, directory of the pages
+        cache: str, file of the comparison cache (None to compare every pair)
+        threshold: int, maximum different bytes of the displacement with a threshold
+    return:
+        pandas.DataFrame with the columns page1, page2 and COMPARISON_COLUMNS
+        (see compare_contents), one row per pair in the same order
+    '''
+    index = open_index(directory)
+    pairs = [(int(p1), int(p2)) for p1, p2 in pairs]
+    keys, tasks = [], {}
+    for numPage1, numPage2 in pairs:
+        if numPage1 not in index or numPage2 not in index:
+            keys.append(None)
+            continue
+        key = (index.digest(numPage1), index.digest(numPage2))
+        tasks.setdefault(key, (numPage1, numPage2, threshold))
+        keys.append(key)
+    cached = {}
+    if cache is not None:
+        cache = ComparisonCache(cache, COMPARISON_VERSION)
+        cached = cache.get_many(tasks.keys(), threshold)
+    unique = [(key, task) for key, task in tasks.items() if key not in cached]
+    workers = workers or multiprocessing.cpu_count()
+    if workers <= 1 or len(unique) <= 1:
+        _init_compare(directory)
+        results = [_compare_task(pair) for _, pair in unique]
+    else:
+        pool = multiprocessing.Pool(min(workers, len(unique)), _init_compare, (directory,))
+        try:
+            results = pool.map(_compare_task, [pair for _, pair in unique], chunksize=max(1, len(unique) // (4*workers)))
+        finally:
+            pool.close()
+            pool.join()
+    results = dict((key, res) for (key, _), res in zip(unique, results))
+    if cache is not None:
+        cache.put_many(results, threshold)
+        cache.close()
+    results.update(cached)
+    missing = dict(status=STATUS_MISSING, shift=None, direction=None, diff_bytes=None, equal_ratio=None, warning=False)
+    rows = [results[key] if key is not None else missing for key in keys]
+    table = pd.DataFrame({
+        'page1': pd.array([p1 for p1, _ in pairs], dtype='uint32'),
+        'page2': pd.array([p2 for _, p2 in pairs], dtype='uint32'),
+        'status': pd.Categorical([r['status'] for r in rows], categories=STATUSES),
+        'shift': pd.array([r['shift'] for r in rows], dtype='Int16'),
+        'direction': pd.array([r['direction'] for r in rows], dtype='Int8'),
+        'diff_bytes': pd.array([r['diff_bytes'] for r in rows], dtype='Int16'),
+        'equal_ratio': pd.array([r['equal_ratio'] for r in rows], dtype='Float32'),
+        'warning': pd.array([r['warning'] for r in rows], dtype='bool'),
+    })
+    table.attrs['unique'] = len(tasks)
+    table.attrs['cached'] = len(cached)
+    return table
+
+
+def describePairs(pages1, pages2, workers=None):
+    '''
+    Describes the collision of each pair of pages as mainRetDesc (see
+    compare_pairs). Each pair of contents is compared only once.
+    parameters:
+        pages1: iterable of int, page numbers of the first pages
+        pages2: iterable of int, page numbers of the second pages
+        workers: int, number of processes
+    return:
+        list of str, description of each pair
+    '''
+    table = compare_pairs(zip(pages1, pages2), workers)
+    print('Parejas comparadas: {} ({} parejas de contenidos distintas, {} en caché)'.format(len(table), table.attrs['unique'], table.attrs['cached']))
+    return [format_desc(row) for row in table.to_dict('records')]
 
 if __name__ == '__main__':
     found = False
@@ -235,48 +388,45 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Busca el desplazamiento de un contenido en otro a nivel de bytes')
     parser.add_argument('numPage1', type=int, help='Número de página del primer archivo')
     parser.add_argument('numPage2', type=int, help='Número de página del segundo archivo')
+    parser.add_argument('-d', '--detail', action='store_true', help='Muestra cada byte diferente en lugar del resumen por regiones')
+    parser.add_argument('-hex', '--hexdiff', default=None, metavar='FICHERO', help='Escribe la comparativa hexadecimal de las páginas, alineadas con el desplazamiento encontrado, en FICHERO (.html para HTML, - para la salida estándar)')
+    parser.add_argument('-c', '--context', type=int, default=None, help='Filas mostradas alrededor de las diferencias en la comparativa hexadecimal (todas por defecto)')
     args = parser.parse_args()
-    # Obtain the names of the files (search in the current directory the file that starts with numPage1_ and numPage2_ using the find command)
-    res = subprocess.run(['find', '.', '-maxdepth', '1', '-type', 'f', '-name', '{}_*'.format(args.numPage1)], stdout=subprocess.PIPE)
-    if res.returncode != 0:
+    # Obtain the names of the files from the index of the pages of the current directory
+    index = open_index('.')
+    if args.numPage1 not in index:
         print('No se ha encontrado el fichero del primer número de página')
         exit(1)
-    file1 = res.stdout.decode().split('\n')[0]
-    res = subprocess.run(['find', '.', '-maxdepth', '1', '-type', 'f', '-name', '{}_*'.format(args.numPage2)], stdout=subprocess.PIPE)
-    if res.returncode != 0:
+    if args.numPage2 not in index:
         print('No se ha encontrado el fichero del segundo número de página')
         exit(1)
-    file2 = res.stdout.decode().split('\n')[0]
+    file1 = index.name(args.numPage1)
+    file2 = index.name(args.numPage2)
     print('Ficheros a comparar:')
     print(' - {}'.format(file1))
     print(' - {}'.format(file2))
-    # Read files
-    with open(file1, 'rb') as f:
-        content1 = f.read()
-    f.close()
-    with open(file2, 'rb') as f:
-        content2 = f.read()
-    f.close()
+    # Read the pages (without copying them if they are in the page pack)
+    content1 = index.view(args.numPage1)
+    content2 = index.view(args.numPage2)
     assert len(content1) == PAGE_SIZE and len(content2) == PAGE_SIZE, 'Error: los ficheros no tienen el tamaño de página esperado'
     # Search for displacement or make the byte to byte comparison:
     # - Search for displacement
-    for i in range(PAGE_SIZE):
-        if searchDisplacement(content1, content2, i, True):
-            print('Necesario desplazamiento de {}B sobre el primer archivo'.format(i))
-            found = True
-            desc = 'desplazamiento de {}B (1)'.format(i)
-            if i > PAGE_SIZE*0.5:
-                warning = True
-                print('\033[93mWarning: el desplazamiento es muy grande (mayor al 50% del tamaño de página) por lo que puede no ser correcto.\033[0m')
-            break
-        elif searchDisplacement(content1, content2, i, False):
-            print('Necesario desplazamiento de {}B sobre el segundo archivo'.format(i))
-            found = True
-            desc = 'desplazamiento de {}B (2)'.format(i)
-            if i > PAGE_SIZE*0.5:
-                warning = True
-                print('\033[93mWarning: el desplazamiento es muy grande (mayor al 50% del tamaño de página) por lo que puede no ser correcto.\033[0m')
-            break
+    #   (smallest exact displacement in both directions, verifying the
+    #   candidates backed by anchors shared by both contents)
+    displacement = findAnchoredDisplacement(content1, content2)
+    # Displacement used to align the hexadecimal comparison
+    align = (0, 1)
+    if displacement is not None:
+        i, over1, coverage = displacement
+        print('Necesario desplazamiento de {}B sobre el {} archivo'.format(i, 'primer' if over1 else 'segundo'))
+        found = True
+        desc = 'desplazamiento de {}B ({})'.format(i, 1 if over1 else 2)
+        align = (i, 1 if over1 else 2)
+        if i > PAGE_SIZE*0.5:
+            warning = True
+            print('\033[93mWarning: el desplazamiento es muy grande (mayor al 50% del tamaño de página) por lo que puede no ser correcto.\033[0m')
+            if coverage is not None:
+                print('   Cobertura de anclas del solapamiento: {:.0%}'.format(coverage))
     # - Byte to byte comparison
     if not found or warning:
         if not found:
@@ -285,40 +435,30 @@ if __name__ == '__main__':
             print('Se ha encontrado un desplazamiento poco fiable, se recomienda comparar byte a byte...')
         if cmpBytes(content1, content2):
             print('> Los contenidos son iguales byte a byte en más de un 90%')
-            res = obtainDifferentBytes(content1, content2)
-            print('> Bytes diferentes ({}):'.format(len(res)))
-            for i in res:
-                print('  - Posición: {}, Byte en el primer archivo: {}, Byte en el segundo archivo: {}'.format(i[0], hex(i[1]), hex(i[2])))
-            if len(res) == 0:
+            ndiff = printDifferentBytes(content1, content2, args.detail)
+            if ndiff == 0:
                 print('> No hay diferencias')
-                print('> ¿Quiere ver la comparativa global? [y/n]')
-                if input() == 'y':
-                    print('> Comparando ficheros...')
-                    colordiff_files(file1, file2)
             else:
-                desc = '{}B diferentes'.format(len(res))
+                # The byte to byte comparison is shown without displacement
+                align = (0, 1)
+                desc = '{}B diferentes'.format(ndiff)
         else:
             print('> Los contenidos tampoco son iguales byte a byte en más de un 90%')
             print('> Probando el buscador de desplazamientos con un umbral de {} bytes...'.format(THRESHOLD))
-            foundThreshold = False
-            for i in range(PAGE_SIZE):
-                res, diffbytes = searchDisplacementThreshold(content1, content2, i, True, THRESHOLD)
-                if res:
-                    print('   Necesario desplazamiento de {}B sobre el primer archivo ({} bytes diferentes)'.format(i, diffbytes))
-                    foundThreshold = True
-                    desc = 'desplazamiento de {}B (1) + {}B diferentes'.format(i, diffbytes)
-                    break
-                res, diffbytes = searchDisplacementThreshold(content1, content2, i, False, THRESHOLD)
-                if res:
-                    print('   Necesario desplazamiento de {}B sobre el segundo archivo ({} bytes diferentes)'.format(i, diffbytes))
-                    desc = 'desplazamiento de {}B (2) + {}B diferentes'.format(i, diffbytes)
-                    foundThreshold = True
-                    break
+            # Different bytes of every displacement in both directions (calculated once)
+            shift = MismatchProfile(content1, content2).firstShift(THRESHOLD)
+            foundThreshold = shift is not None
+            if foundThreshold:
+                i, over1, diffbytes = shift
+                print('   Necesario desplazamiento de {}B sobre el {} archivo ({} bytes diferentes)'.format(i, 'primer' if over1 else 'segundo', diffbytes))
+                desc = 'desplazamiento de {}B ({}) + {}B diferentes'.format(i, 1 if over1 else 2, diffbytes)
+                align = (i, 1 if over1 else 2)
             if not foundThreshold:
                 desc = 'undefined'
-                # print('> ¿Quiere ver la comparativa global? [y/n]')
-                # if input() == 'y':
-                #     print('> Comparando ficheros...')
-                #     colordiff_files(file1, file2)
                 print('> No se ha encontrado desplazamiento ni coincidencia byte a byte')
-    
\ No newline at end of file
+        # Hexadecimal comparison (written without asking, so it can be used in batch runs)
+    if args.hexdiff is not None:
+        title = '{} - {} ({})'.format(file1, file2, desc)
+        write_hexdiff(content1, content2, args.hexdiff, shift=align[0], direction=align[1], context=args.context, title=title)
+        if args.hexdiff != '-':
+            print('> Comparativa hexadecimal escrita en {}'.format(args.hexdiff))
@@ -0,0 +1,283 @@
+# Description: Streaming parser for the collision logs generated by APOTHEOSIS.
+#              It builds the dataframe of colliding pages grouped by page1 and
+#              page2 shared by the extraction and analysis scripts. It can also
+#              ingest the log incrementally (with a checkpoint) while it grows.
+# Phase: Extraction/Analysis
+# Author: Luis Palazón Simón
+
+import os
+import re
+import pickle
+import time
+from array import array
+import pandas as pd
+
+COLLISIONS_FILE = './output_collisions_raw_dataset_filtered_2.out'
+# line format of the file:
+# CRITICAL:datalayer.database.page: [-] TLSH COLLISION [#pages 228438:228442]
+COLLISION_RE = re.compile(rb'\[-\] (\S+) COLLISION \[#pages (\d+):(\d+)\]')
+# Checkpoint of the incremental ingestion (position in the log and grouped table)
+CHECKPOINT_FILE = './collisions_checkpoint.pkl'
+
+
+class CollisionColumns:
+    '''
+    Typed columns of the COLLISION lines read from the log:
+        page1, page2: array of int64 with the page ids
+        codes: array of uint8 with the code of the hash function of each line
+        hash_functions: list with the names of the hash functions (categories)
+    '''
+    def __init__(self):
+        self.page1 = array('q')
+        self.page2 = array('q')
+        self.codes = array('B')
+        self.hash_functions = []
+        self._code_of = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def append(self, hash_function, page1, page2):
+        code = self._code_of.get(hash_function)
+        if code is None:
+            code = len(self.hash_functions)
+            self._code_of[hash_function] = code
+            self.hash_functions.append(hash_function)
+        self.page1.append(page1)
+        self.page2.append(page2)
+        self.codes.append(code)
+
+    def to_frame(self):
+        '''
+        return:
+            pandas.DataFrame, one row per COLLISION line with the columns
+            hash_function (categorical), page1 and page2 (int64)
+        '''
+        return pd.DataFrame({
+            'hash_function': pd.Categorical.from_codes(self.codes, categories=self.hash_functions),
+            'page1': pd.Series(self.page1, dtype='int64'),
+            'page2': pd.Series(self.page2, dtype='int64'),
+        })
+
+
+def parse_lines(lines, columns=None):
+    '''
+    parameters:
+        lines: iterable of bytes, lines of the collision log
+        columns: CollisionColumns where the collisions are appended (optional)
+    return:
+        CollisionColumns with the collisions found in the lines
+    '''
+    if columns is None:
+        columns = CollisionColumns()
+    search = COLLISION_RE.search
+    append = columns.append
+    for line in lines:
+        if b'COLLISION' not in line:
+            continue
+        m = search(line)
+        if m is None:
+            continue
+        append(m.group(1).decode(), int(m.group(2)), int(m.group(3)))
+    return columns
+
+
+def read_collisions(file_path=COLLISIONS_FILE):
+    '''
+    parameters:
+        file_path: str, path of the APOTHEOSIS output file
+    return:
+        pandas.DataFrame, one row per COLLISION line (see CollisionColumns.to_frame)
+    '''
+    with open(file_path, 'rb') as file:
+        columns = parse_lines(file)
+    return columns.to_frame()
+
+
+def group_collisions(df):
+    '''
+    Groups by page1 and page2 and concatenates the values of hash_function
+    with the delimiter "+" (in the order they appear in the log).
+    parameters:
+        df: pandas.DataFrame, as returned by read_collisions
+    return:
+        pandas.DataFrame with the columns page1, page2 and hash_function
+    '''
+    grouped = df.groupby(['page1', 'page2'], sort=True, observed=True)['hash_function'].agg('+'.join)
+    grouped = grouped.astype('category').reset_index()
+    return grouped
+
+
+def load_collisions(file_path=COLLISIONS_FILE):
+    '''
+    parameters:
+        file_path: str, path of the APOTHEOSIS output file
+    return:
+        pandas.DataFrame with the columns page1, page2 and hash_function
+    '''
+    return group_collisions(read_collisions(file_path))
+
+
+def merge_collisions(table, delta):
+    '''
+    Merges the pairs of delta into table without grouping again the whole history.
+    The hash functions of a pair already in table are appended with the delimiter "+".
+    parameters:
+        table: pandas.DataFrame with the columns page1, page2 and hash_function (or None)
+        delta: pandas.DataFrame with the same columns, grouped by page1 and page2
+    return:
+        pandas.DataFrame with the columns page1, page2 and hash_function
+    '''
+    if table is None or table.empty:
+        return delta
+    if delta.empty:
+        return table
+    old = table.set_index(['page1', 'page2'])['hash_function'].astype(str)
+    new = delta.set_index(['page1', 'page2'])['hash_function'].astype(str)
+    common = new.index.intersection(old.index)
+    if len(common) > 0:
+        old.loc[common] = old.loc[common] + '+' + new.loc[common]
+    merged = pd.concat([old, new.drop(common)]).sort_index()
+    return merged.astype('category').reset_index()
+
+
+class LogCheckpoint:
+    '''
+    Position reached in the collision log by the incremental ingestion:
+        file: str, path of the log
+        inode: int, inode of the log (to detect that it has been replaced)
+        offset: int, byte offset after the last complete line parsed
+        lines: int, number of complete lines parsed
+        table: pandas.DataFrame, grouped pairs up to that position
+    The position and the table are saved together in the same file, so they
+    are always consistent even if the ingestion is interrupted.
+    '''
+    def __init__(self, path=CHECKPOINT_FILE):
+        self.path = path
+        self.file = None
+        self.inode = None
+        self.reset()
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+            self.file = state['file']
+            self.inode = state['inode']
+            self.offset = state['offset']
+            self.lines = state['lines']
+            self.table = state['table']
+        return self
+
+    def reset(self):
+        self.offset = 0
+        self.lines = 0
+        self.table = None
+
+    def save(self):
+        state = {'file': self.file, 'inode': self.inode, 'offset': self.offset, 'lines': self.lines, 'table': self.table}
+        with open(self.path + '.tmp', 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def _complete_lines(file, checkpoint):
+    '''
+    Yields the complete lines of file from checkpoint.offset, updating the offset
+    and the line count of the checkpoint. A last line without newline (still
+    being written) is left for the next ingestion.
+    '''
+    file.seek(checkpoint.offset)
+    for line in file:
+        if not line.endswith(b'\n'):
+            break
+        checkpoint.offset += len(line)
+        checkpoint.lines += 1
+        yield line
+
+
+def ingest_collisions(file_path=COLLISIONS_FILE, checkpoint_path=CHECKPOINT_FILE, checkpoint=None):
+    '''
+    Parses only the lines appended to the log since the last ingestion and merges
+    the new pairs into the grouped table saved in the checkpoint. The checkpoint
+    is only saved if the position in the log has changed.
+    parameters:
+        file_path: str, path of the APOTHEOSIS output file
+        checkpoint_path: str, path of the checkpoint file
+        checkpoint: LogCheckpoint already loaded (e.g. kept in memory by
+                    follow_collisions), by default it's loaded from checkpoint_path
+    return:
+        pandas.DataFrame with the columns page1, page2 and hash_function
+        int, number of new COLLISION lines parsed
+    '''
+    if checkpoint is None:
+        checkpoint = LogCheckpoint(checkpoint_path).load()
+    st = os.stat(file_path)
+    file_abs = os.path.abspath(file_path)
+    changed = not os.path.exists(checkpoint.path)
+    # The log has been replaced or truncated: parse it from the beginning
+    if checkpoint.file != file_abs or checkpoint.inode != st.st_ino or st.st_size < checkpoint.offset:
+        checkpoint.reset()
+        changed = True
+    offset = checkpoint.offset
+    checkpoint.file = file_abs
+    checkpoint.inode = st.st_ino
+    with open(file_path, 'rb') as file:
+        columns = parse_lines(_complete_lines(file, checkpoint))
+    if len(columns) > 0:
+        delta = group_collisions(columns.to_frame())
+        checkpoint.table = merge_collisions(checkpoint.table, delta)
+    elif checkpoint.table is None:
+        checkpoint.table = group_collisions(columns.to_frame())
+    # Without new lines the checkpoint on disk is already up to date
+    if changed or checkpoint.offset != offset:
+        checkpoint.save()
+    return checkpoint.table, len(columns)
+
+
+def follow_collisions(file_path=COLLISIONS_FILE, checkpoint_path=CHECKPOINT_FILE, interval=5.0):
+    '''
+    Follows the log while it grows (like tail -f) and yields the grouped table
+    each time new COLLISION lines are appended.
+    parameters:
+        file_path: str, path of the APOTHEOSIS output file
+        checkpoint_path: str, path of the checkpoint file
+        interval: float, seconds between checks of the log
+    yield:
+        pandas.DataFrame with the columns page1, page2 and hash_function
+        int, number of new COLLISION lines parsed
+    '''
+    # The checkpoint (and its table) is kept in memory between the checks
+    checkpoint = LogCheckpoint(checkpoint_path).load()
+    first = True
+    while True:
+        table, new = ingest_collisions(file_path, checkpoint_path, checkpoint)
+        if new > 0 or first:
+            yield table, new
+            first = False
+        time.sleep(interval)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Lee el fichero de colisiones de APOTHEOSIS y agrupa las páginas que colisionan')
+    parser.add_argument('file', nargs='?', default=COLLISIONS_FILE, help='Fichero de salida de APOTHEOSIS')
+    parser.add_argument('-inc', '--incremental', action='store_true', help='Lee sólo las líneas añadidas desde el último checkpoint')
+    parser.add_argument('-f', '--follow', action='store_true', help='Sigue el fichero mientras crece (como tail -f)')
+    parser.add_argument('-cp', '--checkpoint', default=CHECKPOINT_FILE, help='Fichero de checkpoint de la lectura incremental')
+    parser.add_argument('-i', '--interval', type=float, default=5.0, help='Segundos entre comprobaciones en modo follow')
+    args = parser.parse_args()
+    if args.follow:
+        try:
+            for df, new in follow_collisions(args.file, args.checkpoint, args.interval):
+                print('Nuevas colisiones: {}. Total de parejas: {}'.format(new, df.shape[0]))
+        except KeyboardInterrupt:
+            pass
+    else:
+        if args.incremental:
+            df, new = ingest_collisions(args.file, args.checkpoint)
+            print('Nuevas colisiones: {}'.format(new))
+        else:
+            df = load_collisions(args.file)
+        print(df)
+        print('Total de parejas: {}'.format(df.shape[0]))
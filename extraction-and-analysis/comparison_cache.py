@@ -0,0 +1,136 @@
+# Description: Persistent cache (SQLite) of the results of the comparisons of
+#              pairs of pages keyed by the digests of their contents, the
+#              version of the comparison logic and the threshold of different
+#              bytes, so the reruns only compare the pairs not seen before
+# Phase: Analysis
+# Author: Luis Palazón Simón
+
+import sqlite3
+
+CACHE_FILE = './comparison_cache.sqlite'
+# Keys per query (older versions of SQLite allow up to 999 parameters)
+BATCH_SIZE = 200
+FIELDS = ['status', 'shift', 'direction', 'diff_bytes', 'equal_ratio', 'warning']
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS comparisons (digest1 TEXT NOT NULL, digest2 TEXT NOT NULL, "
+    "version INTEGER NOT NULL, threshold INTEGER NOT NULL, status TEXT NOT NULL, shift INTEGER, "
+    "direction INTEGER, diff_bytes INTEGER, equal_ratio REAL, warning INTEGER NOT NULL, "
+    "PRIMARY KEY (digest1, digest2, version, threshold))",
+]
+
+
+def _value(value):
+    # NumPy scalars are converted to Python values
+    return value.item() if hasattr(value, 'item') else value
+
+
+class ComparisonCache:
+    '''
+    Results of compare_contents (cmp_pages.py) stored by
+    (digest1, digest2, version, threshold). When it's opened with a version of
+    the comparison logic different from the one of the stored results, these
+    are removed.
+    '''
+    def __init__(self, path=CACHE_FILE, version=None):
+        self.path = path
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path, timeout=60)
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        if version is not None:
+            self.invalidate(version)
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM comparisons").fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+    def invalidate(self, version):
+        '''
+        Removes the results of the versions of the comparison logic other than version
+        parameters:
+            version: int, current version of the comparison logic
+        return:
+            int, number of results removed
+        '''
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is not None and row[0] == version:
+            return 0
+        removed = self.db.execute("DELETE FROM comparisons WHERE version != ?", (version,)).rowcount
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+        self.db.commit()
+        return removed
+
+    def get_many(self, keys, threshold):
+        '''
+        parameters:
+            keys: list of tuples (digest1, digest2)
+            threshold: int, threshold of different bytes of the comparison
+        return:
+            dict, (digest1, digest2) -> dict with the FIELDS of the result, only
+            for the keys in the cache
+        '''
+        found = {}
+        keys = list(keys)
+        for i in range(0, len(keys), BATCH_SIZE):
+            batch = keys[i:i+BATCH_SIZE]
+            query = "SELECT digest1, digest2, {} FROM comparisons WHERE version = ? AND threshold = ? " \
+                    "AND ({})".format(', '.join(FIELDS), ' OR '.join(['(digest1 = ? AND digest2 = ?)']*len(batch)))
+            params = [self.version, threshold] + [digest for key in batch for digest in key]
+            for row in self.db.execute(query, params):
+                result = dict(zip(FIELDS, row[2:]))
+                result['warning'] = bool(result['warning'])
+                found[(row[0], row[1])] = result
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, results, threshold):
+        '''
+        parameters:
+            results: dict, (digest1, digest2) -> result of compare_contents
+            threshold: int, threshold of different bytes of the comparison
+        '''
+        rows = [key + (self.version, threshold) + tuple(_value(result[field]) for field in FIELDS)
+                for key, result in results.items()]
+        self.db.executemany("INSERT OR REPLACE INTO comparisons VALUES (?, ?, ?, ?, {})".format(
+            ', '.join(['?']*len(FIELDS))), rows)
+        self.db.commit()
+
+    def clear(self):
+        '''Removes all the results'''
+        self.db.execute("DELETE FROM comparisons")
+        self.db.commit()
+
+    def stats(self):
+        '''
+        return:
+            dict, results stored per version and threshold and hits and misses of this session
+        '''
+        rows = self.db.execute("SELECT version, threshold, COUNT(*) FROM comparisons GROUP BY version, threshold").fetchall()
+        return {
+            'results': dict(((version, threshold), count) for version, threshold, count in rows),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Muestra o vacía la caché de comparaciones de páginas')
+    parser.add_argument('cache', nargs='?', default=CACHE_FILE, help='Fichero de la caché. Por defecto {}'.format(CACHE_FILE))
+    parser.add_argument('-clear', '--clear', action='store_true', help='Elimina todos los resultados de la caché')
+    args = parser.parse_args()
+    cache = ComparisonCache(args.cache)
+    if args.clear:
+        cache.clear()
+    stats = cache.stats()
+    print('Resultados en caché: {}'.format(len(cache)))
+    for (version, threshold), count in sorted(stats['results'].items()):
+        print(' - versión {}, umbral {}: {}'.format(version, threshold, count))
+    cache.close()
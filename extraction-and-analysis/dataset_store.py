@@ -0,0 +1,129 @@
+# Description: Columnar store (Parquet) of the collision datasets passed between
+#              the stages of the analysis. Excel is only used as an optional
+#              final report.
+# Phase: Analysis
+# Author: Luis Palazón Simón
+
+import os
+import pandas as pd
+
+# Compact dtypes of the columns of the datasets
+DTYPES = {
+    'page1': 'uint32',
+    'page2': 'uint32',
+    'hash_function': 'category',
+    'desc': 'category',
+    'status': 'category',
+    'shift': 'Int16',
+    'direction': 'Int8',
+    'diff_bytes': 'Int16',
+    'equal_ratio': 'Float32',
+    'warning': 'bool',
+    'new_hash_function': 'category',
+}
+# Rows per row group, readers only decode the row groups they need
+ROW_GROUP_SIZE = 65536
+
+
+def compact(df):
+    '''
+    parameters:
+        df: pandas.DataFrame
+    return:
+        pandas.DataFrame, df with the known columns converted to compact dtypes
+    '''
+    dtypes = {col: dtype for col, dtype in DTYPES.items() if col in df.columns and df[col].dtype != dtype}
+    return df.astype(dtypes) if dtypes else df
+
+
+def excel_path(path):
+    '''
+    return:
+        str, path of the Excel report of the dataset stored in path
+    '''
+    return os.path.splitext(path)[0] + '.xlsx'
+
+
+def save_dataset(df, path, excel=False):
+    '''
+    parameters:
+        df: pandas.DataFrame
+        path: str, path of the .parquet file
+        excel: bool, true to also export the dataset as an Excel report
+    '''
+    df = compact(df)
+    df.to_parquet(path, engine='pyarrow', index=False, row_group_size=ROW_GROUP_SIZE)
+    if excel:
+        df.to_excel(excel_path(path), index=False)
+
+
+def load_dataset(path, columns=None, filters=None):
+    '''
+    parameters:
+        path: str, path of the .parquet file (.xlsx files of previous executions are also accepted)
+        columns: list of str, columns to load (all by default)
+        filters: list of tuples, pyarrow filters to select the rows,
+                 e.g. [('hash_function', '==', 'TLSH')]
+    return:
+        pandas.DataFrame
+    '''
+    if path.endswith('.xlsx'):
+        df = pd.read_excel(path)
+        if filters:
+            for col, op, value in filters:
+                assert op in ('==', 'in'), 'Error: filtro no soportado para ficheros Excel'
+                df = df[df[col] == value] if op == '==' else df[df[col].isin(value)]
+        if columns:
+            df = df[columns]
+        return compact(df.reset_index(drop=True))
+    return pd.read_parquet(path, engine='pyarrow', columns=columns, filters=filters)
+
+
+def hash_function_filters(path, hash_function):
+    '''
+    Filters of the rows that collided with a hash function, alone or with other
+    ones (the values of hash_function are joined with "+", e.g. TLSH+SSDEEP).
+    Only the column hash_function is read to obtain its values.
+    parameters:
+        path: str, path of the dataset
+        hash_function: str, hash function (e.g. 'TLSH'), case insensitive
+    return:
+        list of tuples, filters for load_dataset
+    '''
+    if path.endswith('.xlsx'):
+        values = pd.read_excel(path, usecols=['hash_function'])['hash_function']
+    else:
+        values = pd.read_parquet(path, engine='pyarrow', columns=['hash_function'])['hash_function']
+    values = [v for v in pd.unique(values.dropna().astype(str)) if hash_function.upper() in v.upper().split('+')]
+    # (pyarrow doesn't accept an empty list, the function itself matches nothing)
+    return [('hash_function', 'in', values or [hash_function])]
+
+
+def load_pairs(path, hash_function=None):
+    '''
+    parameters:
+        path: str, path of the dataset
+        hash_function: str, only load the pairs that collided with this hash
+                       function (e.g. 'TLSH', also the ones of 'TLSH+SSDEEP')
+    return:
+        pandas.DataFrame with the columns page1 and page2
+    '''
+    filters = hash_function_filters(path, hash_function) if hash_function else None
+    return load_dataset(path, columns=['page1', 'page2'], filters=filters)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Muestra o exporta a Excel un dataset de colisiones')
+    parser.add_argument('dataset', help='Fichero .parquet del dataset')
+    parser.add_argument('-cols', '--columns', nargs='+', default=None, help='Columnas a cargar')
+    parser.add_argument('-hf', '--hash_function', default=None, help='Cargar sólo las filas que colisionan con esta función de hash (también combinada, p. ej. TLSH+SSDEEP)')
+    parser.add_argument('-excel', '--excel', action='store_true', help='Exportar el dataset a Excel')
+    args = parser.parse_args()
+    filters = hash_function_filters(args.dataset, args.hash_function) if args.hash_function else None
+    df = load_dataset(args.dataset, columns=args.columns, filters=filters)
+    if args.excel:
+        df.to_excel(excel_path(args.dataset), index=False)
+        print('Dataset exportado a {}'.format(excel_path(args.dataset)))
+    else:
+        print(df)
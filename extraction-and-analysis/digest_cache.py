@@ -0,0 +1,163 @@
+# Description: Persistent store (SQLite) of the digests calculated with the SUM
+#              tool keyed by the xxHash64 of the content, the algorithm and the
+#              derelocation, so a content is hashed only once by hashes.py and
+#              the hashing workers. It can be warmed up with all the pages.
+# Phase: Analysis
+# Author: Luis Palazón Simón
+
+import sqlite3
+
+DIGEST_CACHE_FILE = './digest_cache.sqlite'
+# Contents per query (older versions of SQLite allow up to 999 parameters)
+BATCH_SIZE = 500
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS digests (content TEXT NOT NULL, algorithm TEXT NOT NULL, "
+    "derelocation TEXT NOT NULL, name TEXT NOT NULL, digest TEXT NOT NULL, "
+    "PRIMARY KEY (content, algorithm, derelocation))",
+]
+
+
+class DigestCache(object):
+    """Digests stored by (content, algorithm, derelocation)
+
+    content is the xxHash64 of the content (see page_pack.content_digest),
+    algorithm the name requested to the SUM tool (e.g. tlsh) and name the one
+    in its output (e.g. TLSH). Several processes can share the file.
+    """
+
+    def __init__(self, path=DIGEST_CACHE_FILE):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path, timeout=60)
+        # Readers don't block the writer (several workers share the file)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM digests").fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+    def get_many(self, contents, algorithms, derelocation):
+        """Obtains the stored digests of several contents
+
+        Args:
+            contents (iterable): xxHash64 of the contents
+            algorithms (list): Algorithms requested to the SUM tool
+            derelocation (string): Derelocation value of the SUM tool
+
+        Returns:
+            dict: content -> {algorithm: (name, digest)}, only with the stored ones
+        """
+        found = {}
+        contents = sorted(set(contents))
+        marks = ",".join(["?"]*len(algorithms))
+        for i in range(0, len(contents), BATCH_SIZE):
+            batch = contents[i:i+BATCH_SIZE]
+            query = "SELECT content, algorithm, name, digest FROM digests WHERE derelocation = ? " \
+                    "AND algorithm IN ({}) AND content IN ({})".format(marks, ",".join(["?"]*len(batch)))
+            for content, algorithm, name, digest in self.db.execute(query, [derelocation] + list(algorithms) + batch):
+                found.setdefault(content, {})[algorithm] = (name, digest)
+        hits = sum(len(digests) for digests in found.values())
+        self.hits += hits
+        self.misses += len(contents) * len(algorithms) - hits
+        return found
+
+    def put_many(self, rows):
+        """Stores digests
+
+        Args:
+            rows (list): Tuples (content, algorithm, derelocation, name, digest)
+        """
+        if rows:
+            self.db.executemany("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)", rows)
+            self.db.commit()
+
+    def contents(self, algorithms, derelocation):
+        """Returns the set of contents with all the algorithms stored"""
+        query = "SELECT content FROM digests WHERE derelocation = ? AND algorithm IN ({}) " \
+                "GROUP BY content HAVING COUNT(*) = ?".format(",".join(["?"]*len(algorithms)))
+        return set(row[0] for row in self.db.execute(query, [derelocation] + list(algorithms) + [len(algorithms)]))
+
+    def clear(self):
+        """Removes all the digests"""
+        self.db.execute("DELETE FROM digests")
+        self.db.commit()
+
+    def stats(self):
+        """Returns the number of digests stored per algorithm and derelocation
+        and the hits and misses of this session"""
+        rows = self.db.execute("SELECT algorithm, derelocation, COUNT(*) FROM digests GROUP BY algorithm, derelocation").fetchall()
+        return {
+            'digests': dict(((algorithm, der), count) for algorithm, der, count in rows),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+def warm_up(index, pool, algorithms, derelocation='raw', cache=None, chunk_size=256, progress=None):
+    """Hashes in the pool of workers the contents of the pages of an index
+    that aren't in the digest cache (the workers store their digests)
+
+    Args:
+        index (PageIndex): Index of the pages
+        pool (HashWorkerPool): Workers (with the digest cache enabled)
+        algorithms (list): Algorithms requested to the SUM tool
+        [opt.] derelocation (string): Derelocation value of the SUM tool
+        [opt.] cache (DigestCache): Cache to skip the contents already stored
+        [opt.] chunk_size (int): Requests sent to the pool at a time
+        [opt.] progress (function): Called with the number of contents hashed
+            after each chunk
+
+    Returns:
+        int: Number of different contents hashed
+        list: Tuples (page ID, error) of the contents that couldn't be hashed
+    """
+    groups = index.group_by_digest(sorted(index.page_ids()))
+    stored = cache.contents(algorithms, derelocation) if cache is not None else set()
+    pending = [pages[0] for digest, pages in groups.items() if digest not in stored]
+    errors = []
+    for i in range(0, len(pending), chunk_size):
+        chunk = pending[i:i+chunk_size]
+        responses = pool.map({'op': 'hash', 'page_id': page_id, 'derelocation': derelocation, 'algorithms': algorithms} for page_id in chunk)
+        errors.extend((page_id, r['error']) for page_id, r in zip(chunk, responses) if not r['ok'])
+        if progress is not None:
+            progress(len(chunk))
+    return len(pending) - len(errors), errors
+
+
+if __name__ == '__main__':
+    import argparse
+    import multiprocessing
+    parser = argparse.ArgumentParser(description="Shows, clears or warms up the digest cache of the pages")
+    parser.add_argument("cache", nargs="?", default=DIGEST_CACHE_FILE, help="Cache file. Default is {}".format(DIGEST_CACHE_FILE))
+    parser.add_argument("-clear", "--clear", help="Remove all the digests of the cache", default=False, action="store_true")
+    parser.add_argument("-warmup", "--warmup", help="Hash the pages of the current directory that aren't in the cache", default=False, action="store_true")
+    parser.add_argument("-der", "--derelocation", help="Derelocation value for the SUM tool. Default value is raw", default="raw", choices=["raw", "best"])
+    parser.add_argument("-a", "--algorithms", help="Algorithms hashed in the warm-up. Default are the ones of hashes.py", nargs="+", default=['xxx', 'ssdeep', 'tlsh', 'sdhash'])
+    parser.add_argument("-sumdir", "--sumdir", help="Folder where sum.py script is located", metavar="sumdir", default="../similarity-unrelocated-module")
+    parser.add_argument("-w", "--workers", help="Hashing workers. Default is the number of CPUs", type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+    cache = DigestCache(args.cache)
+    if args.clear:
+        cache.clear()
+    if args.warmup:
+        import tqdm
+        from page_index import open_index
+        from hash_worker import HashWorkerPool
+        index = open_index('.')
+        with HashWorkerPool(max(1, args.workers), args.sumdir, digest_cache=args.cache) as pool, \
+                tqdm.tqdm(desc='Hashing contents', unit='content') as progress:
+            hashed, errors = warm_up(index, pool, args.algorithms, args.derelocation, cache, progress=progress.update)
+        print("[+] Contents hashed: {}".format(hashed))
+        for page_id, error in errors:
+            print("[-] Page {} couldn't be hashed: {}".format(page_id, error))
+    stats = cache.stats()
+    print("[+] Digests in the cache: {}".format(len(cache)))
+    for (algorithm, der), count in sorted(stats['digests'].items()):
+        print(" - {} ({}): {}".format(algorithm, der, count))
+    cache.close()
@@ -8,7 +8,11 @@
 import pandas as pd
 import matplotlib.pyplot as plt
 import subprocess
-from cmp_pages import mainRetDesc
+import multiprocessing
+from cmp_pages import COMPARISON_COLUMNS, STATUS_ERROR, STATUS_MISSING, compare_pairs, format_desc
+from collisions_log import COLLISIONS_FILE, load_collisions
+from dataset_store import save_dataset
+from hash_worker import HashWorkerPool, comparison_lines
 
 plt.rcParams.update({
     "text.usetex": True,
@@ -26,83 +30,76 @@ plt.rcParams.update({
 
 # Directory where the byte distribution graphs and hashes will be saved
 DIR = '../auto/'
+# Hashing workers (python2 hash_worker.py processes)
+HASH_WORKERS = multiprocessing.cpu_count()
 
-file_path = './output_collisions_raw_dataset_filtered_2.out'
-# line format of the file:
-# CRITICAL:datalayer.database.page: [-] TLSH COLLISION [#pages 228438:228442]
-
-df = pd.DataFrame(columns=['hash_function', 'page1', 'page2'])
-
-with open(file_path, 'r') as file:
-    for line in file:
-        if "COLLISION" in line:
-            # select the part of the line after '[-] '
-            l = line.split('[-] ')[1]
-            hash_function = l.split()[0]
-            # select the part of the line after '#pages '
-            l2 = l.split('#pages ')[1]
-            l2 = l2[:-2] # remove ']'
-            page1 = l2.split(':')[0]
-            page2 = l2.split(':')[1]
-            # print(hash_function, page1, page2)
-            df = df._append({'hash_function': hash_function, 'page1': page1, 'page2': page2}, ignore_index=True)
-
-    file.close()
-
-# Group by page1 and page2 and concatenate the values of hash_function with the delimiter "+"
-df = df.groupby(['page1', 'page2']).agg({'hash_function': '+'.join}).reset_index()
+# Read the collisions of the APOTHEOSIS output file grouped by page1 and page2
+# (the values of hash_function are concatenated with the delimiter "+")
+df = load_collisions(COLLISIONS_FILE)
 
 ## PAGE ANALYSIS ##
-# Add a new column to the dataframe with the description of the collision
-df['desc'] = ''
-# Recorrer las filas del dataframe
-for index, row in df.iterrows():
-    # Obtener los números de página
-    page1 = row['page1']
-    page2 = row['page2']
-    df.at[index, 'desc'] = mainRetDesc(page1, page2)
+# Add new columns to the dataframe with the result of the comparison of the
+# pages (status, shift, direction, diff_bytes, equal_ratio and warning) and
+# the description of the collision (the pairs of pages with the same contents
+# are compared only once, in parallel, and the pairs compared in previous runs
+# are taken from the comparison cache)
+table = compare_pairs(zip(df['page1'], df['page2']))
+for col in COMPARISON_COLUMNS:
+    df[col] = table[col].values
+df['desc'] = [format_desc(row) for row in table.to_dict('records')]
 
 ## COLLISION FILTERING ##
-# Remove the rows that have the field 'desc' a text that contains 'Error'
+# Remove the rows whose pages couldn't be compared
 # There are errors for 4 collisions of empty pages, so we remove them
-df = df[~df['desc'].str.contains('Error')]
-# Remove the rows that have the field 'desc' a text that contains '\Delta = 0'
+df = df[~df['status'].isin([STATUS_ERROR, STATUS_MISSING])]
+# Remove the rows with a displacement of 0 bytes
 # The entries are equal so it does not make sense to analyze the collision
-df = df[~df['desc'].str.contains('\Delta = 0')]
+df = df[~(df['shift'] == 0).fillna(False)]
 
 # Let only the first row of a same page1
 df = df.drop_duplicates(subset='page1', keep='first')
 
-# Save the dataframe to an excel file
-df.to_excel('coll_analisis_filter.xlsx', index=False)
+# Save the dataframe
+save_dataset(df, 'coll_analisis_filter.parquet')
 
 ## HASHES CALCULATION ##
-i = 0
+# The hashes of all the collisions are calculated by a pool of hashing workers
+# (the SUM tool is loaded once per worker instead of once per collision)
+cases, requests = [], []
 for index, row in df.iterrows():
-    # 'desc' format: "desplazamiento de %x%B (%y%)"
-    if 'desplazamiento de' in row['desc']:
+    # Only the collisions explained by a displacement
+    if not pd.isna(row['shift']):
         # Obtain the number of displacement bytes
-        slide = row['desc'].split()[2][:-1]
+        slide = str(int(row['shift']))
         # Obtain if the slide is in the first or second slide
-        slide_page = row['desc'].split()[3][1:-1]
-        slide_page = int(slide_page)
-        slide_page = "--slide1" if slide_page == 1 else "--slide2"
+        slide_page = "--slide1" if row['direction'] == 1 else "--slide2"
         # Obtaining the page numbers
-        page1 = row['page1']
-        page2 = row['page2']
+        page1 = str(row['page1'])
+        page2 = str(row['page2'])
         # Obtaining the byte distribution graphs
         subprocess.run(["python", "dist_bytes.py", page1, page2], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         subprocess.run(["python", "dist_bytes.py", page1, page2, slide_page, slide], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         print('Byte distribution graphs created for pages {} and {}'.format(page1, page2))
-        # Calculate the hashes
-        with open(DIR+page1+'_'+page2+'/hashes_results.txt', 'w') as output_file: # write mode
-            output_file.write('Tipo de colisión original detectada: {}\n'.format(row['hash_function']))
-            output_file.write('Caso de estudio: {}\n'.format(row['desc']))
-        output_file.close()
-        with open(DIR+page1+'_'+page2+'/hashes_results.txt', 'a') as output_file: # append mode
-            subprocess.run(["python2", "hashes.py", page1, "-page2", page2, slide_page, slide, "-prefixAA"], stdout=output_file, stderr=subprocess.DEVNULL)
-        output_file.close()
+        cases.append((page1, page2, row['hash_function'], format_desc(row, latex=False)))
+        requests.append({'op': 'compare', 'page1': int(page1), 'page2': int(page2),
+                         slide_page.lstrip('-'): int(slide), 'prefix': 'AA'})
+
+responses = []
+if requests:
+    with HashWorkerPool(min(HASH_WORKERS, len(requests))) as pool:
+        responses = pool.map(requests)
+for i, ((page1, page2, hash_function, desc), response) in enumerate(zip(cases, responses)):
+    with open(DIR+page1+'_'+page2+'/hashes_results.txt', 'w') as output_file:
+        output_file.write('Tipo de colisión original detectada: {}\n'.format(hash_function))
+        output_file.write('Caso de estudio: {}\n'.format(desc))
+        if response['ok']:
+            for line in comparison_lines(response['comparison']):
+                output_file.write(line + '\n')
+        else:
+            # A pair that can't be hashed doesn't stop the rest
+            output_file.write('Error: {}\n'.format(response['error']))
+    if response['ok']:
         print('Hashes calculated for pages {} and {}'.format(page1, page2))
-        i += 1
-        print('Collisions analyzed: {}'.format(i))
-    
\ No newline at end of file
+    else:
+        print('Error calculating the hashes of pages {} and {}: {}'.format(page1, page2, response['error']))
+    print('Collisions analyzed: {}'.format(i + 1))
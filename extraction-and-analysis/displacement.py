@@ -0,0 +1,416 @@
+# Description: Vectorized search (NumPy) of the smallest exact displacement of
+#              the content of one page in another, in both directions. It gets
+#              the same result as the byte loop of cmp_pages.searchDisplacement
+#              over all the displacements. It also calculates the profile of
+#              different bytes of every displacement, to search displacements
+#              with a threshold of different bytes or the best alignment, and
+#              the candidate displacements backed by anchors (k-byte substrings
+#              found with a rolling hash) shared by both contents.
+# Phase: Analysis
+# Author: Luis Palazón Simón
+
+import numpy as np
+
+PAGE_SIZE = 4096
+# Positions compared for all the candidate displacements at once (in blocks)
+# before the surviving candidates are compared entirely
+PREFIX_SIZE = 64
+BLOCK_SIZE = 8
+# A byte value whose occurrences in both contents give more pairs of positions
+# than this is correlated with FFT instead of counting its pairs
+PAIRS_LIMIT = 32768
+# Bytes of the anchors and base of their rolling hash (mod 2^64, odd so it
+# has an inverse)
+ANCHOR_SIZE = 8
+HASH_BASE = 0x100000001b3
+# Minimum fraction of the windows of each content that must be unique anchors,
+# contents with less information are searched with findDisplacement
+MIN_ANCHORS = 0.5
+
+
+def as_array(content):
+    '''
+    parameters:
+        content: bytes, memoryview or numpy.ndarray
+    return:
+        numpy.ndarray of uint8 over content (without copying it)
+    '''
+    if isinstance(content, np.ndarray):
+        return content
+    return np.frombuffer(content, dtype=np.uint8)
+
+
+def candidateShifts(a, b, prefix=PREFIX_SIZE, block=BLOCK_SIZE):
+    '''
+    Obtains the displacements d for which a[i] == b[i+d] in the first prefix
+    positions (only the positions i < len-d count). The first position is
+    compared for all the displacements at once and the rest, in blocks, only
+    for the displacements that are left. The blocks stop when they don't
+    discard at least half of the candidates (e.g. constant contents), it's
+    cheaper to compare those candidates entirely.
+    parameters:
+        a: numpy.ndarray, displaced content
+        b: numpy.ndarray, content where a is searched
+        prefix: int, positions compared
+        block: int, positions compared in the first block (it doubles in each block)
+    return:
+        numpy.ndarray of int, candidate displacements in increasing order
+    '''
+    n = len(a)
+    cand = np.flatnonzero(b == a[0])
+    start = 1
+    while len(cand) and start < min(prefix, n):
+        pos = np.arange(start, min(start + block, prefix, n))[None, :]
+        shifted = cand[:, None] + pos
+        # Positions beyond the end of a displacement don't count
+        outside = shifted >= n
+        equal = b[np.minimum(shifted, n - 1)] == a[pos]
+        left = cand[(equal | outside).all(axis=1)]
+        if 2*len(left) > len(cand):
+            return left
+        cand = left
+        start += block
+        block *= 2
+    return cand
+
+
+def matchesShift(a, b, d, over1):
+    '''
+    return:
+        bool, true if a is exactly b with a displacement of d over a (over1) or over b
+    '''
+    n = len(a)
+    return np.array_equal(a[:n-d], b[d:]) if over1 else np.array_equal(a[d:], b[:n-d])
+
+
+def findDisplacement(content1, content2, prefix=PREFIX_SIZE, limit=None):
+    '''
+    Searches the smallest displacement with which one content is exactly the
+    other one. For the same displacement, the displacement over content1 goes
+    first (as in the loop of cmp_pages). A displacement d over content1
+    compares content1[i] with content2[i+d] for every position i < len-d (over
+    content2, content1[i+d] with content2[i]).
+    parameters:
+        content1: bytes, memoryview or numpy.ndarray
+        content2: bytes, memoryview or numpy.ndarray, same length as content1
+        prefix: int, positions compared for all the candidates before comparing
+                each candidate entirely
+        limit: tuple (int, bool), displacement (and direction) where the search
+               stops without checking it, None to search all of them
+    return:
+        tuple (int, bool), displacement and true if it's over content1, or
+        None if there isn't any displacement
+    '''
+    a, b = as_array(content1), as_array(content2)
+    if len(a) != len(b):
+        raise ValueError('Error: los contenidos tienen distinta longitud ({} y {})'.format(len(a), len(b)))
+    over1 = candidateShifts(a, b, prefix)
+    over2 = candidateShifts(b, a, prefix)
+    # The candidates are compared in order: d over 1, d over 2, d+1 over 1...
+    order = np.concatenate((2*over1, 2*over2 + 1))
+    order.sort()
+    if limit is not None:
+        order = order[order < 2*limit[0] + (0 if limit[1] else 1)]
+    for k in order:
+        d, first = int(k) >> 1, (k & 1) == 0
+        if matchesShift(a, b, d, first):
+            return d, bool(first)
+    return None
+
+
+def countMatches(a, b):
+    '''
+    Counts, for every lag k = j-i in (-len, len), the positions with a[i] == b[j].
+    For each byte value, the lags of all its pairs of positions are counted
+    (exact) or, if the value is very frequent, its indicator vectors are
+    correlated with FFT.
+    parameters:
+        a: numpy.ndarray, first content
+        b: numpy.ndarray, second content, same length as a
+    return:
+        numpy.ndarray of int, matches of lag k in position k+len-1
+    '''
+    n = len(a)
+    size = 2*n - 1
+    sa, sb = np.argsort(a, kind='stable'), np.argsort(b, kind='stable')
+    ca, cb = np.bincount(a, minlength=256), np.bincount(b, minlength=256)
+    ea, eb = np.cumsum(ca), np.cumsum(cb)
+    lags, heavy = [], []
+    for v in np.flatnonzero((ca > 0) & (cb > 0)):
+        if ca[v]*cb[v] > PAIRS_LIMIT:
+            heavy.append(v)
+            continue
+        pa, pb = sa[ea[v]-ca[v]:ea[v]], sb[eb[v]-cb[v]:eb[v]]
+        lags.append((pb[None, :] - pa[:, None]).ravel())
+    matches = np.zeros(size, dtype=np.int64)
+    if lags:
+        matches += np.bincount(np.concatenate(lags) + n - 1, minlength=size)
+    if heavy:
+        values = np.array(heavy, dtype=np.uint8)[:, None]
+        fa = np.fft.rfft((a[None, :] == values).astype(np.float64), 2*n, axis=1)
+        fb = np.fft.rfft((b[None, :] == values).astype(np.float64), 2*n, axis=1)
+        corr = np.rint(np.fft.irfft((fa.conj()*fb).sum(axis=0), 2*n)).astype(np.int64)
+        # Circular correlation: lag k >= 0 in corr[k], lag -k in corr[2n-k]
+        matches[n-1:] += corr[:n]
+        matches[:n-1] += corr[n+1:]
+    return matches
+
+
+class MismatchProfile(object):
+    '''
+    Number of different bytes of a pair of contents for every displacement in
+    both directions (calculated once). For a displacement d only the len-d
+    positions that overlap are compared, as in searchDisplacementThreshold.
+    attributes:
+        over1: numpy.ndarray of int, different bytes of each displacement over content1
+        over2: numpy.ndarray of int, different bytes of each displacement over content2
+        overlap: numpy.ndarray of int, compared bytes of each displacement
+    '''
+
+    def __init__(self, content1, content2):
+        a, b = as_array(content1), as_array(content2)
+        if len(a) != len(b):
+            raise ValueError('Error: los contenidos tienen distinta longitud ({} y {})'.format(len(a), len(b)))
+        n = len(a)
+        matches = countMatches(a, b)
+        self.overlap = n - np.arange(n)
+        # Over content1 a[i] is compared with b[i+d] (lag d), over content2 with b[i-d]
+        self.over1 = self.overlap - matches[n-1:]
+        self.over2 = self.overlap - matches[n-1::-1]
+
+    def __len__(self):
+        return len(self.overlap)
+
+    def firstShift(self, threshold=0):
+        '''
+        Searches the smallest displacement with at most threshold different
+        bytes (for the same displacement, over content1 goes first).
+        parameters:
+            threshold: int, maximum number of different bytes
+        return:
+            tuple (int, bool, int), displacement, true if it's over content1 and
+            different bytes, or None if there isn't any displacement
+        '''
+        ok1 = np.flatnonzero(self.over1 <= threshold)
+        ok2 = np.flatnonzero(self.over2 <= threshold)
+        d1 = ok1[0] if len(ok1) else len(self)
+        d2 = ok2[0] if len(ok2) else len(self)
+        if d1 == len(self) and d2 == len(self):
+            return None
+        if d1 <= d2:
+            return int(d1), True, int(self.over1[d1])
+        return int(d2), False, int(self.over2[d2])
+
+    def bestShift(self, min_overlap=PAGE_SIZE//2):
+        '''
+        Searches the displacement with the fewest different bytes among the
+        ones that compare at least min_overlap bytes (the smallest one if
+        there's a tie, over content1 first).
+        parameters:
+            min_overlap: int, minimum number of compared bytes
+        return:
+            tuple (int, bool, int), displacement, true if it's over content1 and
+            different bytes
+        '''
+        last = max(1, min(len(self), len(self) - min_overlap + 1))
+        d1 = int(np.argmin(self.over1[:last]))
+        d2 = int(np.argmin(self.over2[:last]))
+        if (self.over1[d1], d1, 0) <= (self.over2[d2], d2, 1):
+            return d1, True, int(self.over1[d1])
+        return d2, False, int(self.over2[d2])
+
+
+def rollingHashes(a, k=ANCHOR_SIZE):
+    '''
+    Calculates the polynomial rolling hash (mod 2^64) of every k-byte window.
+    With the prefix sums P[i] of a[j]*B^j, the hash of the window that starts
+    in i is (P[i+k] - P[i]) * B^-i, all the windows at once.
+    parameters:
+        a: numpy.ndarray, content
+        k: int, bytes of the windows
+    return:
+        numpy.ndarray of uint64, hash of the window that starts in each position
+    '''
+    n = len(a)
+    if n < k:
+        return np.zeros(0, dtype=np.uint64)
+    powers = np.ones(n, dtype=np.uint64)
+    powers[1:] = np.cumprod(np.full(n - 1, HASH_BASE, dtype=np.uint64))
+    inverses = np.ones(n - k + 1, dtype=np.uint64)
+    inverses[1:] = np.cumprod(np.full(n - k, pow(HASH_BASE, -1, 2**64), dtype=np.uint64))
+    prefix = np.zeros(n + 1, dtype=np.uint64)
+    prefix[1:] = np.cumsum(a.astype(np.uint64)*powers)
+    return (prefix[k:] - prefix[:-k])*inverses
+
+
+def uniqueAnchors(a, k=ANCHOR_SIZE):
+    '''
+    return:
+        numpy.ndarray of uint64, hashes of the windows that appear once in a (sorted)
+        numpy.ndarray of int, position of each of those windows
+    '''
+    hashes = rollingHashes(a, k)
+    order = np.argsort(hashes)
+    hashes = hashes[order]
+    # A window appears once if it's different from the previous and the next one
+    differ = hashes[1:] != hashes[:-1]
+    once = np.ones(len(hashes), dtype=bool)
+    once[1:] &= differ
+    once[:-1] &= differ
+    return hashes[once], order[once]
+
+
+def anchorCandidates(content1, content2, k=ANCHOR_SIZE, min_anchors=0.0):
+    '''
+    Obtains the candidate displacements from the anchors of both contents: each
+    window that appears once in content1 and once in content2 supports the
+    displacement between its positions. The repeated windows (e.g. runs of
+    zeros) don't support any displacement.
+    parameters:
+        content1: bytes, memoryview or numpy.ndarray
+        content2: bytes, memoryview or numpy.ndarray, same length as content1
+        k: int, bytes of the anchors
+        min_anchors: float, minimum fraction of the windows of each content that
+                     must be unique anchors
+    return:
+        list of tuples (int, bool, int, float), displacement, true if it's
+        over content1, anchors that support it and coverage (fraction of the
+        windows of the overlap that support it), in the order of the loop of
+        cmp_pages (d over 1, d over 2, d+1 over 1...), or None if the
+        contents don't have enough anchors
+    '''
+    a, b = as_array(content1), as_array(content2)
+    n = len(a)
+    ha, pa = uniqueAnchors(a, k)
+    hb, pb = uniqueAnchors(b, k)
+    if min(len(ha), len(hb)) < min_anchors*(n - k + 1) or n < k:
+        return None
+    ib = np.minimum(np.searchsorted(hb, ha), max(len(hb) - 1, 0))
+    shared = hb[ib] == ha if len(hb) else np.zeros(len(ha), dtype=bool)
+    # a[i] is compared with b[i+d]: positive lags are over content1
+    votes = np.bincount(pb[ib[shared]] - pa[shared] + n - 1, minlength=2*n - 1)
+    lags = np.flatnonzero(votes) - (n - 1)
+    keys = np.sort(np.where(lags >= 0, 2*lags, -2*lags + 1))
+    candidates = []
+    for key in keys:
+        d, over1 = int(key) >> 1, (key & 1) == 0
+        anchors = int(votes[n - 1 + (d if over1 else -d)])
+        candidates.append((d, bool(over1), anchors, float(anchors) / (n - d - k + 1)))
+    return candidates
+
+
+def findAnchoredDisplacement(content1, content2, k=ANCHOR_SIZE):
+    '''
+    Searches the smallest exact displacement verifying first the candidates
+    backed by anchors. The first one that works bounds the search of
+    findDisplacement over the smaller displacements, which may not be backed
+    by anchors (e.g. their overlap only has repeated windows, such as runs of
+    zeros, or is shorter than k bytes). If no candidate works, or the
+    contents don't have enough unique anchors (e.g. constant, periodic or
+    mostly empty contents), all the displacements are searched with
+    findDisplacement.
+    parameters:
+        content1: bytes, memoryview or numpy.ndarray
+        content2: bytes, memoryview or numpy.ndarray, same length as content1
+        k: int, bytes of the anchors
+    return:
+        tuple (int, bool, float), displacement, true if it's over content1 and
+        coverage of its anchors (None if it hasn't been found with anchors), or
+        None if there isn't any displacement
+    '''
+    a, b = as_array(content1), as_array(content2)
+    if len(a) != len(b):
+        raise ValueError('Error: los contenidos tienen distinta longitud ({} y {})'.format(len(a), len(b)))
+    candidates = anchorCandidates(a, b, k, MIN_ANCHORS)
+    for d, over1, anchors, coverage in candidates or []:
+        if matchesShift(a, b, d, over1):
+            # A smaller displacement without anchors goes first
+            smaller = findDisplacement(a, b, limit=(d, over1))
+            return (d, over1, coverage) if smaller is None else smaller + (None,)
+    displacement = findDisplacement(a, b)
+    return None if displacement is None else displacement + (None,)
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    from cmp_pages import searchDisplacement, searchDisplacementThreshold, THRESHOLD
+    parser = argparse.ArgumentParser(description='Compara la búsqueda vectorizada de desplazamientos con el bucle de cmp_pages')
+    parser.add_argument('-n', '--pairs', type=int, default=20, help='Número de parejas aleatorias a probar')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Semilla de los contenidos aleatorios')
+    args = parser.parse_args()
+
+    def loopDisplacement(content1, content2):
+        for i in range(PAGE_SIZE):
+            if searchDisplacement(content1, content2, i, True):
+                return i, True
+            elif searchDisplacement(content1, content2, i, False):
+                return i, False
+        return None
+
+    def loopThreshold(content1, content2):
+        for i in range(PAGE_SIZE):
+            for over1 in (True, False):
+                res, diffbytes = searchDisplacementThreshold(content1, content2, i, over1, THRESHOLD)
+                if res:
+                    return i, over1, diffbytes
+        return None
+
+    def anchoredDisplacement(content1, content2):
+        res = findAnchoredDisplacement(content1, content2)
+        return None if res is None else res[:2]
+
+    def benchmark(name, loopFunc, vectFunc, pairs):
+        t = time.time()
+        loop = [loopFunc(c1, c2) for c1, c2 in pairs]
+        tloop = time.time() - t
+        t = time.time()
+        vect = [vectFunc(c1, c2) for c1, c2 in pairs]
+        tvect = time.time() - t
+        mismatches = [i for i in range(len(pairs)) if loop[i] != vect[i]]
+        print('{} ({} parejas):'.format(name, len(pairs)))
+        print(' - Bucle: {:.3f}s ({:.2f}ms por pareja)'.format(tloop, 1000*tloop/len(pairs)))
+        print(' - Vectorizado: {:.3f}s ({:.2f}ms por pareja)'.format(tvect, 1000*tvect/len(pairs)))
+        print(' - Aceleración: {:.1f}x'.format(tloop/tvect if tvect else float('inf')))
+        print(' - Resultados distintos: {}'.format(mismatches if mismatches else 'ninguno'))
+
+    # Pairs shifted over each content, equal, unrelated, constant, periodic and
+    # padded with zeros
+    rng = np.random.RandomState(args.seed)
+    pairs = []
+    for k in range(args.pairs):
+        page = rng.randint(0, 256, 2*PAGE_SIZE, dtype=np.uint8)
+        d = rng.randint(0, PAGE_SIZE)
+        kind = k % 7
+        if kind == 0:
+            pairs.append((page[:PAGE_SIZE], page[d:d+PAGE_SIZE]))
+        elif kind == 1:
+            pairs.append((page[d:d+PAGE_SIZE], page[:PAGE_SIZE]))
+        elif kind == 2:
+            pairs.append((page[:PAGE_SIZE], page[:PAGE_SIZE].copy()))
+        elif kind == 3:
+            pairs.append((page[:PAGE_SIZE], page[PAGE_SIZE:]))
+        elif kind == 4:
+            pairs.append((np.zeros(PAGE_SIZE, np.uint8), np.zeros(PAGE_SIZE, np.uint8)))
+        elif kind == 5:
+            pattern = np.tile(page[:16], PAGE_SIZE // 16)
+            other = pattern.copy()
+            other[-1] ^= 0xFF
+            pairs.append((pattern, other))
+        else:
+            # The overlap of the exact displacement only has repeated windows
+            zeros = np.zeros(100, np.uint8)
+            pairs.append((np.concatenate((zeros, page[:PAGE_SIZE-100])), np.concatenate((page[PAGE_SIZE:-100], zeros))))
+    # The same pairs with some different bytes for the search with a threshold
+    noisy = []
+    for c1, c2 in pairs:
+        c2 = c2.copy()
+        c2[rng.randint(0, PAGE_SIZE, rng.randint(1, 2*THRESHOLD))] ^= 0x01
+        noisy.append((c1, c2))
+    pairs = [(bytes(c1.tobytes()), bytes(c2.tobytes())) for c1, c2 in pairs]
+    noisy = [(bytes(c1.tobytes()), bytes(c2.tobytes())) for c1, c2 in noisy]
+
+    benchmark('Desplazamiento exacto', loopDisplacement, findDisplacement, pairs)
+    benchmark('Desplazamiento exacto con anclas', loopDisplacement, anchoredDisplacement, pairs)
+    benchmark('Desplazamiento con umbral de {} bytes'.format(THRESHOLD), loopThreshold,
+              lambda c1, c2: MismatchProfile(c1, c2).firstShift(THRESHOLD), noisy)
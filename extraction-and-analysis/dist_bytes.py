@@ -4,7 +4,7 @@
 # Author: Luis Palazón Simón
 
 import argparse
-import subprocess
+from page_index import open_index
 import matplotlib.pyplot as plt
 import os
 
@@ -136,27 +136,22 @@ if __name__ == '__main__':
     parser.add_argument('--slide1', type=int, default=0, help='Desplazamiento del primer archivo')
     parser.add_argument('--slide2', type=int, default=0, help='Desplazamiento del segundo archivo')
     args = parser.parse_args()
-    # Obtener los nombres de los archivos (buscar en el directorio actual el fichero que comienza por numPage1_ y numPage2_ mediante el comando find)
-    res = subprocess.run(['find', '.', '-maxdepth', '1', '-type', 'f', '-name', '{}_*'.format(args.numPage1)], stdout=subprocess.PIPE)
-    if res.returncode != 0:
+    # Obtener los nombres de los archivos del índice de las páginas del directorio actual
+    index = open_index('.')
+    if args.numPage1 not in index:
         print('No se ha encontrado el fichero del primer número de página')
         exit(1)
-    file1 = res.stdout.decode().split('\n')[0]
-    res = subprocess.run(['find', '.', '-maxdepth', '1', '-type', 'f', '-name', '{}_*'.format(args.numPage2)], stdout=subprocess.PIPE)
-    if res.returncode != 0:
+    if args.numPage2 not in index:
         print('No se ha encontrado el fichero del segundo número de página')
         exit(1)
-    file2 = res.stdout.decode().split('\n')[0]
+    file1 = index.name(args.numPage1)
+    file2 = index.name(args.numPage2)
     print('Ficheros a analizar:')
     print(' - {}'.format(file1))
     print(' - {}'.format(file2))
-    # Read files
-    with open(file1, 'rb') as f:
-        content1 = f.read()
-    f.close()
-    with open(file2, 'rb') as f:
-        content2 = f.read()
-    f.close()
+    # Read the pages (without copying them if they are in the page pack)
+    content1 = index.view(args.numPage1)
+    content2 = index.view(args.numPage2)
     assert len(content1) == PAGE_SIZE and len(content2) == PAGE_SIZE, 'Error: los ficheros no tienen el tamaño de página esperado'
     if args.slide1 == 0 and args.slide2 == 0:
         showBytesFrequency(content1, content2, args.numPage1, args.numPage2)
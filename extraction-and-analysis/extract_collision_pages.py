@@ -5,6 +5,13 @@
 import pandas as pd
 import matplotlib.pyplot as plt
 import subprocess
+import json
+from collisions_log import COLLISIONS_FILE, load_collisions
+
+# File with the page IDs to extract (one per line)
+PAGES_FILE = './pages_to_examine.txt'
+# Report of the extraction of each module
+REPORT_FILE = './extraction_report.json'
 
 plt.rcParams.update({
     "text.usetex": True,
@@ -20,33 +27,12 @@ plt.rcParams.update({
     "figure.figsize": (24, 12)
 })
 
-file_path = './output_collisions_raw_dataset_filtered_2.out'
-# line format of the file:
-# CRITICAL:datalayer.database.page: [-] TLSH COLLISION [#pages 228438:228442]
-
-df = pd.DataFrame(columns=['hash_function', 'page1', 'page2'])
-
-with open(file_path, 'r') as file:
-    for line in file:
-        if "COLLISION" in line:
-            # select the part of the line after '[-] '
-            l = line.split('[-] ')[1]
-            hash_function = l.split()[0]
-            # select the part of the line after '#pages '
-            l2 = l.split('#pages ')[1]
-            l2 = l2[:-2] # remove ']'
-            page1 = l2.split(':')[0]
-            page2 = l2.split(':')[1]
-            # print(hash_function, page1, page2)
-            df = df._append({'hash_function': hash_function, 'page1': page1, 'page2': page2}, ignore_index=True)
-
-    file.close()
-
-# Group by page1 and page2 and concatenate the values of hash_function with the delimiter "+"
-df = df.groupby(['page1', 'page2']).agg({'hash_function': '+'.join}).reset_index()
+# Read the collisions of the APOTHEOSIS output file grouped by page1 and page2
+# (the values of hash_function are concatenated with the delimiter "+")
+df = load_collisions(COLLISIONS_FILE)
 
-# Save the dataframe to an excel file
-# df.to_excel('coll_dataset.xlsx', index=False)
+# Save the dataframe
+# save_dataset(df, 'coll_dataset.parquet')
 
 ## EXTRACCIÓN DE PÁGINAS A EXAMINAR ##
 # Initialize the set of pages to examine
@@ -59,9 +45,17 @@ for page in df['page2']:
     pages_to_examine.add(page)
 print(len(pages_to_examine))
 
-# Extract the pages to examine
-total = 0
-for page in pages_to_examine:
-    subprocess.run(["python2", "extract.py", page], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    total += 1
-    print('Page {} extracted. Total: {}'.format(page, total))
\ No newline at end of file
+# Extract the pages to examine in a single execution of extract_page.py, which
+# opens the ZIP file of each module only once for all its pages and extracts
+# the modules in parallel (one process per CPU)
+with open(PAGES_FILE, 'w') as f:
+    for page in sorted(pages_to_examine):
+        f.write('{}\n'.format(page))
+subprocess.run(["python2", "extract_page.py", "-pages", PAGES_FILE, "-report", REPORT_FILE], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+with open(REPORT_FILE, 'r') as f:
+    report = json.load(f)
+# The pages extracted by previous runs (in the journal) aren't extracted again
+print('Pages extracted in this run: {} (pages to examine: {})'.format(sum(m['correct'] for m in report), len(pages_to_examine)))
+for m in report:
+    for zipf, error in m['err']:
+        print('[-] {}: {}'.format(m['module'], error))
\ No newline at end of file
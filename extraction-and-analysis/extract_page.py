@@ -1,4 +1,4 @@
-# Description: Script to extract a page from its module
+# Description: Script to extract a page (or a batch of pages) from its module
 # Phase: Extraction
 # Author: Luis Palazón Simón
 
@@ -11,12 +11,29 @@ from tempfile import mkdtemp,gettempdir
 import shutil
 import stat
 import re
+import json
+import threading
+import multiprocessing
 from datetime import datetime
-from mysql.connector import connect
 import configparser as cg
+from page_pack import PagePack, content_digest
+from page_metadata import MIRROR_FILE, SQLiteResolver, open_resolver
+from module_cache import ModuleCache, CACHE_SIZE
+from zip_index import ZIP_INDEX_FILE, open_zip_index
+from extraction_journal import JOURNAL_FILE, ExtractionJournal
 
 PAGE_SIZE = 4096
+MODULE_CONTENTS = "joinedModuleContents.dmp"
+# Memory used by SUM per byte of the module (the module read, its virtual
+# layout and the data of the hashes)
+SUM_MEMORY_FACTOR = 3
+# Memory budget of the modules being extracted at the same time (in MB)
+MEMORY_BUDGET = 4096
 wrong_zips = []
+# Page pack, module cache and journal of the process (each worker opens its own)
+worker_pack = None
+worker_cache = None
+worker_journal = None
 
 
 def read_config(cfg_file):
@@ -80,74 +97,194 @@ def read_bytes_from_page(file, num_page, page_size=PAGE_SIZE):
         return f.read(page_size)
     
 
-def search_zip_in_folder(zip, pathzips):
-    """Searches for ZIP files in a folder
+def write_page(page_id,num_page,dir,data,pack=None,journal=None):
+    """Writes an extracted page in the page pack or in its .dmp file
 
     Args:
-        zip (string): ZIP file to search
-        pathzips (list): List of ZIP files in the folder
+        page_id (int): Page ID
+        num_page (int): Number of the page in the module
+        dir (string): Name of the module
+        data (bytes): Content of the page
+        [opt.] pack (PagePack): Page pack where the page is written
+        [opt.] journal (ExtractionJournal): Journal where the page is recorded
+    """
+    if pack is not None:
+        digest = pack.append(page_id, data)
+        location = pack.path
+    else:
+        location = str(page_id)+"_extracted_"+ str(num_page) + "_" + dir + ".dmp"
+        with open(location, "wb") as file:
+            file.write(data)
+            file.close()
+        digest = content_digest(data) if journal is not None else None
+    if journal is not None:
+        journal.record_done(page_id, location, digest, pack is not None)
 
-    Returns:
-        string: ZIP file if it's found, None otherwise
+
+def page_out_of_module(zipf,page_id,num_page,journal=None):
+    """Returns the error of a page beyond the end of its module (and records it)"""
+    error = "page {} out of the module".format(num_page)
+    if journal is not None:
+        journal.record_failed(page_id, error)
+    return (os.path.basename(zipf),error)
+
+
+def read_raw_pages(member, pages):
+    """Reads pages from the (decompressed) stream of a ZIP member without
+    reading the rest of it. The pages are read in order of offset, so the
+    stream is only decompressed up to the last requested page.
+
+    Args:
+        member (zipfile.ZipExtFile): Opened member of the ZIP file
+        pages (list): List of tuples (page_id, num_page)
+
+    Yields:
+        tuple: page_id, num_page and bytes of the page
     """
-    for pathzip in pathzips:
-        if zip in pathzip:
-            return pathzip
-    return None
+    position = 0
+    last_page, data = None, b""
+    for page_id, num_page in sorted(pages, key=lambda p: p[1]):
+        if num_page != last_page:
+            offset = num_page*PAGE_SIZE
+            # Skip up to the page (ZipExtFile only supports seek in Python >= 3.7)
+            while position < offset:
+                skipped = len(member.read(min(offset - position, 1024*PAGE_SIZE)))
+                if skipped == 0:
+                    break
+                position += skipped
+            data = member.read(PAGE_SIZE) if position == offset else b""
+            position += len(data)
+            last_page = num_page
+        yield page_id, num_page, data
+
+
+def sum_pages(data,pages,derelocation):
+    """Calculates the SUM object of a module and obtains its pages
 
+    Args:
+        data (bytes): Content of the module
+        pages (list): List of tuples (page_id, num_page)
+        derelocation (string): Derelocation value for the SUM tool
 
-def extract_zip(pathzips,tpfolder,dir,num_page,page_id):
-    """Extracts a page from a ZIP file
+    Yields:
+        tuple: page_id, num_page and bytes of the page
+    """
+    logger.debug("Creating SUM object")
+    sumF = sum.SUM(data,options=None, algorithms=['xxx','ssdeep','tlsh','sdhash'],virtual_layout=True,derelocation=derelocation)
+    logger.debug("Calculating hashes for the given SUM object")
+    out = sumF.calculate()
+    for page_id, num_page in pages:
+        yield page_id, num_page, sumF.data[num_page*PAGE_SIZE:num_page*PAGE_SIZE+PAGE_SIZE]
+
+
+def extract_cached_pages(cache,zipf,dir,pages,pack=None,derelocation="raw",journal=None):
+    """Extracts several pages of a module from its image in the module cache
 
     Args:
-        pathzips (list): List of path of ZIP files
+        cache (ModuleCache): Cache of decompressed module images
+        zipf (string): Path of the ZIP file of the module
+        dir (string): Name of the module
+        pages (list): List of tuples (page_id, num_page) to extract
+        [opt.] pack (PagePack): Page pack where the pages are written
+        [opt.] derelocation (string): Derelocation value for the SUM tool
+        [opt.] journal (ExtractionJournal): Journal where the pages are recorded
 
     Returns:
         list: Tuple containing ZIP which couldn't be processed and the error
-        integer: Correct times a ZIP has been processed
+        integer: Number of pages correctly extracted
+    """
+    err, correct = [], 0
+    logger.debug("Obtaining the image of {}".format(os.path.basename(zipf)))
+    print("Opening {} (cached)".format(os.path.basename(zipf)))
+    try:
+        image = cache.get(zipf, MODULE_CONTENTS)
+    except KeyError:
+        logger.error("Can't extract 'joinedModuleContents.dmp from {}".format(os.path.basename(zipf)))
+        return err, correct
+    try:
+        if derelocation == "raw":
+            print("Extracting {} raw page(s)".format(len(pages)))
+            extracted = ((page_id, num_page, image[num_page*PAGE_SIZE:num_page*PAGE_SIZE+PAGE_SIZE]) for page_id, num_page in pages)
+        else:
+            print("Extracting {} page(s) ({})".format(len(pages), derelocation))
+            extracted = sum_pages(image[:], pages, derelocation)
+        for page_id, num_page, bytes in extracted:
+            if len(bytes) == 0:
+                err.append(page_out_of_module(zipf,page_id,num_page,journal))
+                continue
+            write_page(page_id,num_page,dir,bytes,pack,journal)
+            correct += 1
+        logger.debug("{} correclty processed".format(os.path.basename(zipf)))
+    except Exception as e:
+        logger.exception(e)
+        err.append((os.path.basename(zipf),str(e)))
+    print("done!")
+    return err, correct
+
+
+def extract_module_pages(zipf,tpfolder,dir,pages,pack=None,derelocation="raw",journal=None):
+    """Extracts several pages of a module from its ZIP file
 
+    Args:
+        zipf (string): Path of the ZIP file of the module
+        tpfolder (string): Temporary folder where the module is extracted
+        dir (string): Name of the module
+        pages (list): List of tuples (page_id, num_page) to extract
+        [opt.] pack (PagePack): Page pack where the pages are written, by default
+            they are written in <page_id>_extracted_<num_page>_<dir>.dmp
+        [opt.] derelocation (string): Derelocation value for the SUM tool. With
+            "raw" the pages are read directly from the ZIP (SUM isn't needed)
+        [opt.] journal (ExtractionJournal): Journal where the pages are recorded
+
+    Returns:
+        list: Tuple containing ZIP which couldn't be processed and the error
+        integer: Number of pages correctly extracted
     """
-    err, correct, total = [], 0, len(pathzips)
-    print ("[+] Searching the corresponding ZIP file...")
-    zipf = search_zip_in_folder(dir, pathzips)
-    if zipf is None:
-        print ("[-] ZIP file not found in the folder")
-        return err, correct, total
-    
+    err, correct = [], 0
     #Open ZipFile
     logger.debug("Opening {}".format(os.path.basename(zipf)))
     print("Opening {}".format(os.path.basename(zipf)))
     with ZipFile(zipf,compression=ZIP_DEFLATED) as zipObj:
-        logger.debug("Extracting 'joinedModuleContents' from {}...".format(os.path.basename(zipf)))
         #Check if it's and appropiate zip
-        if "joinedModuleContents.dmp" in zipObj.namelist():
-            zfile = zipObj.extract("joinedModuleContents.dmp",path=tpfolder)
+        if MODULE_CONTENTS not in zipObj.namelist():
+            logger.error("Can't extract 'joinedModuleContents.dmp from {}".format(os.path.basename(zipf)))
+        elif derelocation == "raw":
+            # Fast path: the raw pages are read from the stream of the ZIP member,
+            # nothing is written to disk and no hash is calculated
+            print("Extracting {} raw page(s)".format(len(pages)))
+            try:
+                with zipObj.open(MODULE_CONTENTS) as member:
+                    for page_id, num_page, bytes in read_raw_pages(member, pages):
+                        if len(bytes) == 0:
+                            err.append(page_out_of_module(zipf,page_id,num_page,journal))
+                            continue
+                        write_page(page_id,num_page,dir,bytes,pack,journal)
+                        correct += 1
+                logger.debug("{} correclty processed".format(os.path.basename(zipf)))
+            except Exception as e:
+                logger.exception(e)
+                err.append((os.path.basename(zipf),str(e)))
+        else:
+            logger.debug("Extracting 'joinedModuleContents' from {}...".format(os.path.basename(zipf)))
+            zfile = zipObj.extract(MODULE_CONTENTS,path=tpfolder)
             logger.debug("'joinedModuleContents' correctly extracted")
 
             with open(zfile, mode="rb") as f:
                 try:
-                    logger.debug("Creating SUM object")
-                    sumF = sum.SUM(f.read(),options=None, algorithms=['xxx','ssdeep','tlsh','sdhash'],virtual_layout=True,derelocation="raw")
-                    logger.debug("Calculating hashes for the given SUM object")
-                    out = sumF.calculate()
-                    
-                    # Extract the page
-                    print("Extracting raw page")
-                    bytes = sumF.data[num_page*PAGE_SIZE:num_page*PAGE_SIZE+PAGE_SIZE]
+                    # Extract the pages
+                    print("Extracting {} page(s) ({})".format(len(pages), derelocation))
+                    for page_id, num_page, bytes in sum_pages(f.read(), pages, derelocation):
+                        write_page(page_id,num_page,dir,bytes,pack,journal)
+                        correct += 1
                     
-                    with open(str(page_id)+"_extracted_"+ str(num_page) + "_" + dir + ".dmp", "wb") as file:
-                        file.write(bytes)
-                        file.close()
-                    
-                    correct += 1
                     logger.debug("{} correclty processed".format(os.path.basename(zipf)))
                 except Exception as e:
                     logger.exception(e)
                     err.append((os.path.basename(zipf),str(e)))
-        else:
-            logger.error("Can't extract 'joinedModuleContents.dmp from {}".format(os.path.basename(zipf)))
+            # The module is no longer needed
+            os.remove(zfile)
     print ("done!")
-    return err, correct, total
+    return err, correct
 
 
 def valid_zip(zipObj,tpfolder):
@@ -259,66 +396,217 @@ def create_logger(log_level):
     return logger
 
 
-def get_page_info(connection, page_id):
-    """Obtains the module ID and page number of the page from the database
+def init_worker(pack_path=None,cache_dir=None,cache_size=CACHE_SIZE,journal_path=None):
+    """Initializes a process of the extraction pool
+
+    Args:
+        [opt.] pack_path (string): Page pack where the pages are written
+        [opt.] cache_dir (string): Directory of the cache of module images,
+            without it the modules are decompressed for each execution
+        [opt.] cache_size (int): Budget of the cache of module images (in MB)
+        [opt.] journal_path (string): Journal where the pages are recorded
+    """
+    global worker_pack, worker_cache, worker_journal
+    worker_pack = PagePack(pack_path) if pack_path else None
+    worker_cache = ModuleCache(cache_size*1024*1024, cache_dir) if cache_dir else None
+    worker_journal = ExtractionJournal(journal_path) if journal_path else None
+
+
+def module_memory(zipf, pages, derelocation="raw"):
+    """Estimates the memory needed to extract pages from a module
 
     Args:
-        connection (mysql.connector.connection.MySQLConnection): Connection to the database
-        page_id (int): Page ID to obtain the module ID and page number
+        zipf (string): Path of the ZIP file of the module
+        pages (list): List of tuples (page_id, num_page) to extract
+        [opt.] derelocation (string): Derelocation value for the SUM tool
 
     Returns:
-        The module ID of the page and the number of the page
+        integer: Estimated bytes
     """
-    query = "SELECT module_id, num_page FROM pages WHERE id = {}".format(page_id)
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        data = cursor.fetchall()
-        print("module_id:",data[0][0])
-        print("num_page:",data[0][1])
-    return data[0][0], data[0][1]
+    if derelocation == "raw":
+        # Only the pages and the buffer used to skip the stream are in memory
+        return (len(pages) + 1024)*PAGE_SIZE
+    try:
+        with ZipFile(zipf) as zipObj:
+            return zipObj.getinfo(MODULE_CONTENTS).file_size*SUM_MEMORY_FACTOR
+    except Exception:
+        # The size of the ZIP is used if the module can't be read here
+        return os.path.getsize(zipf)*SUM_MEMORY_FACTOR
 
 
-def get_module_info(connection, module_id):
-    """Obtains the module information from the database
+def extract_module_task(task):
+    """Extracts the pages of a module in a process of the extraction pool
 
     Args:
-        connection (mysql.connector.connection.MySQLConnection): Connection to the database
-        module_id (int): Module ID to obtain the module information
+        task (tuple): dir, path of the ZIP file, list of tuples (page_id,
+            num_page), temporary folder and derelocation value
 
     Returns:
-        A list with the module information
+        dict: Report of the module (module, zip, pages, correct, err and
+            whether its image was in the module cache)
     """
-    query = "SELECT file_path FROM modules WHERE id = {}".format(module_id)
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        data = cursor.fetchall()
-        json_name = data[0][0]
-        print("file_path:",json_name)
-        info = json_name.split("_")
-        dir, company, word_size = info[:-2], info[-2], (info[-1])[:-5]
-        dir = "_".join(dir)
-        print("dir:",dir)
-        print("company:",company)
-        print("word_size:",word_size)
-    return dir, get_subdir_os(company+word_size)
-
-
-def get_subdir_os(cpu):
-    """Obtains the subdirectory of the OS
+    dir, zipf, pages, tpfolder, derelocation = task
+    err, correct = [], 0
+    hits = worker_cache.hits if worker_cache is not None else 0
+    if worker_journal is not None:
+        previous = dict((page_id, worker_journal.entries.get(page_id)) for page_id, _ in pages)
+    # Each module gets its own temporary folder, so modules extracted at the
+    # same time don't overwrite their joinedModuleContents.dmp
+    tpf = mkdtemp(dir=tpfolder) if derelocation != "raw" and worker_cache is None else tpfolder
+    try:
+        if worker_cache is not None:
+            err, correct = extract_cached_pages(worker_cache,zipf,dir,pages,worker_pack,derelocation,worker_journal)
+        else:
+            err, correct = extract_module_pages(zipf,tpf,dir,pages,worker_pack,derelocation,worker_journal)
+    except Exception as e:
+        logger.exception(e)
+        err.append((os.path.basename(zipf),str(e)))
+    finally:
+        if tpf != tpfolder:
+            shutil.rmtree(tpf, ignore_errors=True)
+    if worker_journal is not None:
+        # The pages that haven't been recorded failed with the module
+        error = "; ".join(e for _, e in err) or "module not extracted"
+        for page_id, _ in pages:
+            if worker_journal.entries.get(page_id) is previous[page_id]:
+                worker_journal.record_failed(page_id, error)
+    cached = worker_cache is not None and worker_cache.hits > hits
+    return {"module": dir, "zip": zipf, "pages": len(pages), "correct": correct, "err": err, "cached": cached}
+
+
+def failed_module_report(task, error):
+    """Report of a module whose task has failed (see extract_module_task)"""
+    dir, zipf, pages = task[:3]
+    return {"module": dir, "zip": zipf, "pages": len(pages), "correct": 0,
+            "err": [(os.path.basename(zipf), str(error))], "cached": False}
+
+
+def run_module_task(task):
+    """Runs extract_module_task in the pool returning the report of a failed
+    module instead of raising, so its callback is always called (Python 2 has
+    no error_callback)"""
+    try:
+        return extract_module_task(task)
+    except Exception as e:
+        logger.exception(e)
+        return failed_module_report(task, e)
+
+
+class MemoryBudget(object):
+    """Bytes available for the modules being extracted. A module is only sent
+    to the pool when its estimated memory fits in the budget (or when there's
+    nothing else being extracted)."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            while self.in_use > 0 and self.in_use + size > self.limit:
+                self.condition.wait()
+            self.in_use += size
+
+    def release(self, size):
+        with self.condition:
+            self.in_use -= size
+            self.condition.notify_all()
+
+
+def extract_modules(tasks, workers=1, memory=MEMORY_BUDGET, pack_path=None, cache_dir=None, cache_size=CACHE_SIZE, journal_path=None):
+    """Extracts the pages of several modules in a pool of processes
 
     Args:
-        cpu (str): CPU of the OS
+        tasks (list): List of tuples (dir, zipf, pages, tpfolder, derelocation)
+        [opt.] workers (int): Number of processes, 1 to extract in this process
+        [opt.] memory (int): Memory budget of the modules extracted at the same time (in MB)
+        [opt.] pack_path (string): Page pack where the pages are written
+        [opt.] cache_dir (string): Directory of the cache of module images
+        [opt.] cache_size (int): Budget of the cache of module images (in MB)
+        [opt.] journal_path (string): Journal where the pages are recorded
 
     Returns:
-        A string with the subdirectory of the OS
+        list: Report of each module (see extract_module_task)
     """
-    if cpu == "Intel32":
-        return "32-bits"
-    elif cpu == "Intel64":
-        return "64-bits"
-    # XXX To be updated when new archs are considered
-    else:
-        return "" # To search in all subdirectories
+    if workers <= 1 or len(tasks) <= 1:
+        init_worker(pack_path, cache_dir, cache_size, journal_path)
+        return [extract_module_task(task[:-1]) for task in tasks]
+    reports = []
+    budget = MemoryBudget(memory*1024*1024)
+    pool = multiprocessing.Pool(min(workers, len(tasks)), init_worker, (pack_path, cache_dir, cache_size, journal_path))
+    try:
+        # The biggest modules are sent first, so they don't delay the end
+        for task in sorted(tasks, key=lambda t: -t[-1]):
+            size = task[-1]
+            budget.acquire(size)
+            def done(report, size=size):
+                reports.append(report)
+                budget.release(size)
+            def failed(error, task=task, size=size):
+                # Without releasing its memory the pool could wait forever
+                reports.append(failed_module_report(task, error))
+                budget.release(size)
+            kwargs = {"error_callback": failed} if sys.version_info[0] >= 3 else {}
+            pool.apply_async(run_module_task, (task[:-1],), callback=done, **kwargs)
+        pool.close()
+        pool.join()
+    except:
+        pool.terminate()
+        raise
+    return reports
+
+
+def write_report(path, reports):
+    """Writes the report of the extraction of each module in a JSON file
+
+    Args:
+        path (string): Path of the JSON file
+        reports (list): Report of each module (see extract_module_task)
+    """
+    with open(path, "w") as f:
+        json.dump(sorted(reports, key=lambda r: r["module"]), f, indent=1)
+
+
+def read_page_ids(page_ids, pages_file=None):
+    """Obtains the list of page IDs to extract
+
+    Args:
+        page_ids (list): Page IDs given in the command line
+        [opt.] pages_file (string): File with a page ID per line
+
+    Returns:
+        list: Page IDs without duplicates (in the order they are given)
+    """
+    ids = list(page_ids)
+    if pages_file:
+        with open(pages_file, "r") as f:
+            ids.extend(int(line) for line in f if line.strip())
+    seen = set()
+    return [p for p in ids if not (p in seen or seen.add(p))]
+
+
+def group_pages_by_module(resolver, page_ids):
+    """Obtains the module of each page and groups the pages by module
+
+    Args:
+        resolver (MySQLResolver or SQLiteResolver): Resolver of the metadata of the pages
+        page_ids (list): Page IDs to extract
+
+    Returns:
+        dict: (subdir, dir) -> list of tuples (page_id, num_page)
+        list: Page IDs not found in the database
+    """
+    table = resolver.resolve(page_ids)
+    groups = {}
+    missing = []
+    for page_id in page_ids:
+        info = table.get(page_id)
+        if info is None:
+            missing.append(page_id)
+            continue
+        groups.setdefault((info.subdir, info.dir), []).append((page_id, info.num_page))
+    return groups, missing
 
 
 if __name__ == "__main__":
@@ -326,12 +614,24 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="A Python script to extract a page from its module")
     parser.add_argument("-folder", "--folder",help="Folder where ZIP files are located",metavar="folder", default="/mnt/modules-Windows/")
     parser.add_argument("-sumdir", "--sumdir", help="Folder where sum.py script is located", metavar="sumdir", default="../similarity-unrelocated-module")
-    parser.add_argument("page_id",help="Page ID to extract",metavar="page_id",type=int)
+    parser.add_argument("page_id",help="Page ID(s) to extract",metavar="page_id",type=int,nargs="*")
+    parser.add_argument("-pages","--pagesfile",help="File with the page IDs to extract (one per line)",metavar="pagesfile",default=None)
     parser.add_argument("-lv","--loggerlevel",help="Set the default level for logger.\
         The default level is logging.WARNING",metavar='',default=logging.WARNING,type=int,\
         choices=[logging.NOTSET,logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL])
     parser.add_argument("-tpdir","--temporarydirectory",help="Temporary directory where .dmp files will be stored",default=gettempdir())
+    parser.add_argument("-der","--derelocation",help="Derelocation value for the SUM tool. Default value is raw (SUM is not needed)",default="raw",choices=["raw","best"])
+    parser.add_argument("-zipidx","--zipindex",help="File where the index of the ZIP files of the folder is stored",metavar="zipindex",default=ZIP_INDEX_FILE)
+    parser.add_argument("-pack","--pack",help="Page pack where the page is written instead of a .dmp file",metavar="pack",default=None)
+    parser.add_argument("-w","--workers",help="Number of processes extracting modules in parallel. Default is the number of CPUs",metavar="workers",default=multiprocessing.cpu_count(),type=int)
+    parser.add_argument("-mem","--memory",help="Memory budget (MB) of the modules extracted at the same time. Default is {}".format(MEMORY_BUDGET),metavar="memory",default=MEMORY_BUDGET,type=int)
+    parser.add_argument("-cache","--cachedir",help="Directory of the cache of decompressed modules, reused between executions",metavar="cachedir",default=None)
+    parser.add_argument("-cachesize","--cachesize",help="Budget (MB) of the cache of decompressed modules. Default is {}".format(CACHE_SIZE),metavar="cachesize",default=CACHE_SIZE,type=int)
+    parser.add_argument("-journal","--journal",help="Journal of the extracted pages, the pages already extracted are skipped. Default is {}".format(JOURNAL_FILE),metavar="journal",default=JOURNAL_FILE)
+    parser.add_argument("-nojournal","--nojournal",help="Extract all the pages without using the journal",default=False,action="store_true")
+    parser.add_argument("-report","--report",help="JSON file where the result of each module is written",metavar="report",default=None)
     parser.add_argument("-vbf","--verbosefails",help="Show additional information about extracting zips",default=False,action="store_true")
+    parser.add_argument("-mirror","--mirror",help="SQLite mirror of the metadata of the pages (see page_metadata.py), used instead of the database if it exists. Default is {}".format(MIRROR_FILE),metavar="mirror",default=MIRROR_FILE)
     parser.add_argument("-cfg", "--configfile", help="Specify path to config file.\
         The default path is filepaths.ini on this folder", metavar='', default="config.ini")
     
@@ -350,59 +650,119 @@ if __name__ == "__main__":
         print("Exiting script...")
         sys.exit(-1)
 
-    page_id = args.page_id
+    page_ids = read_page_ids(args.page_id, args.pagesfile)
+    if not page_ids:
+        logger.error("No page IDs to extract")
+        sys.exit(-1)
+    journal = None
+    if not args.nojournal:
+        # Restart: the extracted pages are skipped, the failed ones are retried
+        journal = ExtractionJournal(args.journal).load()
+        requested = len(page_ids)
+        failed = journal.failed()
+        page_ids = journal.pending(page_ids)
+        print("[+] Pages already extracted: {}, pages to extract: {} (failed before: {})".format(
+            requested - len(page_ids), len(page_ids), len([p for p in page_ids if p in failed])))
+        if not page_ids:
+            print("Nothing to extract")
+            if args.report:
+                write_report(args.report, [])
+            sys.exit(0)
     cfg_path = args.configfile
-    host_g, user_g, pwd_g, dbname_g = read_config(cfg_path)
 
     try:
         print("[+] Adding {} to Python syspath...".format(args.sumdir)),
         sys.path.append(os.path.abspath(args.sumdir))
         print("done!")
-        print("[+] Trying to import sum.py..."),
-        aux = args.sumdir
-        import sum
+        if args.derelocation != "raw":
+            print("[+] Trying to import sum.py..."),
+            aux = args.sumdir
+            import sum
+            print("done!")
+
+        # The database is only used when there isn't a local mirror
+        def dbinfo():
+            host_g, user_g, pwd_g, dbname_g = read_config(cfg_path)
+            print("[+] Logging in {} as {} to use {} database".format(host_g, user_g, dbname_g))
+            return host_g, user_g, pwd_g, dbname_g
+        resolver = open_resolver(dbinfo, args.mirror)
+        if isinstance(resolver, SQLiteResolver):
+            print("[+] Using the local mirror {}".format(args.mirror))
+        print("done!")
+        print("[+] Obtaining the module_id and num_page of {} page(s)...".format(len(page_ids))),
+        groups, missing = group_pages_by_module(resolver, page_ids)
+        print("done!")
+        if missing:
+            logger.error("Pages not found in the database: {}".format(missing))
+            if journal is not None:
+                for page_id in missing:
+                    journal.record_failed(page_id, "page not found in the database")
+
+        print("[+] Creating temporary directory..."),
+        tpf = mkdtemp(dir=args.temporarydirectory)
         print("done!")
 
-        print("[+] Logging in {} as {} to use {} database".format(host_g, user_g, dbname_g))
-        with connect(host=host_g, user=user_g, password=pwd_g, database=dbname_g) as connection_g:
-            print("done!")
-            print("[+] Obtaining the module_id and num_page of the page..."),
-            module_id, num_page = get_page_info(connection_g, page_id)
-            print("done!")
-            dir, subdir = get_module_info(connection_g, module_id)
-            zpfiles = get_all_file_paths(zpfolder+subdir,".zip")
+        print("[+] Loading the index of the ZIP files of {}...".format(zpfolder)),
+        zip_index = open_zip_index(zpfolder, args.zipindex)
+        print("done!")
 
-            print("[+] Creating temporary directory..."),
-            tpf = mkdtemp(dir=args.temporarydirectory)
-            print("done!")
+        # Each module ZIP is opened once to extract all its requested pages,
+        # the modules are distributed among the processes of the pool
+        reports, tasks = [], []
+        for (subdir, dir), pages in sorted(groups.items()):
+            zipf = zip_index.lookup(dir, subdir)
+            if zipf is None:
+                print("[-] ZIP file of {} not found in the folder".format(dir))
+                reports.append({"module": dir, "zip": None, "pages": len(pages), "correct": 0, "err": [(dir, "ZIP file not found")], "cached": False})
+                if journal is not None:
+                    for page_id, _ in pages:
+                        journal.record_failed(page_id, "ZIP file not found")
+                continue
+            tasks.append((dir, zipf, pages, tpf, args.derelocation, module_memory(zipf, pages, args.derelocation)))
+        if zip_index.dirty:
+            zip_index.save()
+        print("[+] Extracting the pages of {} module(s) with {} worker(s)...".format(len(tasks), min(args.workers, len(tasks))))
+        reports.extend(extract_modules(tasks, args.workers, args.memory, args.pack, args.cachedir, args.cachesize, args.journal if journal is not None else None))
+        err = [e for report in reports for e in report["err"]]
+        # (the builtin sum is hidden by the SUM module)
+        correct = 0
+        for report in reports:
+            correct += report["correct"]
+        total = len(tasks)
+        failed = [report["module"] for report in reports if report["err"]]
+        print("modules with errors: {} of {}".format(len(failed), len(reports)))
+        if args.cachedir:
+            print("modules in the cache: {} of {}".format(len([r for r in reports if r["cached"]]), len(reports)))
+        if args.report:
+            write_report(args.report, reports)
+            print("[+] Report written in {}".format(args.report))
+        print("err:",err)
+        print("found pages: {} of {}".format(correct, len(page_ids)))
+        print("modules:",len(groups))
+        print("total:",total)
+        print("[+] Deleting temporary directory..."),
+        #In case folder can't be deleted due to permissions
+        if not os.access(tpf,os.W_OK):
+            logger.debug("Changing folder permissions")
+            os.chmod(path, stat.S_IWUSR)
+        shutil.rmtree(os.path.abspath(tpf))
+        print("done!")
 
-            err, correct, total = extract_zip(zpfiles,tpf,args.derelocation, dir, num_page, page_id)
-            print("err:",err)
-            print("found pages:",correct)
-            print("total:",total)
-            print("[+] Deleting temporary directory..."),
-            #In case folder can't be deleted due to permissions
-            if not os.access(tpf,os.W_OK):
-                logger.debug("Changing folder permissions")
-                os.chmod(path, stat.S_IWUSR)
-            shutil.rmtree(os.path.abspath(tpf))
-            print("done!")
+        if args.verbosefails:
+            print("[+] Showing failed ZIPS")
+            for error in err:
+                logger.error("Cant process {} due to exception {}".format(error[0],error[1]))
+            for zips in wrong_zips:
+                print(zips)
+        print("Correctly processed ZIP files {}".format(correct))
+        print("Total ZIP files processed {}".format(total))
+        t2 = datetime.now()
+        t2s = t2.strftime("%H:%M:%S")
+        print("Ending execution at {}".format(t2s))
+        tt = t2 - t1
+        ts = int(tt.total_seconds())
+        print("Total running time {} seconds".format(ts))
 
-            if args.verbosefails:
-                print("[+] Showing failed ZIPS")
-                for error in err:
-                    logger.error("Cant process {} due to exception {}".format(error[0],error[1]))
-                for zips in wrong_zips:
-                    print(zips)
-            print("Correctly processed ZIP files {}".format(correct))
-            print("Total ZIP files processed {}".format(total))
-            t2 = datetime.now()
-            t2s = t2.strftime("%H:%M:%S")
-            print("Ending execution at {}".format(t2s))
-            tt = t2 - t1
-            ts = int(tt.total_seconds())
-            print("Total running time {} seconds".format(ts))
-        
     except Exception as e:
         print(e)
         import traceback
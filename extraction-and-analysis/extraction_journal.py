@@ -0,0 +1,136 @@
+# Description: Journal of the extraction of pages, a JSON Lines file where each
+#              extracted page is recorded with its location and content digest
+#              and each failed page with its error. A run that is stopped can
+#              be restarted skipping the pages already extracted.
+# Phase: Extraction
+# Author: Luis Palazón Simón
+
+import os
+import json
+import time
+import fcntl
+from page_pack import PagePack
+
+JOURNAL_FILE = 'extraction_journal.jsonl'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class ExtractionJournal(object):
+    """Journal of extracted and failed pages stored in a JSON Lines file
+
+    Each record is appended with a single write to the file opened with
+    O_APPEND and under a lock, so several processes can record pages at the
+    same time. The last record of a page is the valid one, and an incomplete
+    last line (a process stopped while writing it) is ignored.
+    """
+
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self.entries = {}
+        self._packs = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        """Reads the records of the journal"""
+        if not os.path.exists(self.path):
+            return self
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                self.entries[record['page_id']] = record
+        return self
+
+    def _append(self, record):
+        line = (json.dumps(record, sort_keys=True) + '\n').encode('utf-8')
+        fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            end = os.lseek(fd, 0, os.SEEK_END)
+            if end > 0 and os.lseek(fd, end - 1, os.SEEK_SET) >= 0 and os.read(fd, 1) != b'\n':
+                # The incomplete line of a stopped process is terminated, so
+                # it doesn't corrupt this record
+                line = b'\n' + line
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        self.entries[record['page_id']] = record
+
+    def record_done(self, page_id, location, digest, in_pack=False):
+        """Records an extracted page
+
+        Args:
+            page_id (int): Page ID
+            location (string): .dmp file of the page or page pack where it's stored
+            digest (string): Digest of the content of the page
+            [opt.] in_pack (bool): True if location is a page pack
+        """
+        self._append({'page_id': int(page_id), 'status': DONE, 'location': location,
+                      'in_pack': in_pack, 'digest': digest, 'time': time.time()})
+
+    def record_failed(self, page_id, error):
+        """Records a page that couldn't be extracted
+
+        Args:
+            page_id (int): Page ID
+            error (string): Error of the extraction
+        """
+        self._append({'page_id': int(page_id), 'status': FAILED, 'error': error, 'time': time.time()})
+
+    def failed(self):
+        """Returns a dict page_id -> error of the pages whose last record is a failure"""
+        return dict((p, r['error']) for p, r in self.entries.items() if r['status'] == FAILED)
+
+    def is_done(self, page_id):
+        """Checks that a page is recorded as extracted and its content is still
+        in its location with the same digest"""
+        record = self.entries.get(int(page_id))
+        if record is None or record['status'] != DONE:
+            return False
+        location = record['location']
+        if not record['in_pack']:
+            return os.path.exists(location)
+        if not os.path.exists(location):
+            return False
+        pack = self._packs.get(location)
+        if pack is None:
+            pack = self._packs[location] = PagePack(location).reload()
+        return page_id in pack and pack.digest(page_id) == record['digest']
+
+    def pending(self, page_ids):
+        """Obtains the pages that have to be extracted: the new ones, the failed
+        ones and the extracted ones whose content isn't in its location anymore
+
+        Args:
+            page_ids (list): Page IDs
+
+        Returns:
+            list: Page IDs to extract (in the order they are given)
+        """
+        return [p for p in page_ids if not self.is_done(p)]
+
+    def stats(self):
+        """Returns the number of pages recorded as extracted and as failed"""
+        done = len([r for r in self.entries.values() if r['status'] == DONE])
+        return {'done': done, 'failed': len(self.entries) - done}
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Shows the state of an extraction journal")
+    parser.add_argument("journal", nargs="?", default=JOURNAL_FILE, help="Journal file. Default is {}".format(JOURNAL_FILE))
+    parser.add_argument("-failed", "--failed", help="Show the failed pages and their errors", default=False, action="store_true")
+    args = parser.parse_args()
+    journal = ExtractionJournal(args.journal).load()
+    stats = journal.stats()
+    print("[+] Pages extracted: {}, failed: {}".format(stats['done'], stats['failed']))
+    if args.failed:
+        for page_id, error in sorted(journal.failed().items()):
+            print("{}: {}".format(page_id, error))
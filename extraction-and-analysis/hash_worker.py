@@ -0,0 +1,385 @@
+# Description: Long-lived hashing worker that loads the SUM tool once and
+#              serves hash and comparison requests (page IDs or contents) as
+#              length-prefixed JSON frames over stdin/stdout or a Unix socket,
+#              and the clients (and pool of workers) used by the drivers.
+# Phase: Analysis
+# Author: Luis Palazón Simón
+
+import os
+import sys
+import json
+import base64
+import socket
+import struct
+import binascii
+import threading
+import subprocess
+from variants import Variant, iter_variants
+from digest_cache import DIGEST_CACHE_FILE
+
+PYTHON2 = 'python2'
+SUM_DIR = '../similarity-unrelocated-module'
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hash_worker.py')
+# Frame: length of the JSON document (4 bytes, big-endian) and the document (UTF-8)
+HEADER = struct.Struct('>I')
+SEPARATOR = '-------------------------------------------------------'
+
+
+class HashWorkerError(Exception):
+    """Error returned by the worker for a request"""
+
+
+def read_frame(stream):
+    """Reads a frame from a binary stream
+
+    Returns:
+        dict: Decoded document, None at the end of the stream
+    """
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    size = HEADER.unpack(header)[0]
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise EOFError('Incomplete frame')
+        data += chunk
+    return json.loads(data.decode('utf-8'))
+
+
+def write_frame(stream, document):
+    """Writes a document as a frame to a binary stream"""
+    data = json.dumps(document).encode('utf-8')
+    stream.write(HEADER.pack(len(data)) + data)
+    stream.flush()
+
+
+def encode_content(content):
+    """Encodes a content to be sent in a request"""
+    return base64.b64encode(bytes(content)).decode('ascii')
+
+
+def comparison_lines(comparison):
+    """Lines printed by hashes.py for the comparison of the hashes of two contents
+
+    Args:
+        comparison (list): Comparison of the hashes (see hashes.compare_hashes)
+
+    Returns:
+        list: Lines of text
+    """
+    lines = [SEPARATOR]
+    for c in comparison:
+        if c['equal']:
+            lines.append("Hashes for algorithm {} are equal".format(c['algorithm']))
+        else:
+            lines.append("Hashes for algorithm {} are different".format(c['algorithm']))
+            lines.append("Hash1: {}".format(c['hash1']))
+            lines.append("Hash2: {}".format(c['hash2']))
+        if c['score'] is not None:
+            lines.append("Similarity score for {}: {}".format(c['algorithm'], c['score']))
+        lines.append(SEPARATOR)
+    return lines
+
+
+class Worker(object):
+    """Serves the requests with the SUM tool loaded once
+
+    Requests (fields in brackets are optional):
+        {"op": "hash", "page_id" or "content", ["derelocation"], ["algorithms"]}
+            -> {"digests": {algorithm: digest}}
+        {"op": "compare", "page1" or "content1", ["page2" or "content2"],
+         ["slide1"], ["slide2"], ["prefix"], ["payload"], ["test"], ["crop"],
+         ["derelocation"], ["algorithms"]}
+            -> {"digests1", "digests2", "comparison"}
+        {"op": "variants", "page_id" or "content", "variants", ["prefix"],
+         ["payload"], ["reference" or "reference_content"], ["derelocation"],
+         ["algorithms"]}
+            -> {"digests": [{algorithm: digest} of each variant],
+                "comparisons": [comparison of each variant with the reference]}
+    where each variant is {["slide"], ["overwrite"], ["crop"]} (see variants.py).
+    The contents and the payload are base64, the prefix is hexadecimal. As in
+    hashes.py, without a second page the first one is compared with itself
+    with its first test bytes changed. Each response has the "id" of its
+    request and "ok"; if it's false, "error" has the error. The digests are
+    looked up in the digest cache (if any) before being calculated.
+    """
+
+    def __init__(self, sumdir=SUM_DIR, directory='.', digest_cache=DIGEST_CACHE_FILE):
+        import hashes
+        from page_index import open_index
+        self.hashes = hashes
+        self.hashes.load_sum(sumdir)
+        self.hashes.open_digest_cache(digest_cache)
+        self.directory = directory
+        self.index = open_index(directory)
+
+    def reload_index(self):
+        """Adds to the index the pages extracted after the worker was started
+        (.dmp files and page pack)"""
+        from page_pack import PagePack, PACK_FILE
+        self.index.refresh()
+        pack_path = os.path.join(self.directory, PACK_FILE)
+        if self.index.pack is None and os.path.exists(pack_path):
+            self.index.pack = PagePack(pack_path)
+        if self.index.pack is not None:
+            self.index.pack.reload()
+
+    def content(self, request, page_key, content_key):
+        if request.get(content_key) is not None:
+            return base64.b64decode(request[content_key])
+        page_id = int(request[page_key])
+        if page_id not in self.index:
+            # The page may have been extracted after the worker was started
+            self.reload_index()
+        if page_id not in self.index:
+            raise KeyError('Page {} not found'.format(page_id))
+        return self.index.read(page_id)
+
+    def handle(self, request):
+        op = request.get('op', 'compare')
+        der = request.get('derelocation', 'raw')
+        algorithms = request.get('algorithms') or self.hashes.ALGORITHMS
+        if op == 'hash':
+            content = self.content(request, 'page_id', 'content')
+            return {'digests': self.hashes.calculate_hashes(content, der, algorithms)}
+        payload = request.get('payload')
+        payload = base64.b64decode(payload) if payload else None
+        prefix = binascii.unhexlify(request.get('prefix', '00'))
+        if op == 'variants':
+            content = self.content(request, 'page_id', 'content')
+            variants = [Variant(v.get('slide', 0), v.get('overwrite', 0), v.get('crop', 0)) for v in request['variants']]
+            reference = None
+            if request.get('reference') is not None or request.get('reference_content') is not None:
+                reference = self.content(request, 'reference', 'reference_content')
+            contents = [v.tobytes() for v in iter_variants(content, variants, prefix, payload)]
+            # The digests of the whole batch are looked up in the cache at once
+            digests = self.hashes.calculate_hashes_many(contents + ([reference] if reference is not None else []), der, algorithms)
+            response = {'digests': digests[:len(contents)], 'comparisons': []}
+            if reference is not None:
+                for res in response['digests']:
+                    response['comparisons'].append(self.hashes.compare_hashes(res, digests[-1]))
+            return response
+        if op != 'compare':
+            raise ValueError('Unknown operation: {}'.format(op))
+        content = self.content(request, 'page1', 'content1')
+        content2 = None
+        if request.get('page2') is not None or request.get('content2') is not None:
+            content2 = self.content(request, 'page2', 'content2')
+        content, content2 = self.hashes.prepare_contents(
+            content, content2, request.get('slide1', 0), request.get('slide2', 0),
+            prefix, payload, request.get('test'), request.get('crop'))
+        if content2 is None:
+            raise ValueError('A second page, a second content or a test is needed to compare')
+        res, res2 = self.hashes.calculate_hashes_many([content, content2], der, algorithms)
+        return {'digests1': res, 'digests2': res2,
+                'comparison': self.hashes.compare_hashes(res, res2)}
+
+    def serve(self, instream, outstream):
+        """Serves the requests of a stream until its end or an "exit" request
+
+        Returns:
+            bool: True if an "exit" request has been received
+        """
+        while True:
+            request = read_frame(instream)
+            if request is None:
+                return False
+            if request.get('op') == 'exit':
+                return True
+            try:
+                response = self.handle(request)
+                response['ok'] = True
+            except Exception as e:
+                response = {'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)}
+            response['id'] = request.get('id')
+            write_frame(outstream, response)
+
+    def serve_socket(self, path):
+        """Serves the connections to a Unix socket, one at a time"""
+        if os.path.exists(path):
+            os.remove(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(1)
+        try:
+            while True:
+                connection = server.accept()[0]
+                instream, outstream = connection.makefile('rb'), connection.makefile('wb')
+                try:
+                    finished = self.serve(instream, outstream)
+                finally:
+                    instream.close()
+                    outstream.close()
+                    connection.close()
+                if finished:
+                    break
+        finally:
+            server.close()
+            os.remove(path)
+
+
+class HashWorkerClient(object):
+    """Client of a hashing worker: it starts one (python2 hash_worker.py) or
+    connects to the Unix socket of a running one (digest_cache is the digest
+    cache of the worker started, None to disable it)"""
+
+    def __init__(self, sumdir=SUM_DIR, socket_path=None, python=PYTHON2, directory='.', digest_cache=DIGEST_CACHE_FILE):
+        self.process = None
+        self.connection = None
+        self.next_id = 0
+        if socket_path is not None:
+            self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.connection.connect(socket_path)
+            self.instream = self.connection.makefile('rb')
+            self.outstream = self.connection.makefile('wb')
+        else:
+            cache = ['-cache', digest_cache] if digest_cache else ['-nocache']
+            self.process = subprocess.Popen([python, WORKER_SCRIPT, '-sumdir', sumdir] + cache, cwd=directory,
+                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.instream = self.process.stdout
+            self.outstream = self.process.stdin
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Stops the worker (or disconnects from it, leaving it running)"""
+        if self.process is not None:
+            try:
+                write_frame(self.outstream, {'op': 'exit'})
+            except (IOError, OSError):
+                pass
+        # The streams of a worker that has died can fail to close
+        for stream in (self.outstream, self.instream):
+            try:
+                stream.close()
+            except (IOError, OSError):
+                pass
+        if self.process is not None:
+            self.process.wait()
+        if self.connection is not None:
+            self.connection.close()
+
+    def _response(self, request_id):
+        response = read_frame(self.instream)
+        if response is None:
+            raise HashWorkerError('The worker has finished')
+        if response.get('id') != request_id:
+            raise HashWorkerError('Response {} received for request {}'.format(response.get('id'), request_id))
+        return response
+
+    def request(self, request):
+        """Sends a request and waits for its response (see Worker)
+
+        Raises:
+            HashWorkerError: If the worker returns an error for the request
+        """
+        response = list(self.stream([request]))[0]
+        if not response['ok']:
+            raise HashWorkerError(response['error'])
+        return response
+
+    def stream(self, requests):
+        """Sends the requests while the responses are read, so the worker is
+        never waiting for the driver. A request that fails doesn't stop the
+        rest: its response has "ok" false and the "error".
+
+        Yields:
+            dict: Response of each request, in the same order
+
+        Raises:
+            HashWorkerError: If the worker finishes or gets out of sync
+        """
+        requests = list(requests)
+        first = self.next_id
+        self.next_id += len(requests)
+        def send():
+            try:
+                for i, request in enumerate(requests):
+                    request = dict(request, id=first + i)
+                    write_frame(self.outstream, request)
+            except (IOError, OSError, ValueError):
+                # The worker has finished, the reader reports it
+                pass
+        writer = threading.Thread(target=send)
+        writer.daemon = True
+        writer.start()
+        for i in range(len(requests)):
+            yield self._response(first + i)
+        writer.join()
+
+
+class HashWorkerPool(object):
+    """Pool of hashing workers, the requests are split among them"""
+
+    def __init__(self, size, sumdir=SUM_DIR, python=PYTHON2, directory='.', digest_cache=DIGEST_CACHE_FILE):
+        self.clients = [HashWorkerClient(sumdir, python=python, directory=directory, digest_cache=digest_cache)
+                        for _ in range(size)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Stops all the workers, even if some of them fail to stop"""
+        errors = []
+        for client in self.clients:
+            try:
+                client.close()
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+    def map(self, requests):
+        """Sends the requests to the workers
+
+        Returns:
+            list: Response of each request, in the same order (with "ok" false
+                and the "error" if it has failed, see HashWorkerClient.stream)
+        """
+        requests = list(requests)
+        responses = [None] * len(requests)
+        errors = []
+        def run(k, client):
+            try:
+                indices = range(k, len(requests), len(self.clients))
+                for i, response in zip(indices, client.stream([requests[i] for i in indices])):
+                    responses[i] = response
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(k, client)) for k, client in enumerate(self.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return responses
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Hashing worker: serves hash and comparison requests with the SUM tool loaded once")
+    parser.add_argument("-sumdir", "--sumdir", help="Folder where sum.py script is located", metavar="sumdir", default=SUM_DIR)
+    parser.add_argument("-socket", "--socket", help="Unix socket to listen on (stdin/stdout by default)", metavar="socket", default=None)
+    parser.add_argument("-cache", "--cache", help="Digest cache file. Default is {}".format(DIGEST_CACHE_FILE), default=DIGEST_CACHE_FILE)
+    parser.add_argument("-nocache", "--nocache", help="Don't use the digest cache", action="store_true")
+    args = parser.parse_args()
+    digest_cache = None if args.nocache else args.cache
+    if args.socket:
+        Worker(args.sumdir, digest_cache=digest_cache).serve_socket(args.socket)
+    else:
+        # The frames are written to the original stdout, anything printed
+        # (e.g. by the SUM tool) goes to stderr
+        outstream = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        instream = getattr(sys.stdin, 'buffer', sys.stdin)
+        Worker(args.sumdir, digest_cache=digest_cache).serve(instream, outstream)
@@ -6,28 +6,137 @@
 import argparse
 import os
 import sys
-import subprocess
 import pydeep       # ssdeep
 import fuzzyhashlib # TLSH y sdhash
+from page_index import open_index
+from page_pack import content_digest
+from digest_cache import DIGEST_CACHE_FILE, DigestCache
+from hash_worker import comparison_lines
+from variants import PREFIX, PAYLOADS, make_variant
+ALGORITHMS = ['xxx','ssdeep','tlsh','sdhash']
+# Digests already calculated (see open_digest_cache)
+digest_cache = None
 
-PREFIX = b'\x00'
+def load_sum(sumdir):
+    """Imports the SUM tool from the folder where sum.py is located"""
+    global sum
+    sys.path.append(os.path.abspath(sumdir))
+    import sum
+    return sum
 
-def calculate_hashes(content,der):
-    """
+def open_digest_cache(path=DIGEST_CACHE_FILE):
+    """Opens the digest cache checked before hashing (None to disable it)"""
+    global digest_cache
+    digest_cache = DigestCache(path) if path else None
+    return digest_cache
+
+def sum_hashes(content,der,algorithms=ALGORITHMS):
+    """Calculates the hashes of a content with the SUM tool
 
+    Returns:
+        list: Tuples (algorithm name in the output of SUM, digest)
     """
-    results = {}
-    sumF = sum.SUM(content,options=None,algorithms=['xxx','ssdeep','tlsh','sdhash'],json=True, virtual_layout=True,derelocation=der)
+    sumF = sum.SUM(content,options=None,algorithms=algorithms,json=True, virtual_layout=True,derelocation=der)
     out = sumF.calculate()
 
     # d format: {'valid_pages': [True], 'num_valid_pages': 1, 'base_address': None, 'size': 4096, 'derelocation_time': None, 'num_pages': 1, 'algorithm': 'SSDeep', 'section': 'dump', 'virtual_address': 0, 'pe_time': '0.00065398216247558594', 'digest': [u'24:pW9VP6Xa4Xaijp8QDBgNPnuxC9KxMx6yxkxG53Yz3x5AOA/5eWTeWaThghRTIpO:M9wa2ai98QStn2GK2cAJMxwcdbYIO'], 'mod_name': None, 'preprocess': 'Raw', 'digesting_time': ['0.00162696838378906250']}
-    # print("{}".format("-------------------------------------------------------"))
-    for d in out:
-        # print("{}: {}".format(d['algorithm'], d['digest'][0]))
-        # print("{}".format("-------------------------------------------------------"))
-        results[d['algorithm']] = d['digest'][0]
+    return [(d['algorithm'], d['digest'][0]) for d in out]
+
+def match_algorithms(algorithms, out):
+    """Matches the algorithms requested to SUM (e.g. tlsh) with the names of
+    its output (e.g. TLSH)
+
+    Returns:
+        dict: algorithm -> (name, digest)
+        list: Tuples (name, digest) that couldn't be matched
+    """
+    found = {}
+    unmatched = []
+    for name, digest in out:
+        if name.lower() in algorithms and name.lower() not in found:
+            found[name.lower()] = (name, digest)
+        else:
+            unmatched.append((name, digest))
+    missing = [a for a in algorithms if a not in found]
+    if len(missing) == 1 and len(unmatched) == 1:
+        found[missing[0]] = unmatched.pop()
+    return found, unmatched
+
+def calculate_hashes_many(contents,der,algorithms=ALGORITHMS):
+    """Calculates the hashes of several contents. With the digest cache open
+    (see open_digest_cache) only the digests not stored are calculated, and
+    they are stored with a single write.
+
+    Args:
+        contents (list): Contents (bytes)
+        der (string): Derelocation value for the SUM tool
+        [opt.] algorithms (list): Algorithms requested to the SUM tool
+
+    Returns:
+        list: algorithm name -> digest of each content, in the same order
+    """
+    if digest_cache is None:
+        return [dict(sum_hashes(content, der, algorithms)) for content in contents]
+    keys = [content_digest(content) for content in contents]
+    stored = digest_cache.get_many(keys, algorithms, der)
+    rows = []
+    results = []
+    for key, content in zip(keys, contents):
+        # Equal contents of the batch are hashed only once
+        digests = stored.setdefault(key, {})
+        missing = [a for a in algorithms if a not in digests]
+        unmatched = []
+        if missing:
+            found, unmatched = match_algorithms(missing, sum_hashes(content, der, missing))
+            digests.update(found)
+            rows.extend((key, a, der) + found[a] for a in found)
+        res = dict(digests[a] for a in algorithms if a in digests)
+        res.update(unmatched)
+        results.append(res)
+    digest_cache.put_many(rows)
     return results
 
+def calculate_hashes(content,der,algorithms=ALGORITHMS):
+    """Calculates the hashes of a content (see calculate_hashes_many)
+
+    Returns:
+        dict: algorithm name -> digest
+    """
+    return calculate_hashes_many([content], der, algorithms)[0]
+
+def prepare_contents(content, content2=None, slide1=0, slide2=0, prefix=PREFIX, payload=None, test=None, crop=None):
+    """Applies the slides, the test changes and the crop to the contents as
+    the script does (without test and content2 only content is returned)"""
+    content = make_variant(content, slide=slide1, crop=crop or 0, prefix=prefix, payload=payload)
+    if content2 is None and test:
+        # The first content (already slid and cropped) with its first bytes changed
+        content2 = content
+    else:
+        test = 0
+    if content2 is not None:
+        content2 = make_variant(content2, slide=slide2, overwrite=test, crop=crop or 0, prefix=prefix, payload=payload)
+    return content, content2
+
+def compare_hashes(res, res2):
+    """Compares the hashes of two contents. The scores are calculated from
+    the digests (see calculate_hashes), the contents aren't hashed again.
+
+    Returns:
+        list: A dict per algorithm with the algorithm, if the hashes are equal,
+              the hashes and the similarity score (SSDeep and TLSH, None otherwise)
+    """
+    comparison = []
+    for k in res.keys():
+        score = None
+        if k == "SSDeep":
+            score = pydeep.compare(res[k], res2[k])
+        elif k == "TLSH":
+            score = fuzzyhashlib.tlsh(hash=res[k]).compare(fuzzyhashlib.tlsh(hash=res2[k]))
+        # elif k == "SDHash":
+        #     score = fuzzyhashlib.sdhash(content).compare(fuzzyhashlib.sdhash(content2))
+        comparison.append({'algorithm': k, 'equal': res[k] == res2[k], 'hash1': res[k], 'hash2': res2[k], 'score': score})
+    return comparison
+
 
 
 if __name__ == "__main__":
@@ -44,22 +153,16 @@ if __name__ == "__main__":
     parser.add_argument("-prefixAA", "--prefixAA", help="PREFIX default to AA", action="store_true")
     parser.add_argument("-test", "--test", type=int, help="Compare hashes of a page with itself with first bytes changed", default=None)
     parser.add_argument("-crop", "--crop", type=int, help="Crop the last bytes of the file/s", default=None)
+    parser.add_argument("-cache", "--cache", help="Digest cache file. Default is {}".format(DIGEST_CACHE_FILE), default=DIGEST_CACHE_FILE)
+    parser.add_argument("-nocache", "--nocache", help="Don't use the digest cache", action="store_true")
     args = parser.parse_args()
 
     slide1 = args.slide1
     slide2 = args.slide2
     
     if args.prefixFile:
-        if args.prefixFile == "8B":
-            maliciousContent = b'\xD7\xCB\x81\x7C\x90\x90\x90\x90'
-        elif args.prefixFile == "16B":
-            maliciousContent = b'\xB8\xD7\xCB\x81\x7C\xFF\xD0\x90\x90\x90\x90\x90\x90\x90\x90\x90'
-        elif args.prefixFile == "32B":
-            maliciousContent = (
-                b'\x31\xc0\x50\x68\x2e\x65\x78\x65\x68\x2e\x63\x6d\x64'
-                b'\x89\xe3\xb8\xc0\x1e\x86\x7c\xff\xd0\x31\xc0\xb8\xd7'
-                b'\xcb\x81\x7c\xff\xd0'
-            )
+        if args.prefixFile in PAYLOADS:
+            maliciousContent = PAYLOADS[args.prefixFile]
         else:
             try:
                 with open(args.prefixFile, "rb") as f:
@@ -74,9 +177,8 @@ if __name__ == "__main__":
     assert not (args.test and args.page2), "Test mode is only available for one page"
 
     try:
-        sys.path.append(os.path.abspath(args.sumdir))
-        aux = args.sumdir
-        import sum
+        load_sum(args.sumdir)
+        open_digest_cache(None if args.nocache else args.cache)
     except Exception as e:
         print(e)
         import traceback
@@ -84,32 +186,31 @@ if __name__ == "__main__":
         exit(-1)
 
     # If numPage1 contains a dot, it is assumed to be a file and not a page number    
+    page1, page2 = None, None
     if str(args.page1).find('.') != -1:
         file1 = args.page1
         print('Fichero a analizar: {}'.format(file1))
     else:
-        # Obtain the names of the files (search in the current directory the file that starts with numPage1_ using the find command)
+        # Obtain the pages from the index of the pages of the current directory
         page1 = int(args.page1)
-        res = subprocess.Popen(['find', '.', '-maxdepth', '1', '-type', 'f', '-name', '{}_*'.format(page1)], stdout=subprocess.PIPE)
-        output, _ = res.communicate()
-        if res.returncode != 0:
-            print('No se ha encontrado el fichero del segundo número de página')
+        index = open_index('.')
+        if page1 not in index:
+            print('No se ha encontrado el fichero del primer número de página')
             exit(1)
-        file1 = output.decode().split('\n')[0]
+        file1 = index.name(page1)
     if args.page2:
         # If numPage2 contains a dot, it is assumed to be a file and not a page number
         if str(args.page2).find('.') != -1:
             file2 = args.page2
             print('Fichero a analizar: {}'.format(file2))
         else:
-            # Obtain the names of the files (search in the current directory the file that starts with numPage2_ using the find command)
+            # Obtain the pages from the index of the pages of the current directory
             page2 = int(args.page2)
-            res = subprocess.Popen(['find', '.', '-maxdepth', '1', '-type', 'f', '-name', '{}_*'.format(page2)], stdout=subprocess.PIPE)
-            output, _ = res.communicate()
-            if res.returncode != 0:
+            index = open_index('.')
+            if page2 not in index:
                 print('No se ha encontrado el fichero del segundo número de página')
                 exit(1)
-            file2 = output.decode().split('\n')[0]
+            file2 = index.name(page2)
             print('Ficheros a analizar:')
             print(' - {}'.format(file1))
             print(' - {}'.format(file2))
@@ -117,8 +218,11 @@ if __name__ == "__main__":
 
     # Try to read binary the requested file
     try:
-        with open(file1, "rb") as f:
-            content = f.read()
+        if page1 is not None:
+            content = index.read(page1)
+        else:
+            with open(file1, "rb") as f:
+                content = f.read()
     except Exception as e:
         print("Error while reading the file: {}".format(e))
         exit(-1)
@@ -130,7 +234,7 @@ if __name__ == "__main__":
         # show the prefix used
         prefix_string = "00"
         if args.prefixFF:
-            PREFIX = b'FF'
+            PREFIX = b'\xFF'
             prefix_string = "FF"
         elif args.prefixAA:
             PREFIX = b'\xAA'
@@ -140,14 +244,7 @@ if __name__ == "__main__":
         if args.prefixFile:
             print("Payload file used: {}".format(args.prefixFile))
         # introduce the prefix
-        if args.prefixFile:
-            content = maliciousContent + content
-            for _ in range(slide1-len(maliciousContent)):
-                content = PREFIX + content
-        else:
-            for _ in range(slide1):
-                content = PREFIX + content
-        content = content[:-slide1]
+        content = make_variant(content, slide=slide1, prefix=PREFIX, payload=maliciousContent if args.prefixFile else None)
         # write content in a file
         with open("a.dmp", "wb") as f:
             f.write(content)
@@ -164,7 +261,7 @@ if __name__ == "__main__":
         # Update the prefix used if it is necessary
         prefix_string = "00"
         if args.prefixFF:
-            PREFIX = b'FF'
+            PREFIX = b'\xFF'
             prefix_string = "FF"
         elif args.prefixAA:
             PREFIX = b'\xAA'
@@ -172,16 +269,18 @@ if __name__ == "__main__":
         # If a second file is provided, read it
         if args.page2:
             try:
-                with open(file2, "rb") as f:
-                    content2 = f.read()
+                if page2 is not None:
+                    content2 = index.read(page2)
+                else:
+                    with open(file2, "rb") as f:
+                        content2 = f.read()
             except Exception as e:
                 print("Error while reading the file: {}".format(e))
                 exit(-1)
         else: # If not, compare the first file with itself with the first bytes changed
             content2 = content
             file2 = file1 + " (-test {}, prefix {})".format(args.test, prefix_string)
-            for i in range(0, args.test):
-                content2 = content2[:i] + PREFIX + content2[i+1:]
+            content2 = make_variant(content2, overwrite=args.test, prefix=PREFIX)
         if slide2 != 0:
             print("Sliding content2 {} bytes".format(slide2))
             # show the prefix used
@@ -191,14 +290,7 @@ if __name__ == "__main__":
             if args.prefixFile:
                 print("Payload file used: {}".format(args.prefixFile))
             # introduce the prefix
-            if args.prefixFile:
-                content2 = maliciousContent + content2
-                for _ in range(slide2-len(maliciousContent)):
-                    content2 = PREFIX + content2
-            else:
-                for _ in range(slide2):
-                    content2 = PREFIX + content2
-            content2 = content2[:-slide2]
+            content2 = make_variant(content2, slide=slide2, prefix=PREFIX, payload=maliciousContent if args.prefixFile else None)
             # write content in a file
             with open("b.dmp", "wb") as f:
                 f.write(content2)
@@ -210,26 +302,8 @@ if __name__ == "__main__":
         res2 = calculate_hashes(content2, args.derelocation)
 
         # Compare hashes
-        print("{}".format("-------------------------------------------------------"))
-        for k in res.keys():
-            if res[k] == res2[k]:
-                print("Hashes for algorithm {} are equal".format(k))
-            else:
-                print("Hashes for algorithm {} are different".format(k))
-                print("Hash1: {}".format(res[k]))
-                print("Hash2: {}".format(res2[k]))
-            if k == "SSDeep":
-                score = pydeep.compare(res[k], res2[k])
-                print("Similarity score for SSDeep: {}".format(score))
-            elif k == "TLSH":
-                score = fuzzyhashlib.tlsh(content).compare(fuzzyhashlib.tlsh(content2))
-                print("Similarity score for TLSH: {}".format(score))
-            # elif k == "SDHash":
-            #     print("Hash SDHash 1: {}".format(fuzzyhashlib.sdhash(content).hexdigest()))
-            #     print("Hash SDHash 2: {}".format(fuzzyhashlib.sdhash(content2).hexdigest()))
-            #     score = fuzzyhashlib.sdhash(content).compare(fuzzyhashlib.sdhash(content2))
-            #     print("Similarity score for SDHash: {}".format(score))
-            print("{}".format("-------------------------------------------------------"))
+        for line in comparison_lines(compare_hashes(res, res2)):
+            print(line)
     else:
         print("{}".format("-------------------------------------------------------"))
         for k in res.keys():
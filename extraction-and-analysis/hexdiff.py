@@ -0,0 +1,202 @@
+# Description: Side-by-side hex/ASCII diff of two pages rendered in the same
+#              process (ANSI for the terminal or HTML), optionally aligned on
+#              a displacement of the content of one page in the other
+# Phase: Analysis
+# Author: Luis Palazón Simón
+
+import sys
+import html
+
+BYTES_PER_LINE = 16
+ANSI_DIFF = '\033[91m'
+ANSI_MISSING = '\033[90m'
+ANSI_RESET = '\033[0m'
+HTML_STYLE = '''pre { font-family: monospace; font-size: 13px; }
+.diff { color: #c00; font-weight: bold; }
+.miss { color: #999; }
+.sep { color: #06c; }'''
+
+
+def hexdiff_rows(content1, content2, shift=0, direction=1, width=BYTES_PER_LINE, context=None):
+    '''
+    Aligns two contents and splits them in rows. With a displacement over the
+    first content (direction 1), the byte i of content1 is paired with the byte
+    i+shift of content2; over the second one (direction 2), the byte i+shift of
+    content1 with the byte i of content2. The bytes without pair are missing.
+    parameters:
+        content1: bytes
+        content2: bytes
+        shift: int, displacement in bytes
+        direction: int, 1 if the displacement is over content1, 2 if it's over content2
+        width: int, bytes per row
+        context: int, rows shown around the rows with differences (None to show all)
+    return:
+        list of tuples, [(offset1, offset2, cells), ...] where cells is a list
+        of (byte1, byte2) (None if missing), or None for the skipped rows
+    '''
+    content1, content2 = bytearray(content1), bytearray(content2)
+    lag = shift if direction == 1 else -shift
+    # The rows start at multiples of width of content1
+    start = (min(0, -lag) // width) * width
+    end = max(len(content1), len(content2) - lag)
+    rows, changed = [], []
+    for k in range(start, end, width):
+        cells = []
+        for i in range(k, min(k + width, end)):
+            j = i + lag
+            cells.append((content1[i] if 0 <= i < len(content1) else None,
+                          content2[j] if 0 <= j < len(content2) else None))
+        rows.append((k, k + lag, cells))
+        changed.append(any(b1 != b2 for b1, b2 in cells))
+    if context is None:
+        return rows
+    shown, skipped = [], False
+    for r, row in enumerate(rows):
+        if any(changed[max(0, r - context):r + context + 1]):
+            shown.append(row)
+            skipped = False
+        elif not skipped:
+            shown.append(None)
+            skipped = True
+    return shown
+
+
+def _side(offset, cells, side, width):
+    '''
+    return:
+        tuple, (offset label, hex and ASCII columns) of a side of a row as
+        (text, kind) pairs, kind is 'diff', 'miss' or None
+    '''
+    hexcols, asciicols = [], []
+    for b1, b2 in cells:
+        b = b1 if side == 0 else b2
+        if b is None:
+            hexcols.append(('  ', 'miss'))
+            asciicols.append((' ', 'miss'))
+            continue
+        kind = 'diff' if b1 != b2 else None
+        hexcols.append(('{:02x}'.format(b), kind))
+        asciicols.append((chr(b) if 32 <= b < 127 else '.', kind))
+    hexcols.extend([('  ', 'miss')] * (width - len(cells)))
+    asciicols.extend([(' ', 'miss')] * (width - len(cells)))
+    # Offset of the first byte of the side in the row
+    first = [i for i, cell in enumerate(cells) if cell[side] is not None]
+    off = '{:08x}:'.format(offset + first[0]) if first else ' ' * 9
+    return off, hexcols, asciicols
+
+
+def _render(rows, width, paint, escape):
+    lines = []
+    for row in rows:
+        if row is None:
+            lines.append(paint('...', 'sep'))
+            continue
+        offset1, offset2, cells = row
+        mark = '|' if any(b1 != b2 for b1, b2 in cells) else ' '
+        sides = []
+        for side, offset in ((0, offset1), (1, offset2)):
+            off, hexcols, asciicols = _side(offset, cells, side, width)
+            sides.append('{} {}  {}'.format(off, ' '.join(paint(escape(t), k) for t, k in hexcols),
+                                            ''.join(paint(escape(t), k) for t, k in asciicols)))
+        lines.append('{}  {}  {}'.format(sides[0], paint(mark, 'sep') if mark != ' ' else mark, sides[1]))
+    return lines
+
+
+def render_ansi(rows, width=BYTES_PER_LINE, color=True):
+    '''
+    parameters:
+        rows: list, rows of hexdiff_rows
+        width: int, bytes per row
+        color: bool, true to mark the different and missing bytes with ANSI colors
+    return:
+        str, side-by-side diff for the terminal
+    '''
+    colors = {'diff': ANSI_DIFF, 'miss': ANSI_MISSING, 'sep': ANSI_DIFF}
+    def paint(text, kind):
+        if not color or kind is None or not text.strip():
+            return text
+        return colors[kind] + text + ANSI_RESET
+    return '\n'.join(_render(rows, width, paint, lambda text: text)) + '\n'
+
+
+def render_html(rows, width=BYTES_PER_LINE, title=''):
+    '''
+    parameters:
+        rows: list, rows of hexdiff_rows
+        width: int, bytes per row
+        title: str, title of the page
+    return:
+        str, HTML document with the side-by-side diff
+    '''
+    def paint(text, kind):
+        if kind is None or not text.strip():
+            return text
+        return '<span class="{}">{}</span>'.format(kind, text)
+    body = '\n'.join(_render(rows, width, paint, html.escape))
+    return ('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>{0}</title>\n'
+            '<style>\n{1}\n</style>\n</head>\n<body>\n<h3>{0}</h3>\n<pre>\n{2}\n</pre>\n</body>\n</html>\n').format(
+                html.escape(title), HTML_STYLE, body)
+
+
+def write_hexdiff(content1, content2, path=None, fmt=None, shift=0, direction=1, context=None, title='', width=BYTES_PER_LINE):
+    '''
+    Renders the diff of two contents and writes it to a file (or to stdout),
+    without asking anything.
+    parameters:
+        content1: bytes
+        content2: bytes
+        path: str, output file (None or '-' for stdout)
+        fmt: str, 'ansi' or 'html' (by default html if path ends with .html)
+        shift: int, displacement to align the contents
+        direction: int, 1 if the displacement is over content1, 2 if it's over content2
+        context: int, rows shown around the rows with differences (None to show all)
+        title: str, title of the HTML document
+        width: int, bytes per row
+    return:
+        int, number of rows with differences
+    '''
+    if fmt is None:
+        fmt = 'html' if path and path.lower().endswith(('.html', '.htm')) else 'ansi'
+    rows = hexdiff_rows(content1, content2, shift, direction, width, context)
+    if fmt == 'html':
+        text = render_html(rows, width, title)
+    else:
+        # Colors only when they are shown in a terminal
+        tty = path in (None, '-') and sys.stdout.isatty()
+        text = render_ansi(rows, width, color=tty)
+    if path in (None, '-'):
+        sys.stdout.write(text)
+    else:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+    return len([row for row in rows if row is not None and any(b1 != b2 for b1, b2 in row[2])])
+
+
+if __name__ == '__main__':
+    import argparse
+    from page_index import open_index
+    from displacement import findAnchoredDisplacement
+    parser = argparse.ArgumentParser(description='Muestra la comparativa hexadecimal de dos páginas')
+    parser.add_argument('numPage1', type=int, help='Número de página del primer archivo')
+    parser.add_argument('numPage2', type=int, help='Número de página del segundo archivo')
+    parser.add_argument('-o', '--output', default=None, help='Fichero de salida (.html para HTML). Por defecto la salida estándar')
+    parser.add_argument('-html', '--html', action='store_true', help='Genera HTML aunque la salida no acabe en .html')
+    parser.add_argument('-s', '--shift', type=int, default=None, help='Desplazamiento con el que alinear las páginas')
+    parser.add_argument('-dir', '--direction', type=int, choices=[1, 2], default=1, help='Página sobre la que se aplica el desplazamiento')
+    parser.add_argument('-align', '--align', action='store_true', help='Alinea las páginas con el desplazamiento exacto encontrado (si lo hay)')
+    parser.add_argument('-c', '--context', type=int, default=None, help='Muestra sólo las filas con diferencias y este número de filas alrededor')
+    args = parser.parse_args()
+    index = open_index('.')
+    for numPage in (args.numPage1, args.numPage2):
+        if numPage not in index:
+            print('No se ha encontrado el fichero de la página {}'.format(numPage))
+            exit(1)
+    content1 = index.read(args.numPage1)
+    content2 = index.read(args.numPage2)
+    shift, direction = args.shift or 0, args.direction
+    if args.align and args.shift is None:
+        displacement = findAnchoredDisplacement(content1, content2)
+        if displacement is not None:
+            shift, direction = displacement[0], 1 if displacement[1] else 2
+    title = '{} - {} (desplazamiento de {}B ({}))'.format(index.name(args.numPage1), index.name(args.numPage2), shift, direction)
+    write_hexdiff(content1, content2, args.output, 'html' if args.html else None, shift, direction, args.context, title)
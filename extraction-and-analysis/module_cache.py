@@ -0,0 +1,232 @@
+# Description: Cache of decompressed module images (joinedModuleContents.dmp)
+#              keyed by the path and mtime of their ZIP file. The images are
+#              kept in memory or as memory-mapped files in a cache directory,
+#              with LRU eviction under a budget of bytes.
+# Phase: Extraction/Analysis
+# Author: Luis Palazón Simón
+
+import os
+import mmap
+import fcntl
+import shutil
+import xxhash
+from collections import OrderedDict
+from contextlib import contextmanager
+from zipfile import ZipFile
+
+MODULE_CONTENTS = "joinedModuleContents.dmp"
+# Budget of the cache (in MB)
+CACHE_SIZE = 2048
+
+
+class ModuleCache(object):
+    """LRU cache of module images under a budget of bytes
+
+    With a directory, the images are stored as <key>.img files and returned as
+    read-only memory maps; the files of previous executions are reused (the
+    least recently used are the ones with the oldest mtime). The directory can
+    be shared by several processes: the budget applies to all the files stored
+    in it, which are rescanned under a lock before adding an image. Without
+    it, the images are kept in memory as bytes. An image bigger than the
+    budget is returned but not cached.
+    """
+
+    def __init__(self, budget=CACHE_SIZE*1024*1024, directory=None):
+        self.budget = budget
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if directory is not None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with self._lock():
+                self._scan()
+                self._evict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, zipf):
+        return self.key(zipf) in self.entries
+
+    def key(self, zipf, member=MODULE_CONTENTS):
+        """Returns the key of the image of a ZIP file, it changes with its mtime"""
+        zipf = os.path.abspath(zipf)
+        return xxhash.xxh64("{}:{}:{}".format(zipf, os.stat(zipf).st_mtime, member).encode("utf-8")).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.directory, key + ".img")
+
+    @contextmanager
+    def _lock(self):
+        """Locks the cache directory for the processes sharing it"""
+        with open(os.path.join(self.directory, ".lock"), "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _scan(self):
+        """Loads the images stored in the cache directory, oldest first,
+        including the ones written or removed by other processes (the images
+        already mapped are kept)"""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".img"):
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                files.append((st.st_mtime, name[:-len(".img")], st.st_size))
+        entries = OrderedDict()
+        for _, key, size in sorted(files):
+            entries[key] = self.entries.pop(key, [size, None])
+        self.entries = entries
+        self.used = sum(size for size, _ in entries.values())
+
+    def _evict(self, needed=0):
+        """Removes the least recently used images until needed bytes fit in the budget"""
+        while self.entries and self.used + needed > self.budget:
+            key, (size, image) = self.entries.popitem(last=False)
+            self.used -= size
+            self.evictions += 1
+            if self.directory is not None:
+                self._close(image)
+                try:
+                    os.remove(self._file(key))
+                except OSError:
+                    # Another process has already removed it
+                    pass
+
+    def _close(self, image):
+        if isinstance(image, mmap.mmap):
+            try:
+                image.close()
+            except BufferError:
+                # There are still views of the image, the map is released with them
+                pass
+
+    def _map(self, key):
+        with open(self._file(key), "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _load(self, zipf, member, key):
+        """Decompresses the image of a ZIP file and caches it, in the cache
+        directory if there is one"""
+        with ZipFile(zipf) as zipObj:
+            size = zipObj.getinfo(member).file_size
+            if self.directory is None or size == 0 or size > self.budget:
+                image = zipObj.read(member)
+                if self.directory is None and size <= self.budget:
+                    self._evict(size)
+                    self.entries[key] = [size, image]
+                    self.used += size
+                return image
+            tmp = "{}.{}.tmp".format(self._file(key), os.getpid())
+            with zipObj.open(member) as src, open(tmp, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024*1024)
+        with self._lock():
+            # The other processes may have added images since the last scan
+            self._scan()
+            image = self._use(key)
+            if image is not None:
+                # Another process has stored the same image meanwhile
+                os.remove(tmp)
+                return image
+            self._evict(size)
+            os.rename(tmp, self._file(key))
+            self.entries[key] = [size, self._map(key)]
+            self.used += size
+        return self.entries[key][1]
+
+    def _use(self, key):
+        """Returns the cached image of a key as the most recently used one,
+        None if it isn't cached"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if self.directory is not None:
+            try:
+                if entry[1] is None:
+                    entry[1] = self._map(key)
+                # The other processes evict by mtime
+                os.utime(self._file(key), None)
+            except (IOError, OSError):
+                # Evicted by another process sharing the directory
+                self.used -= self.entries.pop(key)[0]
+                return None
+        self.entries[key] = self.entries.pop(key)
+        return entry[1]
+
+    def get(self, zipf, member=MODULE_CONTENTS):
+        """Obtains the decompressed image of a member of a ZIP file
+
+        Args:
+            zipf (string): Path of the ZIP file
+            [opt.] member (string): Member of the ZIP file
+
+        Returns:
+            bytes or mmap: Content of the member (read-only)
+
+        Raises:
+            KeyError: If the member isn't in the ZIP file
+        """
+        key = self.key(zipf, member)
+        image = self._use(key)
+        if image is None and self.directory is not None:
+            # Another process sharing the directory may have stored it since
+            # the last scan, it's mapped instead of decompressed again
+            with self._lock():
+                self._scan()
+                image = self._use(key)
+        if image is not None:
+            self.hits += 1
+            return image
+        self.misses += 1
+        return self._load(zipf, member, key)
+
+    def clear(self):
+        """Removes all the images of the cache"""
+        budget, self.budget = self.budget, 0
+        if self.directory is not None:
+            with self._lock():
+                self._scan()
+                self._evict()
+        else:
+            self._evict()
+        self.budget = budget
+
+    def stats(self):
+        """Returns the statistics of the cache
+
+        Returns:
+            dict: Cached images, bytes used, budget, hits, misses, evictions and hit ratio
+        """
+        requests = self.hits + self.misses
+        return {
+            'images': len(self.entries),
+            'used_bytes': self.used,
+            'budget_bytes': self.budget,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': float(self.hits) / requests if requests else 0.0,
+        }
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Shows or clears the cache of module images of a directory")
+    parser.add_argument("directory", help="Cache directory")
+    parser.add_argument("-size", "--cachesize", help="Budget of the cache (MB). Default is {}".format(CACHE_SIZE), metavar="cachesize", default=CACHE_SIZE, type=int)
+    parser.add_argument("-clear", "--clear", help="Remove all the images of the cache", default=False, action="store_true")
+    args = parser.parse_args()
+    cache = ModuleCache(args.cachesize*1024*1024, args.directory)
+    if args.clear:
+        cache.clear()
+    stats = cache.stats()
+    print("[+] Cached images: {} ({}B of {}B, evicted: {})".format(stats['images'], stats['used_bytes'], stats['budget_bytes'], stats['evictions']))
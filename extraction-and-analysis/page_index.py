@@ -0,0 +1,211 @@
+# Description: Persistent index of the extracted pages of a directory. It maps
+#              each page ID to the name, size and content hash of its
+#              <page_id>_extracted_<num_page>_<dir>.dmp file, so the scripts
+#              don't need to search the files with find. If the directory has
+#              a page pack, the pages are also read from it.
+# Phase: Analysis
+# Author: Luis Palazón Simón
+
+import os
+import re
+import json
+from page_pack import PagePack, PACK_FILE, content_digest
+
+INDEX_FILE = '.page_index.json'
+INDEX_VERSION = 1
+# <page_id>_extracted_<num_page>_<dir>.dmp
+PAGE_RE = re.compile(r'^(\d+)_extracted_(\d+)_(.+)\.dmp$')
+
+_indexes = {}
+
+
+class PageIndex(object):
+    """Index page_id -> (name, size, mtime, digest) of the pages of a directory.
+    The pages of the page pack (if any) take precedence over the .dmp files."""
+
+    def __init__(self, directory='.', index_file=INDEX_FILE, pack=None):
+        self.directory = directory
+        self.index_path = os.path.join(directory, index_file)
+        self.pages = {}
+        self.dirty = False
+        self.pack = pack
+
+    def __len__(self):
+        return len(self.page_ids())
+
+    def __contains__(self, page_id):
+        return int(page_id) in self.pages or self._in_pack(page_id)
+
+    def page_ids(self):
+        ids = set(self.pages)
+        if self.pack is not None:
+            ids.update(self.pack.page_ids())
+        return ids
+
+    def load(self):
+        """Loads the index from disk (if it exists and has the current version)"""
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == INDEX_VERSION:
+                self.pages = dict((int(k), tuple(v)) for k, v in data['pages'].items())
+            else:
+                self.dirty = True
+        return self
+
+    def save(self):
+        """Saves the index to disk atomically"""
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'pages': dict((str(k), list(v)) for k, v in self.pages.items())}, f)
+        os.rename(tmp, self.index_path)
+        self.dirty = False
+
+    def refresh(self):
+        """Updates the index with the pages added, modified or removed from the directory.
+        Only the new or modified files are read and hashed.
+
+        Returns:
+            tuple: Number of pages added/updated and number of pages removed
+        """
+        found = {}
+        updated = 0
+        for name in sorted(os.listdir(self.directory)):
+            m = PAGE_RE.match(name)
+            if m is None:
+                continue
+            page_id = int(m.group(1))
+            if page_id in found:
+                continue
+            st = os.stat(os.path.join(self.directory, name))
+            entry = self.pages.get(page_id)
+            if entry is None or entry[0] != name or entry[1] != st.st_size or entry[2] != st.st_mtime:
+                with open(os.path.join(self.directory, name), 'rb') as f:
+                    digest = content_digest(f.read())
+                entry = (name, st.st_size, st.st_mtime, digest)
+                updated += 1
+            found[page_id] = entry
+        removed = len(set(self.pages) - set(found))
+        self.pages = found
+        if updated or removed:
+            self.dirty = True
+        return updated, removed
+
+    def _in_pack(self, page_id):
+        # The pack is only reloaded for pages that aren't in the .dmp files either
+        if self.pack is None:
+            return False
+        page_id = int(page_id)
+        return page_id in self.pack.pages or (page_id not in self.pages and page_id in self.pack)
+
+    def path(self, page_id):
+        """Returns the path of the .dmp file of the page, None if there isn't one"""
+        entry = self.pages.get(int(page_id))
+        if entry is None:
+            return None
+        return os.path.join(self.directory, entry[0])
+
+    def name(self, page_id):
+        """Returns a name to show the page: its .dmp file or its place in the pack"""
+        if self._in_pack(page_id):
+            return '{}:{}'.format(self.pack.path, page_id)
+        return self.path(page_id)
+
+    def size(self, page_id):
+        if self._in_pack(page_id):
+            return self.pack.size(page_id)
+        return self.pages[int(page_id)][1]
+
+    def digest(self, page_id):
+        if self._in_pack(page_id):
+            return self.pack.digest(page_id)
+        return self.pages[int(page_id)][3]
+
+    def read(self, page_id):
+        """Returns the content of the page as bytes"""
+        if self._in_pack(page_id):
+            return self.pack.read(page_id)
+        with open(self.path(page_id), 'rb') as f:
+            return f.read()
+
+    def view(self, page_id):
+        """Returns the content of the page, without copying it if it's in the pack"""
+        if self._in_pack(page_id):
+            return self.pack.view(page_id)
+        return self.read(page_id)
+
+    def group_by_digest(self, page_ids):
+        """Groups page IDs by the digest of their content, so the results
+        obtained for a content can be reused by all the pages with it
+
+        Args:
+            page_ids (iterable): Page IDs
+
+        Returns:
+            dict: digest -> list of page IDs (in the order they are given)
+        """
+        groups = {}
+        for page_id in page_ids:
+            groups.setdefault(self.digest(page_id), []).append(page_id)
+        return groups
+
+    def stats(self):
+        """Returns the deduplication statistics of the indexed pages
+
+        Returns:
+            dict: Number of pages, number of unique contents and deduplication ratio
+        """
+        pages = len(self)
+        unique = len(self.group_by_digest(self.page_ids()))
+        return {
+            'pages': pages,
+            'unique': unique,
+            'dedup_ratio': float(pages) / unique if unique else 1.0,
+        }
+
+
+def open_index(directory='.'):
+    """Loads the index of a directory, refreshes it and saves it if it has changed.
+    The index is opened once per process and directory.
+
+    Args:
+        directory (string): Directory where the pages are located
+
+    Returns:
+        PageIndex: Index of the pages of the directory
+    """
+    key = os.path.abspath(directory)
+    index = _indexes.get(key)
+    if index is None:
+        index = PageIndex(directory).load()
+        index.refresh()
+        if index.dirty:
+            index.save()
+        pack_path = os.path.join(directory, PACK_FILE)
+        if os.path.exists(pack_path):
+            index.pack = PagePack(pack_path).reload()
+        _indexes[key] = index
+    return index
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Crea o actualiza el índice de las páginas extraídas de un directorio')
+    parser.add_argument('directory', nargs='?', default='.', help='Directorio de las páginas extraídas')
+    parser.add_argument('-p', '--pages', nargs='+', type=int, default=None, help='Mostrar la entrada de estas páginas')
+    args = parser.parse_args()
+    index = PageIndex(args.directory).load()
+    updated, removed = index.refresh()
+    if index.dirty:
+        index.save()
+    print('Páginas indexadas: {} (nuevas o modificadas: {}, eliminadas: {})'.format(len(index), updated, removed))
+    if os.path.exists(os.path.join(args.directory, PACK_FILE)):
+        index.pack = PagePack(os.path.join(args.directory, PACK_FILE)).reload()
+        print('Páginas en el pack: {}'.format(len(index.pack)))
+    stats = index.stats()
+    print('Contenidos únicos: {} de {} páginas (ratio de deduplicación: {:.2f})'.format(stats['unique'], stats['pages'], stats['dedup_ratio']))
+    for page_id in args.pages or []:
+        if page_id in index:
+            print('{}: {} ({}B, {})'.format(page_id, index.name(page_id), index.size(page_id), index.digest(page_id)))
+        else:
+            print('{}: no encontrada'.format(page_id))
@@ -0,0 +1,216 @@
+# Description: Resolver of the metadata of the pages (module, number of page
+#              in the module, directory and subdirectory of its ZIP file) with
+#              batched queries over a pool of connections to the database, or
+#              over a local SQLite mirror of the pages and modules tables.
+# Phase: Extraction
+# Author: Luis Palazón Simón
+
+import os
+import sqlite3
+from collections import namedtuple
+
+# Page IDs per query
+BATCH_SIZE = 1000
+# Page IDs per query in SQLite (older versions allow up to 999 parameters)
+SQLITE_BATCH_SIZE = 500
+# Rows fetched at a time when the mirror is created
+FETCH_SIZE = 100000
+PAGES_QUERY = "SELECT p.id, p.module_id, p.num_page, m.file_path FROM pages p " \
+              "JOIN modules m ON m.id = p.module_id WHERE p.id IN ({})"
+MIRROR_FILE = 'page_metadata.sqlite'
+# Only the columns used to locate the pages are mirrored
+MIRROR_SCHEMA = [
+    "CREATE TABLE modules (id INTEGER PRIMARY KEY, file_path TEXT NOT NULL)",
+    "CREATE TABLE pages (id INTEGER PRIMARY KEY, module_id INTEGER NOT NULL, num_page INTEGER NOT NULL)",
+]
+MIRROR_TABLES = [
+    ("modules", "SELECT id, file_path FROM modules"),
+    ("pages", "SELECT id, module_id, num_page FROM pages"),
+]
+
+PageInfo = namedtuple('PageInfo', ['module_id', 'num_page', 'dir', 'subdir'])
+
+
+def get_subdir_os(cpu):
+    """Obtains the subdirectory of the OS
+
+    Args:
+        cpu (str): CPU of the OS
+
+    Returns:
+        A string with the subdirectory of the OS
+    """
+    if cpu == "Intel32":
+        return "32-bits"
+    elif cpu == "Intel64":
+        return "64-bits"
+    # XXX To be updated when new archs are considered
+    else:
+        return "" # To search in all subdirectories
+
+
+def parse_module_path(file_path):
+    """Obtains the directory and subdirectory of the ZIP of a module from the
+    name of its JSON file (<dir>_<company>_<word_size>.json)
+
+    Args:
+        file_path (str): file_path of the module in the database
+
+    Returns:
+        tuple: Directory (name of the module) and subdirectory of the OS
+    """
+    info = file_path.split("_")
+    dir, company, word_size = info[:-2], info[-2], (info[-1])[:-5]
+    return "_".join(dir), get_subdir_os(company+word_size)
+
+
+def batches(items, size):
+    """Splits a list in batches of a given size"""
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+
+def build_page_table(rows):
+    """Builds the table page_id -> PageInfo from the rows (id, module_id,
+    num_page, file_path). The module information is shared by its pages."""
+    modules = {}
+    table = {}
+    for page_id, module_id, num_page, file_path in rows:
+        if module_id not in modules:
+            modules[module_id] = parse_module_path(file_path)
+        dir, subdir = modules[module_id]
+        table[page_id] = PageInfo(module_id, num_page, dir, subdir)
+    return table
+
+
+class MySQLResolver(object):
+    """Resolves the metadata of the pages in the MySQL database"""
+
+    def __init__(self, host, user, pwd, dbname, pool_size=2, pool_name="page_metadata"):
+        from mysql.connector import pooling
+        self.pool = pooling.MySQLConnectionPool(pool_name=pool_name, pool_size=pool_size,
+                                                host=host, user=user, password=pwd, database=dbname)
+
+    def resolve(self, page_ids, batch_size=BATCH_SIZE):
+        """Obtains the metadata of a list of pages
+
+        Args:
+            page_ids (list): Page IDs
+            [opt.] batch_size (int): Page IDs per query
+
+        Returns:
+            dict: page_id -> PageInfo(module_id, num_page, dir, subdir), the
+                pages that aren't in the database are missing
+        """
+        rows = []
+        connection = self.pool.get_connection()
+        try:
+            cursor = connection.cursor()
+            for batch in batches(sorted(set(page_ids)), batch_size):
+                cursor.execute(PAGES_QUERY.format(",".join(["%s"]*len(batch))), tuple(batch))
+                rows.extend(cursor.fetchall())
+            cursor.close()
+        finally:
+            # Returns the connection to the pool
+            connection.close()
+        return build_page_table(rows)
+
+    def mirror(self, path=MIRROR_FILE, fetch_size=FETCH_SIZE):
+        """Copies the columns of the pages and modules tables used to locate
+        the pages to a SQLite file. The file is replaced atomically, so the
+        previous mirror can be used until the new one is complete.
+
+        Args:
+            [opt.] path (string): Path of the SQLite file
+            [opt.] fetch_size (int): Rows fetched from MySQL at a time
+
+        Returns:
+            dict: Number of rows copied of each table
+        """
+        tmp = path + '.tmp'
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        counts = {}
+        db = sqlite3.connect(tmp)
+        connection = self.pool.get_connection()
+        try:
+            for statement in MIRROR_SCHEMA:
+                db.execute(statement)
+            for table, query in MIRROR_TABLES:
+                cursor = connection.cursor()
+                cursor.execute(query)
+                counts[table] = 0
+                rows = cursor.fetchmany(fetch_size)
+                while rows:
+                    db.executemany("INSERT INTO {} VALUES ({})".format(table, ",".join(["?"]*len(rows[0]))), rows)
+                    counts[table] += len(rows)
+                    rows = cursor.fetchmany(fetch_size)
+                cursor.close()
+            db.commit()
+        finally:
+            connection.close()
+            db.close()
+        os.rename(tmp, path)
+        return counts
+
+
+class SQLiteResolver(object):
+    """Resolves the metadata of the pages in a local SQLite mirror of the
+    database (see MySQLResolver.mirror)"""
+
+    def __init__(self, path=MIRROR_FILE):
+        self.path = path
+        self.db = sqlite3.connect(path)
+
+    def close(self):
+        self.db.close()
+
+    def resolve(self, page_ids, batch_size=SQLITE_BATCH_SIZE):
+        """Obtains the metadata of a list of pages
+
+        Args:
+            page_ids (list): Page IDs
+            [opt.] batch_size (int): Page IDs per query
+
+        Returns:
+            dict: page_id -> PageInfo(module_id, num_page, dir, subdir), the
+                pages that aren't in the mirror are missing
+        """
+        rows = []
+        for batch in batches(sorted(set(page_ids)), batch_size):
+            rows.extend(self.db.execute(PAGES_QUERY.format(",".join(["?"]*len(batch))), tuple(batch)).fetchall())
+        return build_page_table(rows)
+
+
+def open_resolver(dbinfo, mirror=MIRROR_FILE):
+    """Obtains the resolver of the metadata of the pages: the SQLite mirror if
+    it exists, the MySQL database otherwise
+
+    Args:
+        dbinfo (function): Function returning the host, user, password and
+            name of the database (only called if the database is used)
+        [opt.] mirror (string): Path of the SQLite mirror
+
+    Returns:
+        MySQLResolver or SQLiteResolver: Resolver of the metadata of the pages
+    """
+    if mirror and os.path.exists(mirror):
+        return SQLiteResolver(mirror)
+    return MySQLResolver(*dbinfo())
+
+
+if __name__ == '__main__':
+    import argparse
+    import configparser as cg
+    parser = argparse.ArgumentParser(description="Creates a local SQLite mirror of the metadata of the pages")
+    parser.add_argument("-cfg", "--configfile", help="Config file with the DBINFO of the database", metavar="configfile", default="config.ini")
+    parser.add_argument("-mirror", "--mirror", help="SQLite file of the mirror. Default is {}".format(MIRROR_FILE), metavar="mirror", default=MIRROR_FILE)
+    args = parser.parse_args()
+    config = cg.ConfigParser()
+    if not config.read(args.configfile):
+        print("[-] Config file not found :(, exiting now...")
+        raise SystemExit(1)
+    dbinfo = config['DBINFO']
+    print("[+] Copying the pages and modules of {} from {}...".format(dbinfo['dbname'], dbinfo['host']))
+    counts = MySQLResolver(dbinfo['host'], dbinfo['user'], dbinfo['pwd'], dbinfo['dbname']).mirror(args.mirror)
+    print("[+] Mirror written in {} ({} modules, {} pages)".format(args.mirror, counts['modules'], counts['pages']))
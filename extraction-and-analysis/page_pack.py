@@ -0,0 +1,236 @@
+# Description: Page pack, a single append-only data file with the extracted
+#              pages aligned to PAGE_SIZE and an index file with the offset of
+#              each page ID. Readers memory-map the data file and access the
+#              pages without copying them. Pages with the same content are
+#              stored only once (content-addressed by their xxHash64 digest).
+# Phase: Extraction/Analysis
+# Author: Luis Palazón Simón
+
+import os
+import mmap
+import fcntl
+import struct
+import xxhash
+
+PAGE_SIZE = 4096
+PACK_FILE = 'pages.pack'
+# Index record: page_id, offset in the data file, length of the page and
+# xxHash64 hexdigest of its content
+RECORD = struct.Struct('<QQI16s')
+
+
+def content_digest(content):
+    """Calculates the digest used to identify the content of a page
+
+    Args:
+        content (bytes): Content of the page
+
+    Returns:
+        string: xxHash64 hexdigest of the content
+    """
+    return xxhash.xxh64(content).hexdigest()
+
+
+class PagePack(object):
+    """Page pack stored in <path> (data) and <path>.idx (index)
+
+    The data file only grows: a page written again is appended and the last
+    record of the index for a page ID is the valid one. A content that is
+    already in the data file isn't written again, the record of the new page ID
+    points to the stored copy. Several processes can append to the same pack,
+    the appends are serialized with a lock.
+    """
+
+    def __init__(self, path=PACK_FILE):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.pages = {}
+        self.contents = {}
+        self._index_size = 0
+        self._mm = None
+        self._mm_size = 0
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __contains__(self, page_id):
+        page_id = int(page_id)
+        if page_id not in self.pages:
+            self.reload()
+        return page_id in self.pages
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def page_ids(self):
+        return self.pages.keys()
+
+    def reload(self):
+        """Reads the records appended to the index since the last load"""
+        if not os.path.exists(self.index_path):
+            return self
+        with open(self.index_path, 'rb') as f:
+            f.seek(self._index_size)
+            data = f.read()
+        # An incomplete last record (a writer is appending it) is read later
+        data = data[:len(data) - len(data) % RECORD.size]
+        for pos in range(0, len(data), RECORD.size):
+            page_id, offset, length, digest = RECORD.unpack_from(data, pos)
+            digest = digest.decode('ascii')
+            self.pages[page_id] = (offset, length, digest)
+            self.contents.setdefault(digest, (offset, length))
+        self._index_size += len(data)
+        return self
+
+    def close(self):
+        if self._mm is not None:
+            try:
+                self._mm.close()
+            except BufferError:
+                # There are still views of the pages, the map is released with them
+                pass
+            self._mm = None
+            self._mm_size = 0
+
+    def _map(self, end):
+        """Maps the data file, again if it has grown beyond the current map
+        (the previous map stays alive while there are views of its pages)"""
+        if self._mm is None or end > self._mm_size:
+            with open(self.path, 'rb') as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mm_size = len(self._mm)
+        return self._mm
+
+    def _entry(self, page_id):
+        page_id = int(page_id)
+        if page_id not in self.pages:
+            self.reload()
+        return self.pages[page_id]
+
+    def digest(self, page_id):
+        return self._entry(page_id)[2]
+
+    def size(self, page_id):
+        return self._entry(page_id)[1]
+
+    def view(self, page_id):
+        """Returns a memoryview of the page over the mapped data file (no copy)"""
+        offset, length, _ = self._entry(page_id)
+        return memoryview(self._map(offset + length))[offset:offset + length]
+
+    def array(self, page_id):
+        """Returns a read-only NumPy uint8 array of the page (no copy)"""
+        import numpy as np
+        offset, length, _ = self._entry(page_id)
+        return np.frombuffer(self._map(offset + length), dtype=np.uint8, count=length, offset=offset)
+
+    def read(self, page_id):
+        """Returns a copy of the content of the page as bytes"""
+        offset, length, _ = self._entry(page_id)
+        return self._map(offset + length)[offset:offset + length]
+
+    def page_ids_by_digest(self):
+        """Returns a dict digest -> list of page IDs with that content"""
+        groups = {}
+        for page_id, (_, _, digest) in self.pages.items():
+            groups.setdefault(digest, []).append(page_id)
+        return groups
+
+    def stats(self):
+        """Returns the deduplication statistics of the pack
+
+        Returns:
+            dict: Number of pages and of unique contents, logical bytes (sum of
+                the pages) and stored bytes (data file) and deduplication ratio
+        """
+        unique = set(digest for _, _, digest in self.pages.values())
+        logical = sum(length for _, length, _ in self.pages.values())
+        stored = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        return {
+            'pages': len(self.pages),
+            'unique': len(unique),
+            'logical_bytes': logical,
+            'stored_bytes': stored,
+            'dedup_ratio': float(len(self.pages)) / len(unique) if unique else 1.0,
+        }
+
+    def append(self, page_id, content):
+        """Appends a page at the end of the data file (aligned to PAGE_SIZE)
+
+        Args:
+            page_id (int): Page ID
+            content (bytes): Content of the page
+
+        Returns:
+            string: Digest of the content
+        """
+        digest = content_digest(content)
+        padding = (-len(content)) % PAGE_SIZE
+        with open(self.path, 'ab') as data:
+            fcntl.flock(data, fcntl.LOCK_EX)
+            try:
+                # Other processes may have stored the same content
+                self.reload()
+                stored = self.contents.get(digest)
+                data.seek(0, os.SEEK_END)
+                if stored is not None and stored[1] == len(content) and \
+                        self._map(stored[0] + stored[1])[stored[0]:stored[0] + stored[1]] == content:
+                    offset = stored[0]
+                else:
+                    offset = data.tell()
+                    data.write(content)
+                    data.write(b'\x00' * padding)
+                    data.flush()
+                    self.contents.setdefault(digest, (offset, len(content)))
+                # The record is written after the data, so a page in the index
+                # is always complete in the data file
+                with open(self.index_path, 'ab') as index:
+                    index.write(RECORD.pack(int(page_id), offset, len(content), digest.encode('ascii')))
+            finally:
+                fcntl.flock(data, fcntl.LOCK_UN)
+        self.pages[int(page_id)] = (offset, len(content), digest)
+        return digest
+
+
+def convert_directory(directory, pack):
+    """Appends to the pack the .dmp pages of a directory that aren't already in it
+
+    Args:
+        directory (string): Directory with the <page_id>_extracted_<n>_<dir>.dmp files
+        pack (PagePack): Destination pack
+
+    Returns:
+        integer: Number of pages added to the pack
+    """
+    from page_index import PageIndex
+    index = PageIndex(directory).load()
+    index.refresh()
+    added = 0
+    pack.reload()
+    for page_id in sorted(index.pages):
+        if page_id in pack.pages and pack.digest(page_id) == index.digest(page_id):
+            continue
+        with open(index.path(page_id), 'rb') as f:
+            pack.append(page_id, f.read())
+        added += 1
+    return added
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Convierte un directorio de páginas .dmp a un page pack o muestra su contenido')
+    parser.add_argument('directory', nargs='?', default=None, help='Directorio con las páginas .dmp a convertir')
+    parser.add_argument('-o', '--output', default=PACK_FILE, help='Fichero del page pack')
+    args = parser.parse_args()
+    with PagePack(args.output).reload() as pack:
+        if args.directory:
+            added = convert_directory(args.directory, pack)
+            print('Páginas añadidas al pack: {}'.format(added))
+        stats = pack.stats()
+        print('Páginas en el pack: {}'.format(stats['pages']))
+        print('Contenidos únicos: {}'.format(stats['unique']))
+        print('Tamaño de las páginas: {}B, tamaño del fichero de datos: {}B'.format(stats['logical_bytes'], stats['stored_bytes']))
+        print('Ratio de deduplicación: {:.2f}'.format(stats['dedup_ratio']))
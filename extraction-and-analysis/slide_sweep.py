@@ -0,0 +1,162 @@
+# Description: Sweep of slides of a pair of pages: the content of one of them is
+#              slid across a range of displacements (with a prefix byte and a
+#              payload) and the hashes of each variant are compared with the
+#              ones of the other page in a pool of hashing workers.
+# Phase: Analysis
+# Author: Luis Palazón Simón
+
+import binascii
+import multiprocessing
+import pandas as pd
+from page_index import open_index
+from page_pack import content_digest
+from hash_worker import HashWorkerPool, HashWorkerError, encode_content
+from variants import PAYLOADS, Variant, iter_variants
+
+# Variants per request sent to the workers
+CHUNK_SIZE = 32
+SWEEP_COLUMNS = ['slide', 'tlsh_equal', 'ssdeep_equal', 'sdhash_equal', 'tlsh_distance', 'ssdeep_score']
+
+
+def unique_variants(content, slides, prefix, payload=None):
+    """Builds the variants of a content slid each slide and groups the equal ones
+
+    Args:
+        content (bytes): Content slid
+        slides (list): Slides of the sweep
+        prefix (bytes): Byte used to fill the slide
+        [opt.] payload (bytes): Content placed just before the slid content
+
+    Returns:
+        list: Slide of the first variant of each different content
+        dict: slide -> slide of the first variant with its content
+    """
+    first = {}
+    same = {}
+    for slide, variant in zip(slides, iter_variants(content, [Variant(s) for s in slides], prefix, payload)):
+        same[slide] = first.setdefault(content_digest(variant), slide)
+    return sorted(set(first.values())), same
+
+
+def sweep_table(slides, same, comparisons):
+    """Builds the table of the sweep
+
+    Args:
+        slides (list): Slides of the sweep
+        same (dict): slide -> slide with the same content (see unique_variants)
+        comparisons (dict): slide -> comparison of the hashes of its variant with
+            the ones of the other page (see hashes.compare_hashes)
+
+    Returns:
+        pandas.DataFrame: A row per slide with the columns SWEEP_COLUMNS
+    """
+    rows = []
+    for slide in slides:
+        algorithms = dict((c['algorithm'], c) for c in comparisons[same[slide]])
+        rows.append({
+            'slide': slide,
+            'tlsh_equal': algorithms['TLSH']['equal'],
+            'ssdeep_equal': algorithms['SSDeep']['equal'],
+            'sdhash_equal': algorithms['SDHash']['equal'],
+            'tlsh_distance': algorithms['TLSH']['score'],
+            'ssdeep_score': algorithms['SSDeep']['score'],
+        })
+    table = pd.DataFrame(rows, columns=SWEEP_COLUMNS)
+    return table.astype({'slide': 'int32', 'tlsh_distance': 'Int32', 'ssdeep_score': 'Int32'})
+
+
+def slide_sweep(page1, page2, slides, slid=1, prefix=b'\x00', payload=None, pool=None, derelocation='raw', directory='.'):
+    """Compares the hashes of a page slid across a range of displacements with
+    the ones of another page. The equal variants are hashed only once.
+
+    Args:
+        page1 (int): Page ID of the first page
+        page2 (int): Page ID of the second page
+        slides (list): Slides of the sweep
+        [opt.] slid (int): Page slid (1 or 2), the other one is the reference
+        [opt.] prefix (bytes): Byte used to fill the slide
+        [opt.] payload (bytes): Content placed just before the slid content
+        [opt.] pool (HashWorkerPool): Workers (a pool with a worker per CPU by default)
+        [opt.] derelocation (str): Derelocation value for the SUM tool
+        [opt.] directory (str): Directory of the pages
+
+    Returns:
+        pandas.DataFrame: A row per slide with the columns SWEEP_COLUMNS and the
+            number of different variants hashed in attrs['hashed']
+
+    Raises:
+        HashWorkerError: If the variants can't be hashed
+    """
+    index = open_index(directory)
+    slid_page, reference = (page1, page2) if slid == 1 else (page2, page1)
+    content = index.read(slid_page)
+    slides = list(slides)
+    unique, same = unique_variants(content, slides, prefix, payload)
+    # Each request carries a chunk of variants and the reference page, whose
+    # hashes are calculated once per request
+    chunks = [unique[i:i+CHUNK_SIZE] for i in range(0, len(unique), CHUNK_SIZE)]
+    base = {'op': 'variants', 'content': encode_content(content), 'reference_content': encode_content(index.read(reference)),
+            'prefix': binascii.hexlify(prefix).decode('ascii'), 'derelocation': derelocation}
+    if payload:
+        base['payload'] = encode_content(payload)
+    requests = [dict(base, variants=[{'slide': s} for s in chunk]) for chunk in chunks]
+    own_pool = pool is None
+    if own_pool:
+        pool = HashWorkerPool(max(1, min(multiprocessing.cpu_count(), len(requests))), directory=directory)
+    try:
+        responses = pool.map(requests)
+    finally:
+        if own_pool:
+            pool.close()
+    comparisons = {}
+    for chunk, response in zip(chunks, responses):
+        if not response['ok']:
+            raise HashWorkerError(response['error'])
+        comparisons.update(zip(chunk, response['comparisons']))
+    table = sweep_table(slides, same, comparisons)
+    table.attrs['hashed'] = len(unique)
+    return table
+
+
+if __name__ == '__main__':
+    import argparse
+    from dataset_store import save_dataset
+    parser = argparse.ArgumentParser(description="Hashes a pair of pages across a range of slides of one of them")
+    parser.add_argument('page1', type=int, help='Page ID of the first page')
+    parser.add_argument('page2', type=int, help='Page ID of the second page')
+    parser.add_argument('-start', '--start', type=int, default=1, help='First slide. Default is 1')
+    parser.add_argument('-end', '--end', type=int, default=4096, help='Last slide (included). Default is 4096')
+    parser.add_argument('-step', '--step', type=int, default=1, help='Step between slides. Default is 1')
+    parser.add_argument('-slid', '--slid', type=int, choices=[1, 2], default=1, help='Page slid, the other one is the reference. Default is 1')
+    parser.add_argument('-prefix', '--prefix', default='00', help='Prefix byte in hexadecimal. Default is 00')
+    parser.add_argument('-payload', '--payload', default=None, help='Payload placed before the slid content ({} or a file)'.format(', '.join(sorted(PAYLOADS))))
+    parser.add_argument('-der', '--derelocation', default='raw', choices=['raw', 'best'], help='Derelocation value for the SUM tool. Default is raw')
+    parser.add_argument('-w', '--workers', type=int, default=multiprocessing.cpu_count(), help='Hashing workers. Default is the number of CPUs')
+    parser.add_argument('-o', '--output', default=None, help='Save the table in a .parquet file')
+    args = parser.parse_args()
+
+    prefix = binascii.unhexlify(args.prefix)
+    assert len(prefix) == 1, 'The prefix must be a single byte'
+    payload = None
+    if args.payload:
+        if args.payload in PAYLOADS:
+            payload = PAYLOADS[args.payload]
+        else:
+            with open(args.payload, 'rb') as f:
+                payload = f.read()
+    # The slides must leave room for the payload
+    start = max(args.start, len(payload)) if payload else args.start
+    slides = list(range(start, args.end + 1, args.step))
+    index = open_index('.')
+    for page in (args.page1, args.page2):
+        if page not in index:
+            print('[-] Page {} not found'.format(page))
+            exit(1)
+    with HashWorkerPool(max(1, args.workers)) as pool:
+        table = slide_sweep(args.page1, args.page2, slides, args.slid, prefix, payload, pool, args.derelocation)
+    print('[+] Slides: {}, different variants hashed: {}'.format(len(table), table.attrs['hashed']))
+    with pd.option_context('display.max_rows', None):
+        print(table.to_string(index=False))
+    if args.output:
+        save_dataset(table, args.output)
+        print('[+] Table saved in {}'.format(args.output))
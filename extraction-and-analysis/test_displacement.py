@@ -0,0 +1,29 @@
+# Description: Regression tests of the search of displacements with anchors,
+#              which must get the same result as the exhaustive search.
+# Phase: Analysis
+# Author: Luis Palazón Simón
+
+import numpy as np
+from displacement import PAGE_SIZE, findDisplacement, findAnchoredDisplacement
+
+
+def random_bytes(size, seed):
+    return np.random.RandomState(seed).randint(0, 256, size).astype(np.uint8)
+
+
+def test_repeated_windows_overlap():
+    # The overlap of the exact displacement (3996 over content1) only has
+    # zeros, so no anchor backs it, while a bigger displacement is exact too
+    zeros = np.zeros(100, np.uint8)
+    a = np.concatenate((zeros, random_bytes(PAGE_SIZE - 100, 1)))
+    b = np.concatenate((random_bytes(PAGE_SIZE - 100, 2), zeros))
+    assert findDisplacement(a, b) == (PAGE_SIZE - 100, True)
+    assert findAnchoredDisplacement(a, b)[:2] == (PAGE_SIZE - 100, True)
+
+
+def test_anchored_displacement():
+    page = random_bytes(2*PAGE_SIZE, 3)
+    for d in (0, 1, 700, PAGE_SIZE - 10):
+        a, b = page[:PAGE_SIZE], page[d:d+PAGE_SIZE]
+        assert findAnchoredDisplacement(a, b)[:2] == findDisplacement(a, b) == (d, d == 0)
+        assert findAnchoredDisplacement(b, a)[:2] == findDisplacement(b, a) == (d, True)
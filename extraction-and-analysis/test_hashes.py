@@ -4,60 +4,92 @@
 
 import os
 import sys
-import subprocess
 import argparse
+import multiprocessing
 import tqdm
-import pandas as pd
+from dataset_store import load_pairs
+from page_index import open_index
+from hash_worker import HashWorkerPool, comparison_lines
+
+# Hashing workers (python2 hash_worker.py processes)
+HASH_WORKERS = multiprocessing.cpu_count()
+# Requests sent to the pool at a time (to show the progress)
+CHUNK_SIZE = 256
+
+def run_tests(index, pages, x, crop, pool):
+    '''
+    Compares the hashes of each different content of the pages with the ones of
+    the content with the first x bytes changed (as hashes.py -test x) in the
+    pool of hashing workers and writes the comparison in test_hashes.txt once
+    per page, so the pages with the same content reuse the result.
+    parameters:
+        index: PageIndex of the current directory
+        pages: list of int, page IDs
+        x: int, number of bytes changed in the test
+        crop: int, bytes cropped at the end of the contents (None to not crop)
+        pool: HashWorkerPool
+    '''
+    groups = list(index.group_by_digest(pages).values())
+    with open('test_hashes.txt', 'w') as out, tqdm.tqdm(total=len(groups), desc='Processing files', unit='file') as progress:
+        for i in range(0, len(groups), CHUNK_SIZE):
+            chunk = groups[i:i+CHUNK_SIZE]
+            responses = pool.map({'op': 'compare', 'page1': same[0], 'test': x, 'crop': crop} for same in chunk)
+            for same, response in zip(chunk, responses):
+                if response['ok']:
+                    output = ''.join(line + '\n' for line in comparison_lines(response['comparison']))
+                else:
+                    # A page that can't be hashed doesn't stop the rest
+                    output = 'Error: {}\n'.format(response['error'])
+                for _ in same:
+                    out.write(output)
+            progress.update(len(chunk))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Test hashes.py')
     parser.add_argument('x', type=int, help='Number of test to do')
-    parser.add_argument('dataset', type=str, help='Dataset .xlsx to test', nargs='?')
+    parser.add_argument('dataset', type=str, help='Dataset .parquet (or .xlsx) to test', nargs='?')
     parser.add_argument('-read', '--readOnly', action='store_true', help='Read only mode', default=False)
     parser.add_argument('-fin', '--fin', type=int, help='Final test', default=None)
     parser.add_argument('-crop', '--crop', type=int, help='Crop bytes', default=None)
+    parser.add_argument('-hf', '--hash_function', type=str, help='Only test the pairs of the dataset that collided with this hash function, alone or combined (e.g. TLSH)', default=None)
     args = parser.parse_args()
 
-    crop = ''
-    if args.crop:
-        crop = ' -crop ' + str(args.crop)
+    crop = args.crop
 
-    # Obtain the .dmp files from the current directory
+    # Obtain the pages from the index of the pages of the current directory
+    # (the page IDs are passed to the hashing workers, so the pages can also be in the page pack)
+    index = open_index('.')
     if not args.dataset:
-        files = [f for f in os.listdir('.') if f.endswith('.dmp')]
+        files = sorted(index.page_ids())
         total = len(files)
     else:
-        # args.dataset is a .xlsx file that contains a pandas dataframe
-        df = pd.read_excel(args.dataset)
+        # args.dataset is a .parquet (or .xlsx) file that contains a pandas dataframe,
+        # only the page1 and page2 columns are loaded
+        df = load_pairs(args.dataset, args.hash_function)
         files = []
         # we want to read the 'page1' column
         pages = df['page1'].tolist()
         for p in pages:
-            p1 = int(p)
-            res = subprocess.run(['find', '.', '-maxdepth', '1', '-type', 'f', '-name', '{}_*'.format(p1)], stdout=subprocess.PIPE)
-            if res.returncode != 0:
+            if int(p) not in index:
                 print('No se ha encontrado el fichero del primer número de página')
                 exit(1)
-            file1 = res.stdout.decode().split('\n')[0]
-            files.append(file1)
+            files.append(int(p))
         # we want to read the 'page2' column
         pages = df['page2'].tolist()
         for p in pages:
-            p2 = int(p)
-            res = subprocess.run(['find', '.', '-maxdepth', '1', '-type', 'f', '-name', '{}_*'.format(p2)], stdout=subprocess.PIPE)
-            if res.returncode != 0:
+            if int(p) not in index:
                 print('No se ha encontrado el fichero del segundo número de página')
                 exit(1)
-            file2 = res.stdout.decode().split('\n')[0]
-            files.append(file2) 
+            files.append(int(p))
         total = len(files)   
+    unique = len(index.group_by_digest(files))
+    print('Contenidos únicos: {} de {} páginas (ratio de deduplicación: {:.2f})'.format(unique, total, float(total) / unique if unique else 1.0))
     if not args.fin:
         if not args.readOnly:
-            # Execute the hashes.py script with each of the files
-            # and the -test x argument
-            os.remove('test_hashes.txt')
-            for f in tqdm.tqdm(files, desc='Processing files', unit='file'):
-                os.system('python2 hashes.py ' + f + ' -test ' + str(args.x) + crop + ' >> test_hashes.txt')
+            # Compare the hashes of each of the files with the ones
+            # of the file with the first x bytes changed
+            with HashWorkerPool(HASH_WORKERS) as pool:
+                run_tests(index, files, args.x, crop, pool)
 
         # Count how many hashes of each algorithm are equal
         with open('test_hashes.txt') as f:
@@ -79,13 +111,13 @@ if __name__ == '__main__':
         # remove results_test_hashes.txt if it exists
         if os.path.exists('results_test_hashes.txt'):
             os.remove('results_test_hashes.txt')
+        # The workers are started once for all the tests
+        pool = HashWorkerPool(HASH_WORKERS) if not args.readOnly else None
         for x in xs:
             if not args.readOnly:
-                # Execute the hashes.py script with each of the files
-                # and the -test x argument
-                os.remove('test_hashes.txt')
-                for f in tqdm.tqdm(files, desc='Processing files', unit='file'):
-                    os.system('python2 hashes.py ' + f + ' -test ' + str(x) + crop + ' >> test_hashes.txt')
+                # Compare the hashes of each of the files with the ones
+                # of the file with the first x bytes changed
+                run_tests(index, files, x, crop, pool)
 
             # Count how many hashes of each algorithm are
             with open('test_hashes.txt') as f:
@@ -103,4 +135,6 @@ if __name__ == '__main__':
                 f.write('Test ' + str(x) + '\n')
                 f.write('SDHash equal: ' + str(countSDHASH) + ' of ' + str(total) + '\n')
                 f.write('TLSH equal: ' + str(countTLSH) + ' of ' + str(total) + '\n')
-                f.write('SSDeep equal: ' + str(countSSDEEP) + ' of ' + str(total) + '\n')
\ No newline at end of file
+                f.write('SSDeep equal: ' + str(countSSDEEP) + ' of ' + str(total) + '\n')
+        if pool is not None:
+            pool.close()
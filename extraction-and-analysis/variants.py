@@ -0,0 +1,108 @@
+# Description: Builder of the variants of the content of a page used to test
+#              the hashes (slid with a prefix and a payload, with the first
+#              bytes overwritten and cropped), each one built with a single
+#              copy into a preallocated buffer, and batches of variants.
+# Phase: Analysis
+# Author: Luis Palazón Simón
+
+from collections import namedtuple
+
+PREFIX = b'\x00'
+# Payloads of hashes.py -prefix
+PAYLOADS = {
+    "8B": b'\xD7\xCB\x81\x7C\x90\x90\x90\x90',
+    "16B": b'\xB8\xD7\xCB\x81\x7C\xFF\xD0\x90\x90\x90\x90\x90\x90\x90\x90\x90',
+    "32B": (
+        b'\x31\xc0\x50\x68\x2e\x65\x78\x65\x68\x2e\x63\x6d\x64'
+        b'\x89\xe3\xb8\xc0\x1e\x86\x7c\xff\xd0\x31\xc0\xb8\xd7'
+        b'\xcb\x81\x7c\xff\xd0'
+    ),
+}
+
+# Transformations of a variant, applied in this order: the first overwrite
+# bytes are changed by the prefix, the content is slid slide bytes (the
+# beginning is filled with the prefix followed by the payload) and the last
+# crop bytes are removed
+Variant = namedtuple('Variant', ['slide', 'overwrite', 'crop'])
+Variant.__new__.__defaults__ = (0, 0, 0)
+
+
+def fill(prefix, size):
+    """Repeats the prefix to fill size bytes"""
+    return (bytearray(prefix) * (size // len(prefix) + 1))[:size]
+
+
+def build_variant(content, variant, prefix=PREFIX, payload=None, out=None):
+    """Builds a variant of a content
+
+    Args:
+        content (bytes): Content of the page
+        variant (Variant): Transformations of the variant
+        [opt.] prefix (bytes): Byte used to fill the slide and to overwrite
+        [opt.] payload (bytes): Content placed just before the slid content
+        [opt.] out (bytearray): Buffer of the size of the content where the
+            variant is built (a new one by default)
+
+    Returns:
+        memoryview: Variant (a view of out, valid until out is reused)
+
+    Raises:
+        ValueError: If the payload is larger than the slide
+    """
+    size = len(content)
+    payload = payload or b''
+    if out is None:
+        out = bytearray(size)
+    slide = min(variant.slide, size)
+    if variant.slide and len(payload) > variant.slide:
+        raise ValueError("The payload is larger than the slide value")
+    if variant.slide:
+        # Prefix and payload in the beginning, the rest is the content moved
+        head = fill(prefix, variant.slide - len(payload)) + bytearray(payload)
+        out[:slide] = head[:slide]
+    else:
+        slide = 0
+    out[slide:size] = memoryview(content)[:size - slide]
+    # Overwritten bytes of the content after the slide
+    overwrite = min(variant.overwrite, size - slide)
+    if overwrite > 0:
+        out[slide:slide + overwrite] = fill(prefix, overwrite)
+    view = memoryview(out)[:size]
+    if variant.crop:
+        view = view[:max(size - variant.crop, 0)]
+    return view
+
+
+def make_variant(content, slide=0, overwrite=0, crop=0, prefix=PREFIX, payload=None):
+    """Builds a variant of a content (see build_variant)
+
+    Returns:
+        bytes: Variant
+    """
+    return build_variant(content, Variant(slide, overwrite, crop), prefix, payload).tobytes()
+
+
+def iter_variants(content, variants, prefix=PREFIX, payload=None):
+    """Builds a batch of variants of a content in a single buffer
+
+    Args:
+        content (bytes): Content of the page
+        variants (list): Variant of each element of the batch
+        [opt.] prefix (bytes): Byte used to fill the slide and to overwrite
+        [opt.] payload (bytes): Content placed just before the slid content
+
+    Yields:
+        memoryview: Each variant, valid until the next one is built
+    """
+    out = bytearray(len(content))
+    for variant in variants:
+        yield build_variant(content, variant, prefix, payload, out)
+
+
+def build_variants(content, variants, prefix=PREFIX, payload=None):
+    """Builds a batch of variants of a content
+
+    Returns:
+        list: Variants (bytes), in the same order
+    """
+    return [v.tobytes() for v in iter_variants(content, variants, prefix, payload)]
@@ -0,0 +1,163 @@
+# Description: Persistent index of the module ZIP files of the modules folder.
+#              It maps the name of each module (dir) to its exact ZIP path,
+#              with its mtime and size to validate it, and it's refreshed
+#              incrementally (only the directories that have changed are listed).
+# Phase: Extraction
+# Author: Luis Palazón Simón
+
+import os
+import json
+
+ZIP_INDEX_FILE = 'zip_index.json'
+ZIP_INDEX_VERSION = 1
+
+
+class ZipIndex(object):
+    """Index dir -> ZIP path of the modules under a root folder
+
+    For each directory it stores its mtime, its subdirectories and its ZIP
+    files (with their mtime and size). A directory whose mtime hasn't changed
+    isn't listed again when the index is refreshed.
+    """
+
+    def __init__(self, root, index_path=ZIP_INDEX_FILE):
+        self.root = os.path.abspath(root)
+        self.index_path = index_path
+        self.dirs = {}
+        self.keys = {}
+        self.dirty = False
+
+    def __len__(self):
+        return sum(len(paths) for paths in self.keys.values())
+
+    def load(self):
+        """Loads the index from disk (if it exists, has the current version and the same root)"""
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == ZIP_INDEX_VERSION and data.get('root') == self.root:
+                self.dirs = data['dirs']
+                self._build_keys()
+            else:
+                self.dirty = True
+        return self
+
+    def save(self):
+        """Saves the index to disk atomically"""
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': ZIP_INDEX_VERSION, 'root': self.root, 'dirs': self.dirs}, f)
+        os.rename(tmp, self.index_path)
+        self.dirty = False
+
+    def _build_keys(self):
+        self.keys = {}
+        for rel, (_, _, zips) in self.dirs.items():
+            for name in zips:
+                self.keys.setdefault(name[:-len('.zip')], []).append(os.path.join(rel, name))
+        for paths in self.keys.values():
+            paths.sort()
+
+    def refresh(self):
+        """Updates the index with the changes in the modules folder
+
+        Returns:
+            integer: Number of directories listed again
+        """
+        dirs = {}
+        listed = 0
+        pending = ['']
+        while pending:
+            rel = pending.pop()
+            full = os.path.join(self.root, rel)
+            try:
+                mtime = os.stat(full).st_mtime
+            except OSError:
+                continue
+            entry = self.dirs.get(rel)
+            if entry is None or entry[0] != mtime:
+                subdirs, zips = [], {}
+                for name in os.listdir(full):
+                    path = os.path.join(full, name)
+                    if os.path.isdir(path):
+                        subdirs.append(name)
+                    elif name.endswith('.zip'):
+                        st = os.stat(path)
+                        zips[name] = [st.st_mtime, st.st_size]
+                entry = [mtime, sorted(subdirs), zips]
+                listed += 1
+            dirs[rel] = entry
+            pending.extend(os.path.join(rel, d) for d in entry[1])
+        if listed or len(dirs) != len(self.dirs):
+            self.dirty = True
+        self.dirs = dirs
+        self._build_keys()
+        return listed
+
+    def _validate(self, rel_path):
+        """Checks that the ZIP still exists and updates its mtime and size"""
+        rel, name = os.path.split(rel_path)
+        try:
+            st = os.stat(os.path.join(self.root, rel_path))
+        except OSError:
+            return False
+        zips = self.dirs[rel][2]
+        if zips[name] != [st.st_mtime, st.st_size]:
+            zips[name] = [st.st_mtime, st.st_size]
+            self.dirty = True
+        return True
+
+    def lookup(self, dir, subdir=''):
+        """Obtains the ZIP file of a module
+
+        Args:
+            dir (str): Name of the module (name of the ZIP without .zip)
+            [opt.] subdir (str): Subdirectory of the OS where the ZIP must be,
+                all subdirectories if it's empty
+
+        Returns:
+            string: Path of the ZIP file, None if it's not found
+        """
+        for retry in (False, True):
+            if retry:
+                # The ZIP may be new or have been moved: refresh and try again
+                self.refresh()
+            for rel_path in self.keys.get(dir, []):
+                if subdir and not rel_path.startswith(subdir.strip('/') + os.sep):
+                    continue
+                if self._validate(rel_path):
+                    return os.path.join(self.root, rel_path)
+        return None
+
+
+def open_zip_index(root, index_path=ZIP_INDEX_FILE):
+    """Loads the index of the modules folder, refreshes it and saves it if it has changed
+
+    Args:
+        root (string): Folder where ZIP files are located
+        [opt.] index_path (string): File where the index is stored
+
+    Returns:
+        ZipIndex: Index of the ZIP files
+    """
+    index = ZipIndex(root, index_path).load()
+    index.refresh()
+    if index.dirty:
+        index.save()
+    return index
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Creates or updates the index of the module ZIP files")
+    parser.add_argument("-folder", "--folder", help="Folder where ZIP files are located", metavar="folder", default="/mnt/modules-Windows/")
+    parser.add_argument("-zipidx", "--zipindex", help="File where the index is stored", metavar="zipindex", default=ZIP_INDEX_FILE)
+    parser.add_argument("-m", "--modules", nargs="+", default=None, help="Show the ZIP file of these modules")
+    args = parser.parse_args()
+    index = ZipIndex(args.folder, args.zipindex).load()
+    listed = index.refresh()
+    if index.dirty:
+        index.save()
+    print("[+] Indexed ZIP files: {} (directories listed: {})".format(len(index), listed))
+    for module in args.modules or []:
+        print("{}: {}".format(module, index.lookup(module)))